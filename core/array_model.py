@@ -0,0 +1,149 @@
+"""
+Module containing array models that account for the array's shape.
+"""
+
+__author__ = "Brett Duncan"
+__email__ = "dunca384@umn.edu"
+
+
+from dataclasses import dataclass
+import math
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from core.irradiance import IrradianceRaster
+from core.race import Race
+import core.sun as sun
+
+
+@dataclass(frozen=True)
+class Facet:
+    """
+    Flat section of the solar array.
+    """
+    area: float  # <m^2>
+    efficiency: float
+    tilt: float  # <rad> from horizontal
+    azimuth: float  # <rad> direction the facet tilts toward, clockwise from the nose of the car
+
+
+class MultiFacetArray:
+    """
+    Array model made of several flat facets, such as a curved top shell.
+
+    A facet's incidence only depends on the sun's altitude and the sun's azimuth relative
+    to the car's heading, so the summed effective area (area * efficiency * cos(incidence))
+    of every facet is cached per (altitude bin, relative azimuth bin). After the cache warms
+    up the cost of a call doesn't depend on the number of facets.
+
+    When the array is normalized (stationary charging) the `charging_facets` are used
+    instead. Their azimuths are relative to the sun rather than the car, since the array
+    is turned to face the sun. By default the whole array faces the sun directly.
+    """
+
+    uses_sun_azimuth = True
+    """
+    Tells `simulate` to pass `sun_azimuth` and `heading` when calling the model.
+    """
+
+    def __init__(self,
+                 facets: Sequence[Facet],
+                 charging_facets: Optional[Sequence[Facet]] = None,
+                 altitude_bins: int = 180,
+                 azimuth_bins: int = 144):
+        self.facets = list(facets)
+        self.charging_facets = list(charging_facets) if charging_facets is not None else \
+            [Facet(area=f.area, efficiency=f.efficiency, tilt=0.0, azimuth=0.0) for f in facets]
+        self.altitude_bins = altitude_bins
+        self.azimuth_bins = azimuth_bins
+
+        self._driving_cache: Dict[Tuple[int, int], float] = {}
+        self._charging_cache: Dict[Tuple[int, int], float] = {}
+
+    def __call__(self,
+                 irradiance: float,
+                 sun_altitude: float,
+                 normalized: bool,
+                 sun_azimuth: float = 0.0,
+                 heading: float = 0.0) -> float:
+        """
+        Calculate the array power.
+
+        :param irradiance: Irradiance in watts/meter/meter.
+        :param sun_altitude: Solar altitude in radians.
+        :param normalized: Whether or not the array is normalized to the sun.
+        :param sun_azimuth: Solar azimuth in radians as returned by `core.sun`
+        (measured from south, positive toward west).
+        :param heading: Car heading in radians clockwise from north.
+
+        :return: Array power in watts.
+        """
+        if sun_altitude <= 0.0:
+            return 0.0
+
+        if normalized:
+            facets, cache, relative_azimuth = self.charging_facets, self._charging_cache, 0.0
+        else:
+            # Convert the solar azimuth to clockwise from north and make it relative to the car
+            facets, cache = self.facets, self._driving_cache
+            relative_azimuth = sun_azimuth + math.pi - heading
+
+        altitude_bin = min(int(sun_altitude / (math.pi / 2.0) * self.altitude_bins), self.altitude_bins - 1)
+        azimuth_bin = int((relative_azimuth % (2.0 * math.pi)) / (2.0 * math.pi) * self.azimuth_bins) \
+            % self.azimuth_bins
+
+        key = (altitude_bin, azimuth_bin)
+        effective_area = cache.get(key)
+        if effective_area is None:
+            # Evaluate at the center of the bin
+            altitude = (altitude_bin + 0.5) * (math.pi / 2.0) / self.altitude_bins
+            azimuth = (azimuth_bin + 0.5) * (2.0 * math.pi) / self.azimuth_bins
+            effective_area = sum(f.area * f.efficiency * c
+                                 for f, c in zip(facets, get_incidence(facets, altitude, azimuth)))
+            cache[key] = effective_area
+
+        return irradiance * effective_area
+
+
+def get_incidence(facets: Sequence[Facet], sun_altitude: float, relative_azimuth: float) -> List[float]:
+    """
+    Calculate the cosine of the angle of incidence of sunlight on every facet at once.
+
+    :param facets: Facets to evaluate.
+    :param sun_altitude: Solar altitude in radians.
+    :param relative_azimuth: Solar azimuth in radians clockwise from the facets' reference direction.
+
+    :return: Cosine of the angle of incidence for each facet, clamped to zero for facets facing away.
+    """
+    sin_altitude = math.sin(sun_altitude)
+    cos_altitude = math.cos(sun_altitude)
+    return [max(0.0, sin_altitude * math.cos(f.tilt) +
+                cos_altitude * math.sin(f.tilt) * math.cos(relative_azimuth - f.azimuth))
+            for f in facets]
+
+
+def get_array_power(array_model: Callable,
+                    race: Race,
+                    distance: float,
+                    time: float,
+                    irradiance: float,
+                    sun_altitude: float,
+                    normalized: bool,
+                    irradiance_raster: Optional[IrradianceRaster] = None) -> float:
+    """
+    Call an array model, passing the sun's azimuth and the car's heading if the model uses them.
+
+    :param irradiance_raster: Raster to take the sun's azimuth from instead of calculating it.
+
+    :return: Array power in watts.
+    """
+    if sun_altitude <= 0.0:
+        return 0.0
+    if getattr(array_model, 'uses_sun_azimuth', False):
+        if irradiance_raster is not None:
+            sun_azimuth = irradiance_raster.azimuth(distance, time)
+        else:
+            lat, lon = race.get_location(distance)
+            _, sun_azimuth = sun.get_sun_position(time, lon, lat)
+        return array_model(irradiance, sun_altitude, normalized,
+                           sun_azimuth=sun_azimuth, heading=race.get_heading(distance))
+    return array_model(irradiance, sun_altitude, normalized)
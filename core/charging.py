@@ -0,0 +1,190 @@
+"""
+Module containing the stationary charging integrator.
+"""
+
+__author__ = "Brett Duncan"
+__email__ = "dunca384@umn.edu"
+
+
+import math
+from typing import Callable, Optional, Tuple
+
+from core.array_model import get_array_power
+from core.car import Car, lookup_values
+from core.functions import charge_current_limit_lookup
+from core.irradiance import IrradianceRaster, get_cloud_factor
+from core.race import Race
+from core.sim_constants import *
+from core.weather import WeatherCursor
+import core.sun as sun
+
+
+STATIONARY_MAX_STEP = 900.0  # <s>
+"""
+Longest macro-step taken while the car is stationary. The array power is
+integrated with Simpson's rule over each macro-step, so this only needs to be
+short compared to how quickly the sun moves across the sky.
+"""
+
+
+def _get_soc_bounds(soc: float) -> Tuple[float, float]:
+    """
+    Find the range of SOC over which the estimated cell voltage does not change.
+
+    Mirrors the search in `Battery.estimate_cell_voltage_from_soc`.
+
+    :param soc: State of Charge (unitless, 0.0-1.0)
+
+    :return: Tuple of the SOC the voltage drops below and the SOC it rises at.
+    """
+    if soc < lookup_values[-1]:
+        return -math.inf, lookup_values[-1]
+
+    index = 0
+    while index < len(lookup_values) and soc < lookup_values[index]:
+        index += 1
+
+    upper = lookup_values[index - 1] if index > 0 else math.inf
+    return lookup_values[index], upper
+
+
+def find_horizon_crossing(start: float, end: float, is_up: Callable[[float], bool]) -> float:
+    """
+    Bisect for the first whole second after `start` where the sun changes sides of the horizon.
+
+    :param start: Time when the sun is on the same side as it was at the beginning of the step.
+    :param end: Time when the sun is on the other side.
+    :param is_up: Function returning whether or not the sun is up at the given time.
+
+    :return: Time of the first whole second on the other side of the horizon.
+    """
+    was_up = is_up(start)
+    while end - start > 1.0:
+        middle = math.floor((start + end) / 2.0)
+        if middle <= start:
+            break
+        if is_up(middle) == was_up:
+            start = middle
+        else:
+            end = middle
+    return end
+
+
+def integrate_stationary(race: Race,
+                         car: Car,
+                         array_model: Callable[[float, float, bool], float],
+                         distance: float,
+                         time: float,
+                         soc: float,
+                         battery_size: float,
+                         battery_esr: float,
+                         grid_charging: bool,
+                         normalized: bool,
+                         end_time: float,
+                         max_step: float = STATIONARY_MAX_STEP,
+                         irradiance_raster: Optional[IrradianceRaster] = None,
+                         weather_cursor: Optional[WeatherCursor] = None) -> Tuple[float, float, float, float]:
+    """
+    Advance a stationary car by one macro-step.
+
+    A macro-step ends at whichever comes first: `end_time`, `max_step`, the sun crossing
+    the horizon, grid charging stopping because the pack is full, or the SOC moving into
+    a different bin of the cell voltage lookup table. Inside a macro-step the pack voltage,
+    the grid charge current tier, and the grid power are constant, so only the array power
+    varies and the net power (after ESR losses) is integrated with Simpson's rule.
+
+    Agrees with stepping `simulate` one second at a time to within 0.1% SOC over a full night
+    (check with `core.diagnostics.dt_convergence(..., stationary_integrator=True)`).
+
+    :param race: The race being simulated.
+    :param car: The car being raced.
+    :param array_model: Function modeling array power given irradiance,
+    solar altitude, and whether the array is normalized.
+    :param distance: Distance along the race route in meters.
+    :param time: Current time in seconds since the unix epoch.
+    :param soc: Current state of charge.
+    :param battery_size: Battery size in Joules.
+    :param battery_esr: Pack equivalent series resistance in ohms.
+    :param grid_charging: Whether or not a grid charge window is open.
+    :param normalized: Whether or not the array is normalized to the sun.
+    :param end_time: Time of the next event, which the step will not pass.
+    :param max_step: Longest macro-step to take in seconds.
+    :param irradiance_raster: Precomputed solar altitude and irradiance along the route.
+    :param weather_cursor: Weather to scale the clear-sky irradiance by the cloud cover of.
+    It isn't used with `irradiance_raster`, which has the cloud cover it was built with.
+
+    :return: Tuple of the step length in seconds, change in battery energy in Joules,
+    grid energy used in Joules, and the array power at the end of the step in watts.
+    """
+    lat, lon = race.get_location(distance)
+
+    def get_altitude(t: float) -> float:
+        if irradiance_raster is not None:
+            return irradiance_raster.altitude(distance, t)
+        altitude, _ = sun.get_sun_position(t, lon, lat)
+        return altitude
+
+    def get_irradiance(t: float, altitude: float) -> float:
+        if irradiance_raster is not None:
+            return irradiance_raster.irradiance(distance, t)
+        if weather_cursor is not None:
+            return sun.get_sun_power(altitude) * get_cloud_factor(weather_cursor.sample(distance, t)[4])
+        return sun.get_sun_power(altitude)
+
+    h = min(max_step, end_time - time)
+    max_h = h
+
+    # Stop at the sun crossing the horizon since that turns the array (and maybe the car) on or off
+    sun_up = get_altitude(time) > 0.0
+    if (get_altitude(time + h) > 0.0) != sun_up:
+        h = find_horizon_crossing(time, time + h,
+                                   lambda t: get_altitude(t) > 0.0) - time
+
+    grid_charging = grid_charging and soc < 1.0
+
+    if not sun_up and not grid_charging:
+        # The car is off so nothing changes
+        return h, 0.0, 0.0, 0.0
+
+    cell_voltage = car.battery.estimate_cell_voltage_from_soc(soc)
+    battery_voltage = cell_voltage * car.battery.cells_in_series
+
+    grid_power = 0.0
+    if grid_charging:
+        dc_grid_current = min((AC_CHARGE_CURRENT * AC_CHARGE_VOLTAGE * car.charger_efficiency) / battery_voltage,
+                              charge_current_limit_lookup(cell_voltage))
+        grid_power = dc_grid_current * battery_voltage
+
+    def get_power(t: float) -> Tuple[float, float]:
+        altitude = get_altitude(t)
+        array_power = get_array_power(array_model, race, distance, t,
+                                      get_irradiance(t, altitude), altitude, normalized, irradiance_raster)
+        battery_power = grid_power + array_power - car.idle_power_loss
+        battery_current = battery_power / battery_voltage
+        return battery_power - battery_current**2 * battery_esr, array_power
+
+    start_power, _ = get_power(time)
+    middle_power, _ = get_power(time + h / 2.0)
+    end_power, array_power = get_power(time + h)
+
+    delta_energy = h * (start_power + 4.0 * middle_power + end_power) / 6.0
+
+    # Stop once the voltage bin changes or the pack fills up
+    lower, upper = _get_soc_bounds(soc)
+    if grid_charging:
+        upper = min(upper, 1.0)
+    lower = max(lower, 0.0)
+
+    energy = soc * battery_size
+    boundary = None
+    if energy + delta_energy >= upper * battery_size:
+        boundary = upper * battery_size
+    elif energy + delta_energy < lower * battery_size:
+        boundary = lower * battery_size
+
+    if boundary is not None and delta_energy != 0.0:
+        h = min(max_h, max(1.0, math.ceil(h * (boundary - energy) / delta_energy)))
+        end_power, array_power = get_power(time + h)
+        delta_energy = h * (start_power + end_power) / 2.0
+
+    return h, delta_energy, grid_power * h, array_power
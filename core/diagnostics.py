@@ -0,0 +1,395 @@
+"""
+Tools for checking the accuracy of the simulation.
+"""
+
+__author__ = "Brett Duncan"
+__email__ = "dunca384@umn.edu"
+
+
+from dataclasses import dataclass
+import math
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from core.car import Car
+from core.objects import State, RaceActions
+from core.race import Race
+from core.simulation import simulate, EULER, RK2
+from core.state_log import StateLog, live_logs
+
+
+@dataclass(frozen=True)
+class ConvergenceResult:
+    """
+    Error of one simulation run against the reference run.
+    """
+    integrator: str
+    dt: float  # <s>
+    result: Any
+    matches_reference: bool  # whether `result` is the same as the reference
+    final_soc_error: float
+    min_soc_error: float
+    distance_error: float  # <m>
+    runtime: float  # <s>
+
+
+def dt_convergence(race: Race,
+                   car: Car,
+                   wind_func: Callable[[float, float], float],
+                   array_model: Callable[[float, float, bool], float],
+                   end_simulation: Callable[[State], Any],
+                   battery_size: float,
+                   state: State,
+                   race_state: RaceActions,
+                   target_speeds: List[Tuple[float, float]],
+                   dts: Tuple[float, ...] = (1.0, 5.0, 10.0, 30.0, 60.0),
+                   integrators: Tuple[str, ...] = (EULER, RK2),
+                   stationary_integrator: bool = False,
+                   verbose: bool = True) -> List[ConvergenceResult]:
+    """
+    Sweep the time step and report the error against a 1 second forward Euler reference run.
+
+    The arguments are passed straight through to `simulate`.
+
+    :param dts: Time steps to try in seconds.
+    :param integrators: Integrators to try at each time step.
+    :param stationary_integrator: Run the sweep (but not the reference) with the
+    stationary integrator.
+    :param verbose: Print a table of the results.
+
+    :return: List containing the error for every integrator and time step.
+    """
+
+    def run(integrator, dt, stationary=False):
+        start = time.perf_counter()
+        result, end_state, logged_states = simulate(race=race,
+                                                    car=car,
+                                                    wind_func=wind_func,
+                                                    array_model=array_model,
+                                                    end_simulation=end_simulation,
+                                                    battery_size=battery_size,
+                                                    state=state,
+                                                    race_state=race_state,
+                                                    target_speeds=target_speeds,
+                                                    dt=dt,
+                                                    stationary_integrator=stationary,
+                                                    integrator=integrator)
+        min_soc = min(s[0].soc for s in logged_states)
+        return result, end_state, min_soc, time.perf_counter() - start
+
+    reference, reference_state, reference_min_soc, _ = run(EULER, 1.0)
+
+    results = []
+    for integrator in integrators:
+        for dt in dts:
+            result, end_state, min_soc, runtime = run(integrator, dt, stationary_integrator)
+            results.append(ConvergenceResult(integrator=integrator,
+                                             dt=dt,
+                                             result=result,
+                                             matches_reference=result == reference,
+                                             final_soc_error=end_state.soc - reference_state.soc,
+                                             min_soc_error=min_soc - reference_min_soc,
+                                             distance_error=end_state.distance - reference_state.distance,
+                                             runtime=runtime))
+
+    if verbose:
+        print('integrator     dt  result  final soc err  min soc err  distance err (m)  runtime (s)')
+        for r in results:
+            print(f'{r.integrator:>10} {r.dt:6.1f}  {str(r.matches_reference):>6}  {r.final_soc_error:13.5f}'
+                  f'  {r.min_soc_error:11.5f}  {r.distance_error:16.1f}  {r.runtime:11.2f}')
+
+    return results
+
+
+def check_dt_convergence(results: List[ConvergenceResult],
+                         final_soc_tolerance: float,
+                         min_soc_tolerance: float,
+                         distance_tolerance: float = math.inf) -> None:
+    """
+    Check the results of `dt_convergence` against error tolerances.
+
+    :param results: Results from `dt_convergence`.
+    :param final_soc_tolerance: Largest allowed final SOC error.
+    :param min_soc_tolerance: Largest allowed minimum SOC error.
+    :param distance_tolerance: Largest allowed distance error in meters.
+
+    :raises RuntimeError: If any run's result differs from the reference or an error is over its tolerance.
+    """
+    failures = [r for r in results
+                if not r.matches_reference
+                or abs(r.final_soc_error) > final_soc_tolerance
+                or abs(r.min_soc_error) > min_soc_tolerance
+                or abs(r.distance_error) > distance_tolerance]
+    if failures:
+        raise RuntimeError('Runs that didn\'t converge to the reference:\n' + '\n'.join(map(str, failures)))
+
+
+@dataclass(frozen=True)
+class StepAllocations:
+    """
+    Python allocations made by `simulate` over a window of steps.
+    """
+    steps: int
+    retained_blocks: int  # blocks allocated during the window that are still alive at the end
+    retained_bytes: int
+    transient_bytes: int  # how far traced memory peaked above where it ended
+    top: List[str]  # where the retained blocks were allocated
+
+    @property
+    def blocks_per_step(self) -> float:
+        return self.retained_blocks / self.steps if self.steps else 0.0
+
+
+class _AllocationWindow:
+    """
+    End condition that traces allocations between two times and then ends the simulation.
+    """
+
+    def __init__(self, end_simulation: Callable[[State], Any], start_time: float, end_time: float):
+        self.end_simulation = end_simulation
+        self.start_time = start_time
+        self.end_time = end_time
+        self.steps = 0.0  # a float so counting doesn't allocate ints
+        self.tracing = False
+        self.first: Optional[tracemalloc.Snapshot] = None
+        self.last: Optional[tracemalloc.Snapshot] = None
+        self.memory = (0, 0)
+
+    def __call__(self, state: State) -> Any:
+        if self.tracing:
+            if state.time >= self.end_time:
+                self.memory = tracemalloc.get_traced_memory()
+                self.last = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                self.tracing = False
+                return False
+            self.steps += 1.0
+        elif self.first is None and state.time >= self.start_time:
+            tracemalloc.start()
+            self.first = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            self.tracing = True
+        return self.end_simulation(state)
+
+
+def measure_step_allocations(race: Race,
+                             car: Car,
+                             wind_func: Callable[[float, float], float],
+                             array_model: Callable[[float, float, bool], float],
+                             end_simulation: Callable[[State], Any],
+                             battery_size: float,
+                             state: State,
+                             race_state: RaceActions,
+                             target_speeds: List[Tuple[float, float]],
+                             start: float = 3600.0,
+                             duration: float = 1000.0,
+                             dt: float = 1.0,
+                             verbose: bool = True) -> StepAllocations:
+    """
+    Trace the Python allocations `simulate` makes over a window of steady-state steps.
+
+    The simulation runs untraced until `start` seconds after `state.time`, is traced with
+    `tracemalloc` for `duration` seconds, and then ends. The log has room for every step
+    allocated up front so that only allocations made by the steps themselves are counted.
+    A steady-state step shouldn't allocate anything, so both counts should only be the
+    few bytes of a float or two that CPython couldn't take from its free list at the edges
+    of the window, and shouldn't grow with `duration`.
+
+    The other arguments are passed straight through to `simulate`.
+
+    :param start: Time after the start of the simulation to start tracing in seconds.
+    :param duration: Time to trace for in seconds.
+    :param dt: Time step in seconds.
+    :param verbose: Print the result and where the retained blocks were allocated.
+
+    :return: StepAllocations for the window.
+    """
+    window = _AllocationWindow(end_simulation, state.time + start, state.time + start + duration)
+
+    try:
+        simulate(race=race,
+                 car=car,
+                 wind_func=wind_func,
+                 array_model=array_model,
+                 end_simulation=window,
+                 battery_size=battery_size,
+                 state=state,
+                 race_state=race_state,
+                 target_speeds=target_speeds,
+                 dt=dt,
+                 log=StateLog(capacity=int((start + duration) / dt) + 2))
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    if window.first is None or window.last is None:
+        raise ValueError('The simulation ended before the end of the window')
+
+    # Leave out the snapshots themselves
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    diffs = [d for d in window.last.filter_traces(filters).compare_to(window.first.filter_traces(filters), 'lineno')
+             if d.count_diff > 0]
+
+    current, peak = window.memory
+    allocations = StepAllocations(steps=int(window.steps),
+                                  retained_blocks=sum(d.count_diff for d in diffs),
+                                  retained_bytes=sum(d.size_diff for d in diffs),
+                                  transient_bytes=peak - current,
+                                  top=[str(d) for d in diffs[:10]])
+
+    if verbose:
+        print(f'{allocations.steps} steps: {allocations.retained_blocks} blocks '
+              f'({allocations.retained_bytes} bytes) retained, {allocations.transient_bytes} bytes transient')
+        for line in allocations.top:
+            print(f'  {line}')
+
+    return allocations
+
+
+def check_step_allocations(race: Race,
+                           car: Car,
+                           wind_func: Callable[[float, float], float],
+                           array_model: Callable[[float, float, bool], float],
+                           end_simulation: Callable[[State], Any],
+                           battery_size: float,
+                           state: State,
+                           race_state: RaceActions,
+                           target_speeds: List[Tuple[float, float]],
+                           start: float = 3600.0,
+                           duration: float = 1000.0,
+                           dt: float = 1.0,
+                           max_retained_blocks: int = 8) -> StepAllocations:
+    """
+    Check that steady-state steps don't allocate.
+
+    `measure_step_allocations` traces a window of `duration` seconds and one four times
+    as long, and both have to retain at most `max_retained_blocks` blocks. A step that
+    allocates even once every few hundred steps retains more than that in the longer window.
+
+    :param max_retained_blocks: Most blocks either window may retain.
+
+    :raises RuntimeError: If either window retained more than `max_retained_blocks` blocks.
+
+    :return: StepAllocations for the longer window.
+    """
+    allocations = None
+    for window in (duration, 4.0 * duration):
+        allocations = measure_step_allocations(race, car, wind_func, array_model, end_simulation, battery_size,
+                                               state, race_state, target_speeds, start=start, duration=window,
+                                               dt=dt, verbose=False)
+        if allocations.retained_blocks > max_retained_blocks:
+            raise RuntimeError(f'{allocations.steps} steps retained {allocations.retained_blocks} blocks '
+                               f'(at most {max_retained_blocks} allowed):\n' + '\n'.join(allocations.top))
+    return allocations
+
+
+@dataclass(frozen=True)
+class MemoryReport:
+    """
+    Memory used by the simulation logs in this process.
+    """
+    live_logs: int  # StateLogs that haven't been garbage collected
+    rows: int  # rows across the live logs
+    log_bytes: int  # bytes of rows the live logs hold in memory
+    spilled_bytes: int  # bytes of rows the live logs have spilled to disk
+    peak_log_bytes: int  # most bytes any one live log has held in memory
+    peak_process_bytes: Optional[int]  # traced peak while tracemalloc runs, otherwise peak RSS
+
+    @property
+    def bytes_per_row(self) -> float:
+        return (self.log_bytes + self.spilled_bytes) / self.rows if self.rows else 0.0
+
+    def __str__(self) -> str:
+        peak = 'unknown' if self.peak_process_bytes is None else f'{self.peak_process_bytes / 2 ** 20:.1f} MiB'
+        return (f'{self.live_logs} live log(s), {self.rows} rows, {self.log_bytes / 2 ** 20:.1f} MiB in memory, '
+                f'{self.spilled_bytes / 2 ** 20:.1f} MiB spilled, {self.bytes_per_row:.1f} bytes/row, '
+                f'peak log {self.peak_log_bytes / 2 ** 20:.1f} MiB, peak process {peak}')
+
+
+def _peak_process_bytes() -> Optional[int]:
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[1]
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # kilobytes everywhere but macOS
+
+
+def memory_report() -> MemoryReport:
+    """
+    Measure the simulation logs alive in this process and its peak memory use.
+
+    Logs returned by `simulate` count until they're garbage collected, so a growing
+    number of live logs in a long sweep means results are holding on to them.
+
+    :return: MemoryReport for this process.
+    """
+    logs = live_logs()
+    return MemoryReport(live_logs=len(logs),
+                        rows=sum(len(log) for log in logs),
+                        log_bytes=sum(log.size_in_bytes for log in logs),
+                        spilled_bytes=sum(log.spilled_bytes for log in logs),
+                        peak_log_bytes=max((log.peak_bytes for log in logs), default=0),
+                        peak_process_bytes=_peak_process_bytes())
+
+
+@dataclass(frozen=True)
+class LogStats:
+    """
+    Memory one simulation's log used, recorded before the log is dropped so that it can
+    be sent back from a worker process.
+    """
+    rows: int
+    peak_bytes: int  # most bytes the log held in memory
+    spilled_bytes: int
+    stride: int  # steps per logged row at the end
+    process_peak_bytes: Optional[int]  # peak memory of the process that ran the simulation
+
+    @staticmethod
+    def of(log: StateLog) -> 'LogStats':
+        return LogStats(rows=len(log),
+                        peak_bytes=log.peak_bytes,
+                        spilled_bytes=log.spilled_bytes,
+                        stride=log.stride,
+                        process_peak_bytes=_peak_process_bytes())
+
+
+@dataclass
+class LogUsage:
+    """
+    Aggregate of the LogStats of many simulations, wherever they ran.
+    """
+    runs: int = 0
+    rows: int = 0
+    bytes: int = 0  # sum of the peak in-memory and spilled bytes of every log
+    peak_bytes: int = 0  # most bytes any one log held in memory
+    spilled_bytes: int = 0
+    max_stride: int = 1
+    process_peak_bytes: Optional[int] = None  # largest peak of any process that ran a simulation
+
+    @property
+    def bytes_per_row(self) -> float:
+        return self.bytes / self.rows if self.rows else 0.0
+
+    def add(self, stats: LogStats) -> None:
+        self.runs += 1
+        self.rows += stats.rows
+        self.bytes += stats.peak_bytes + stats.spilled_bytes
+        self.peak_bytes = max(self.peak_bytes, stats.peak_bytes)
+        self.spilled_bytes += stats.spilled_bytes
+        self.max_stride = max(self.max_stride, stats.stride)
+        if stats.process_peak_bytes is not None:
+            self.process_peak_bytes = max(self.process_peak_bytes or 0, stats.process_peak_bytes)
+
+    def __str__(self) -> str:
+        peak = 'unknown' if self.process_peak_bytes is None else f'{self.process_peak_bytes / 2 ** 20:.1f} MiB'
+        return (f'{self.runs} log(s), {self.rows} rows, {self.bytes_per_row:.1f} bytes/row, '
+                f'largest log {self.peak_bytes / 2 ** 20:.1f} MiB, {self.spilled_bytes / 2 ** 20:.1f} MiB spilled, '
+                f'stride up to {self.max_stride}, peak process {peak}')
@@ -0,0 +1,157 @@
+"""
+Module containing the precomputed drive power lookup table.
+"""
+
+__author__ = "Brett Duncan"
+__email__ = "dunca384@umn.edu"
+
+
+from array import array
+from functools import lru_cache
+import math
+from typing import Tuple
+
+from core.car import Car
+from core.physics import calculate_power_to_drive
+import core.earth as earth
+
+
+class DrivePowerTable:
+    """
+    Power to drive a car precomputed over vehicle speed, wind speed, road angle, and air
+    density, and looked up with linear interpolation.
+
+    The power at the wheels separates into `speed * grade_force(angle)` plus
+    `rho * aero(speed, wind)`, so the table is stored as a 1D grade force table and a
+    2D aero table per unit air density. Air density is exact and the motor and powertrain
+    efficiencies are applied at lookup, leaving the interpolation error in speed, wind,
+    and angle. `error_bound` bounds that error anywhere on the grid for air on `rho_range`
+    from the second derivatives (linear interpolation is off by at most step**2 / 8 times
+    the largest second derivative along each axis). It's about 1 W for a 410 kg car with
+    the default grid. Speeds, winds, and angles on the grid's nodes are exact. Lookups
+    outside of the grid fall back to `calculate_power_to_drive`.
+    """
+
+    def __init__(self,
+                 car: Car,
+                 speeds: Tuple[float, float, float] = (0.0, 40.0, 0.25),
+                 wind_speeds: Tuple[float, float, float] = (-20.0, 20.0, 0.5),
+                 angles: Tuple[float, float, float] = (-0.15, 0.15, 0.005),
+                 rho_range: Tuple[float, float] = (0.9, 1.4)):
+        """
+        :param car: Car to build the table for.
+        :param speeds: (min, max, step) of the vehicle speed axis in m/s.
+        :param wind_speeds: (min, max, step) of the wind speed axis in m/s.
+        :param angles: (min, max, step) of the road angle axis in radians.
+        :param rho_range: (min, max) air density in kg/m/m/m the table is used for.
+        """
+        self.car = car
+        self.speed_min, self.speed_step, self.speed_count = self._make_axis(*speeds)
+        self.wind_min, self.wind_step, self.wind_count = self._make_axis(*wind_speeds)
+        self.angle_min, self.angle_step, self.angle_count = self._make_axis(*angles)
+        self.rho_min, self.rho_max = rho_range
+
+        self.grade_force = array('d', (self._calculate_grade_force(self.angle_min + i * self.angle_step)
+                                       for i in range(self.angle_count)))  # <N>
+
+        # Aero power per unit air density, indexed [speed][wind]
+        self.aero = array('d', (self._calculate_aero(self.speed_min + i * self.speed_step,
+                                                     self.wind_min + j * self.wind_step)
+                                for i in range(self.speed_count)
+                                for j in range(self.wind_count)))
+
+        max_speed = self.speed_min + (self.speed_count - 1) * self.speed_step
+        max_wind = self.wind_min + (self.wind_count - 1) * self.wind_step
+        max_angle = self.angle_min + (self.angle_count - 1) * self.angle_step
+        largest_speed = max(abs(self.speed_min), abs(max_speed))
+
+        # Bilinear interpolation of aero is off by at most the sum of the linear errors along
+        # each axis. d2/dv2 = cda * (3v - 2w) is linear, so it's largest at a corner, and
+        # d2/dw2 = cda * v.
+        aero_v = 0.5 * car.cda * max(abs(6.0 * v - 4.0 * w) for v in (self.speed_min, max_speed)
+                                     for w in (self.wind_min, max_wind))
+        aero_w = car.cda * largest_speed
+        aero_error = (self.speed_step**2 * aero_v + self.wind_step**2 * aero_w) / 8.0
+
+        # d2/da2 of the grade force is minus the grade force, largest at the steepest angle
+        grade_error = self.angle_step**2 / 8.0 * max(abs(self._calculate_grade_force(a))
+                                                      for a in (self.angle_min, max_angle))
+
+        # Worst case at the wheels, then through the lower (low SOC) motor efficiency
+        self.error_bound = (self.rho_max * aero_error + largest_speed * grade_error) \
+            / (0.8 * car.powertrain_efficiency)  # <W>
+
+    @staticmethod
+    @lru_cache(maxsize=32)
+    def for_car(car: Car) -> 'DrivePowerTable':
+        """
+        Get the table for a car, building it the first time the car is seen in this process.
+
+        :param car: Car to get the table for.
+
+        :return: DrivePowerTable for the car.
+        """
+        return DrivePowerTable(car)
+
+    @staticmethod
+    def _make_axis(low: float, high: float, step: float) -> Tuple[float, float, int]:
+        return low, step, int(round((high - low) / step)) + 1
+
+    def _calculate_grade_force(self, angle: float) -> float:
+        # Same terms as `calculate_power_to_drive`
+        return earth.GRAVITY * self.car.mass * (math.sin(angle) + self.car.crr * math.cos(angle))
+
+    def _calculate_aero(self, vehicle_speed: float, wind_speed: float) -> float:
+        return 0.5 * self.car.cda * (vehicle_speed - wind_speed)**2 * vehicle_speed
+
+    def _interpolate_grade_force(self, angle: float) -> float:
+        x = (angle - self.angle_min) / self.angle_step
+        if x < 0.0 or x > self.angle_count - 1:
+            return math.nan
+        i = min(int(x), self.angle_count - 2)
+        f = x - i
+        return self.grade_force[i] + f * (self.grade_force[i + 1] - self.grade_force[i])
+
+    def _interpolate_aero(self, vehicle_speed: float, wind_speed: float) -> float:
+        x = (vehicle_speed - self.speed_min) / self.speed_step
+        y = (wind_speed - self.wind_min) / self.wind_step
+        if x < 0.0 or y < 0.0 or x > self.speed_count - 1 or y > self.wind_count - 1:
+            return math.nan
+        i = min(int(x), self.speed_count - 2)
+        j = min(int(y), self.wind_count - 2)
+        fx = x - i
+        fy = y - j
+
+        aero = self.aero
+        index = i * self.wind_count + j
+        low = aero[index] + fy * (aero[index + 1] - aero[index])
+        index += self.wind_count
+        high = aero[index] + fy * (aero[index + 1] - aero[index])
+        return low + fx * (high - low)
+
+    def __call__(self,
+                 vehicle_speed: float,
+                 angle: float = 0.0,
+                 wind_speed: float = 0.0,
+                 rho: float = 1.2922,
+                 soc: float = 1.0) -> float:
+        """
+        Look up the car's power to drive. Takes the same arguments as
+        `calculate_power_to_drive` (minus the car and acceleration).
+
+        :param vehicle_speed: Vehicle speed in m/s.
+        :param angle: Angle of the road in radians.
+        :param wind_speed: Wind speed in the direction of travel in m/s.
+        :param rho: Density of air in kg/m/m/m
+        :param soc: State of charge (unitless, 0.0-1.0)
+
+        :return: Returns the power required to drive the car in watts.
+        """
+        power = vehicle_speed * self._interpolate_grade_force(angle) \
+            + rho * self._interpolate_aero(vehicle_speed, wind_speed)
+        if math.isnan(power) or not self.rho_min <= rho <= self.rho_max:
+            return calculate_power_to_drive(self.car, vehicle_speed, angle=angle,
+                                            wind_speed=wind_speed, rho=rho, soc=soc)
+
+        motor_efficiency = 0.95 if soc > 0.2 else 0.8
+        return power / (motor_efficiency * self.car.powertrain_efficiency)
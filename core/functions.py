@@ -6,6 +6,7 @@ __author__ = "Brett Duncan"
 __email__ = "dunca384@umn.edu"
 
 
+import math
 from typing import List, Tuple
 
 
@@ -28,8 +29,8 @@ def get_target_speed(target_speeds: List[Tuple[float, float]], distance: float)
     """
     Calculates the target speed given a list of target speed tuples and current distance.
 
-    :param target_speeds: List of tuples containing target speeds and the distance
-    that target speed starts at.
+    :param target_speeds: List of tuples containing the distance each target speed
+    starts at and the target speed, in order of increasing distance.
 
     :return: Target speed at the current distance along the route.
     """
@@ -37,7 +38,24 @@ def get_target_speed(target_speeds: List[Tuple[float, float]], distance: float)
     if distance >= target_speeds[-1][0]:
         return target_speeds[-1][1]
 
+    # Use the last target speed that starts at or before the current distance
     index = 0
-    while distance < target_speeds[index][0]:
+    while index + 1 < len(target_speeds) and distance >= target_speeds[index + 1][0]:
         index += 1
     return target_speeds[index][1]
+
+
+def get_next_speed_change(target_speeds: List[Tuple[float, float]], speed_limits: List, distance: float) -> float:
+    """
+    Find the next distance along the route where the target speed or speed limit changes.
+
+    :param target_speeds: List of tuples containing target speeds and the distance
+    that target speed starts at.
+    :param speed_limits: List of SpeedLimit events.
+    :param distance: Current distance along the race route in meters.
+
+    :return: Distance in meters of the next change, or infinity if there isn't one.
+    """
+    upcoming = [d for d, _ in target_speeds if d > distance]
+    upcoming.extend(limit.distance for limit in speed_limits if limit.distance > distance)
+    return min(upcoming, default=math.inf)
@@ -0,0 +1,260 @@
+"""
+Module containing the precomputed irradiance raster.
+
+The raster holds the solar altitude, irradiance, and azimuth on a uniform grid of
+distance along the race route by time, stored in a binary file that is memory-mapped so worker
+processes share one read-only copy through the page cache:
+
+    magic           4 bytes   b'SCIR'
+    version         uint32
+    n_distance      uint32
+    n_time          uint32
+    distance_start  float64   <m>
+    distance_step   float64   <m>
+    time_start      float64   <s since unix epoch>
+    time_step       float64   <s>
+    altitude        float64[n_distance * n_time]  <rad>
+    irradiance      float64[n_distance * n_time]  <watt/m/m>
+    azimuth_sin     float64[n_distance * n_time]  sine of the solar azimuth
+    azimuth_cos     float64[n_distance * n_time]  cosine of the solar azimuth
+
+Every plane is row-major with distance as the outer index. All values are little-endian.
+The azimuth is stored as its sine and cosine so that interpolating it doesn't break
+where it wraps around.
+"""
+
+__author__ = "Brett Duncan"
+__email__ = "dunca384@umn.edu"
+
+
+from array import array
+import math
+import mmap
+import struct
+import sys
+from typing import Optional
+
+from core.race import Race
+import core.sun as sun
+from core.weather import GriddedWeather
+
+
+MAGIC = b'SCIR'
+VERSION = 2
+HEADER = struct.Struct('<4sIIIdddd')
+
+
+def get_cloud_factor(cloud_cover: float) -> float:
+    """
+    Fraction of clear-sky irradiance that reaches the ground under cloud cover.
+
+    Kasten and Czeplak (1980).
+
+    :param cloud_cover: Fraction of the sky covered by cloud [0.0, 1.0].
+
+    :return: Irradiance scale factor.
+    """
+    return 1.0 - 0.75 * math.pow(cloud_cover, 3.4)
+
+
+def build_irradiance_raster(race: Race,
+                            file_path: str,
+                            distance_step: float = 10000.0,
+                            time_step: float = 300.0,
+                            start_time: Optional[float] = None,
+                            end_time: Optional[float] = None,
+                            weather: Optional[GriddedWeather] = None) -> 'IrradianceRaster':
+    """
+    Build the irradiance raster for a race and write it to a file.
+
+    The parts of the sun's position that only depend on time (declination, right
+    ascension, and sidereal time) are calculated once per time bin and shared by every
+    location along the route, and locations that repeat along the route are only
+    evaluated once.
+
+    :param race: Race to build the raster for.
+    :param file_path: Path of the file to write.
+    :param distance_step: Size of the distance bins in meters.
+    :param time_step: Size of the time bins in seconds.
+    :param start_time: First time in the raster (defaults to the first time event).
+    :param end_time: Last time in the raster (defaults to the last time event).
+    :param weather: Optional weather grid whose cloud cover scales the clear-sky irradiance.
+
+    :return: IrradianceRaster mapping the new file.
+    """
+    if start_time is None:
+        start_time = race.time_events[0].time
+    if end_time is None:
+        end_time = race.time_events[-1].time
+
+    length = race.distance_events[-1].distance
+    n_distance = int(math.ceil(length / distance_step)) + 1
+    n_time = int(math.ceil((end_time - start_time) / time_step)) + 1
+
+    # Index every distance bin into the list of distinct locations along the route
+    locations = []
+    location_index = []
+    for i in range(n_distance):
+        location = race.get_location(i * distance_step)
+        if location not in locations:
+            locations.append(location)
+        location_index.append(locations.index(location))
+
+    # (sin(phi), cos(phi), west longitude) for each location
+    observers = [(math.sin(math.radians(lat)), math.cos(math.radians(lat)), -math.radians(lon))
+                 for lat, lon in locations]
+
+    # altitude[location][time], and the same for the sine and cosine of the azimuth
+    altitudes = [array('d', bytes(8 * n_time)) for _ in locations]
+    azimuth_sins = [array('d', bytes(8 * n_time)) for _ in locations]
+    azimuth_coss = [array('d', bytes(8 * n_time)) for _ in locations]
+    for k in range(n_time):
+        j = sun.date_to_julian_date(start_time + k * time_step)
+        m = sun.get_solar_mean_anomaly(j)
+        lsun = sun.get_ecliptic_longitude(m, sun.get_equation_of_center(m))
+        d = sun.get_sun_declination(lsun)
+        a = sun.get_right_ascension(lsun)
+        sidereal = sun.get_sidereal_time(j, 0.0)
+        sin_d, cos_d, tan_d = math.sin(d), math.cos(d), math.tan(d)
+
+        for altitude, azimuth_sin, azimuth_cos, (sin_phi, cos_phi, lw) in zip(altitudes, azimuth_sins, azimuth_coss,
+                                                                              observers):
+            h = sidereal - lw - a
+            cos_h = math.cos(h)
+            altitude[k] = math.asin(sin_phi * sin_d + cos_phi * cos_d * cos_h)
+            # Same azimuth as `sun.get_azimuth`, without the atan2
+            y, x = math.sin(h), cos_h * sin_phi - tan_d * cos_phi
+            r = math.hypot(x, y)
+            azimuth_sin[k], azimuth_cos[k] = (y / r, x / r) if r > 0.0 else (0.0, 1.0)
+
+    irradiances = [array('d', (sun.get_sun_power(alt) if alt > 0.0 else 0.0 for alt in altitude))
+                   for altitude in altitudes]
+
+    cursor = weather.cursor(race) if weather is not None else None
+
+    with open(file_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, n_distance, n_time,
+                            0.0, distance_step, start_time, time_step))
+
+        for i in range(n_distance):
+            _write_doubles(f, altitudes[location_index[i]])
+
+        for i in range(n_distance):
+            row = irradiances[location_index[i]]
+            if cursor is not None:
+                row = array('d', (value * get_cloud_factor(cursor.sample(i * distance_step,
+                                                                          start_time + k * time_step)[4])
+                                  for k, value in enumerate(row)))
+            _write_doubles(f, row)
+
+        for plane in (azimuth_sins, azimuth_coss):
+            for i in range(n_distance):
+                _write_doubles(f, plane[location_index[i]])
+
+    return IrradianceRaster(file_path)
+
+
+def _write_doubles(f, values: array) -> None:
+    if sys.byteorder != 'little':
+        values = array('d', values)
+        values.byteswap()
+    values.tofile(f)
+
+
+class IrradianceRaster:
+    """
+    Memory-mapped solar altitude and irradiance along a race route.
+
+    Pickling a raster only sends the file path, so it can be handed to worker
+    processes which map the same file. A raster can also be read straight out of
+    any buffer holding the file's contents (like shared memory) with `from_buffer`.
+    """
+
+    def __init__(self, file_path: Optional[str], buffer=None):
+        """
+        :param file_path: Path of the raster file to map.
+        :param buffer: Buffer to read the raster from instead of mapping a file.
+        """
+        self.file_path = file_path
+
+        if buffer is None:
+            with open(file_path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            buffer = self._mmap
+
+        magic, version, self.n_distance, self.n_time, self.distance_start, self.distance_step, \
+            self.time_start, self.time_step = HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{file_path or "buffer"} is not a version {VERSION} irradiance raster.')
+        if sys.byteorder != 'little':
+            raise NotImplementedError('Irradiance rasters are only mapped on little-endian machines.')
+
+        size = self.n_distance * self.n_time
+        self._buffer = memoryview(buffer).cast('B')[:HEADER.size + 32 * size]
+        doubles = self._buffer[HEADER.size:].cast('d')
+        self.altitudes = doubles[:size]
+        self.irradiances = doubles[size:2 * size]
+        self.azimuth_sins = doubles[2 * size:3 * size]
+        self.azimuth_coss = doubles[3 * size:]
+
+    @staticmethod
+    def from_buffer(buffer) -> 'IrradianceRaster':
+        """
+        Read a raster from a buffer holding the contents of a raster file without copying it.
+        """
+        return IrradianceRaster(None, buffer=buffer)
+
+    @property
+    def buffer(self) -> memoryview:
+        """
+        :return: Read-only view of the raster in the file format.
+        """
+        return self._buffer.toreadonly()
+
+    def __reduce__(self):
+        if self.file_path is None:
+            raise TypeError('Only rasters mapped from a file can be pickled.')
+        return IrradianceRaster, (self.file_path,)
+
+    def _interpolate(self, plane: memoryview, distance: float, time: float) -> float:
+        x = min(max((distance - self.distance_start) / self.distance_step, 0.0), self.n_distance - 1)
+        y = min(max((time - self.time_start) / self.time_step, 0.0), self.n_time - 1)
+        i = min(int(x), self.n_distance - 2) if self.n_distance > 1 else 0
+        k = min(int(y), self.n_time - 2) if self.n_time > 1 else 0
+        fx, fy = x - i, y - k
+
+        a = i * self.n_time + k
+        b = a + self.n_time if self.n_distance > 1 else a
+        dk = 1 if self.n_time > 1 else 0
+
+        return (1.0 - fx) * ((1.0 - fy) * plane[a] + fy * plane[a + dk]) + \
+            fx * ((1.0 - fy) * plane[b] + fy * plane[b + dk])
+
+    def altitude(self, distance: float, time: float) -> float:
+        """
+        Solar altitude in radians, bilinearly interpolated.
+
+        :param distance: Distance along the race route in meters.
+        :param time: Time in seconds since the unix epoch.
+        """
+        return self._interpolate(self.altitudes, distance, time)
+
+    def irradiance(self, distance: float, time: float) -> float:
+        """
+        Irradiance in watts/meter/meter, bilinearly interpolated.
+
+        :param distance: Distance along the race route in meters.
+        :param time: Time in seconds since the unix epoch.
+        """
+        return self._interpolate(self.irradiances, distance, time)
+
+    def azimuth(self, distance: float, time: float) -> float:
+        """
+        Solar azimuth in radians, the same angle `sun.get_sun_position` gives, interpolated
+        through its sine and cosine.
+
+        :param distance: Distance along the race route in meters.
+        :param time: Time in seconds since the unix epoch.
+        """
+        return math.atan2(self._interpolate(self.azimuth_sins, distance, time),
+                          self._interpolate(self.azimuth_coss, distance, time))
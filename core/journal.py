@@ -0,0 +1,238 @@
+"""
+On-disk work journal for resuming long sweeps.
+
+The journal is an append-only file of records, each a pickled tuple behind its length
+and CRC32:
+
+    ('header', fingerprint)   written once when the journal is created
+    ('start', key)            a task was handed to a worker
+    ('done', key, result)     a task finished
+
+Records are buffered and written in batches with one write and one fsync, so a crash
+loses at most the last unwritten batch of results (which are then simply run again).
+Start records are flushed before their tasks are dispatched, so a task that was started
+but never finished in an earlier run is known to have been in flight when that run
+died. `run_journaled` dispatches tasks in half-window batches so that those flushes are
+shared by many tasks too. A torn record at the end of the file is cut off when the journal is reopened.
+"""
+
+__author__ = "Brett Duncan"
+__email__ = "dunca384@umn.edu"
+
+
+from concurrent.futures import Executor, FIRST_COMPLETED, wait
+import os
+import pickle
+import struct
+import time
+import zlib
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Set, Tuple
+
+
+RECORD = struct.Struct('<II')  # payload length, CRC32 of the payload
+
+
+class Journal:
+    """
+    Journal of the tasks in a sweep.
+
+    `completed` holds the result of every task finished in this or an earlier run,
+    `attempts` counts how many times each unfinished task has been started, and
+    `crashed` holds the tasks that an earlier run started but never finished.
+    """
+
+    def __init__(self, file_path: str, fingerprint: Any = None, batch_size: int = 256, flush_interval: float = 1.0):
+        """
+        Open a journal, creating it if it doesn't exist.
+
+        :param file_path: Path of the journal file.
+        :param fingerprint: Picklable description of the sweep. Reopening a journal with a
+        different fingerprint raises a ValueError instead of mixing results of two sweeps.
+        :param batch_size: Number of buffered records that triggers a write.
+        :param flush_interval: Longest time to keep records buffered in seconds.
+        """
+        self.file_path = file_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.completed: Dict[Hashable, Any] = {}
+        self.attempts: Dict[Hashable, int] = {}
+        self.crashed: Set[Hashable] = set()
+
+        self._buffer = bytearray()
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+        self.syncs = 0  # number of fsyncs, to check that writes are batched
+
+        header = None
+        valid_length = 0
+        if os.path.exists(file_path):
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            for record, end in self._records(data):
+                valid_length = end
+                if record[0] == 'header':
+                    header = record
+                elif record[0] == 'start':
+                    self.attempts[record[1]] = self.attempts.get(record[1], 0) + 1
+                elif record[0] == 'done':
+                    self.completed[record[1]] = record[2]
+                    self.attempts.pop(record[1], None)
+            self.crashed = set(self.attempts)
+
+            if header is not None and header[1] != fingerprint:
+                raise ValueError(f'{file_path} is the journal of a different sweep ({header[1]!r})')
+
+        self._file = open(file_path, 'ab')
+        if valid_length != self._file.tell():
+            # cut off a record that was only partly written when the last run died
+            self._file.truncate(valid_length)
+            self._file.seek(valid_length)
+        if header is None:
+            self._append(('header', fingerprint))
+            self.flush()
+
+    @staticmethod
+    def _records(data: bytes) -> Iterator[Tuple[Tuple, int]]:
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            length, crc = RECORD.unpack_from(data, offset)
+            start, end = offset + RECORD.size, offset + RECORD.size + length
+            if end > len(data) or zlib.crc32(data[start:end]) != crc:
+                return
+            yield pickle.loads(data[start:end]), end
+            offset = end
+
+    def _append(self, record: Tuple) -> None:
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        self._buffer += RECORD.pack(len(payload), zlib.crc32(payload))
+        self._buffer += payload
+        self._buffered += 1
+
+    def start(self, keys: Iterable[Hashable]) -> None:
+        """
+        Record that tasks are about to be dispatched. Call `flush` before dispatching them
+        so they can be detected if the run dies.
+        """
+        for key in keys:
+            self.attempts[key] = self.attempts.get(key, 0) + 1
+            self._append(('start', key))
+
+    def finish(self, key: Hashable, result: Any) -> None:
+        """
+        Record the result of a task. It's written with the next batch.
+        """
+        self.completed[key] = result
+        self.attempts.pop(key, None)
+        self._append(('done', key, result))
+        if self._buffered >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the buffered records and wait for them to reach the disk.
+        """
+        if self._buffer:
+            self._file.write(self._buffer)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.syncs += 1
+            self._buffer.clear()
+            self._buffered = 0
+        self._last_flush = time.monotonic()
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self) -> 'Journal':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def run_journaled(journal: Journal,
+                  executor: Executor,
+                  function: Callable[[Tuple], Any],
+                  tasks: Iterable[Tuple[Hashable, Tuple]],
+                  window: int = 256,
+                  max_attempts: int = 3,
+                  verbose: bool = True) -> Iterator[Tuple[Hashable, Any]]:
+    """
+    Run tasks in an executor, skipping the ones the journal already has results for.
+
+    At most `window` tasks are in flight at a time. The window is only topped up once half
+    of it has finished, so the start records of half a window share one fsync. Tasks that
+    were started `max_attempts` times without finishing (they keep killing the run) are
+    skipped.
+
+    :param journal: Journal of the sweep.
+    :param executor: Executor to run the tasks in.
+    :param function: Module-level function called with each task's arguments tuple.
+    :param tasks: Iterable of (key, arguments) pairs with unique, picklable keys.
+    :param window: Most tasks to have in flight at once.
+    :param max_attempts: Number of starts without a finish before a task is skipped.
+    :param verbose: Print the crashed and skipped tasks, and the fsyncs per task at the end.
+
+    :return: Iterator of (key, result) pairs, in the order the tasks finish. Results
+    from the journal come first.
+    """
+    if verbose and journal.crashed:
+        print(f'{len(journal.crashed)} task(s) were running when the last run died: '
+              f'{sorted(journal.crashed, key=repr)[:10]}')
+
+    seen = set()
+    for key, result in list(journal.completed.items()):
+        seen.add(key)
+        yield key, result
+
+    pending = {}
+    tasks = iter(tasks)
+    exhausted = False
+    dispatched = 0
+    syncs = journal.syncs
+
+    try:
+        while pending or not exhausted:
+            # Top up the window once it's half empty, recording the starts before anything is dispatched
+            batch: List[Tuple[Hashable, Tuple]] = []
+            while not exhausted and len(pending) <= window // 2 and len(pending) + len(batch) < window:
+                try:
+                    key, args = next(tasks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if key in seen:
+                    continue
+                seen.add(key)
+                if journal.attempts.get(key, 0) >= max_attempts:
+                    if verbose:
+                        print(f'Skipping {key!r}, it was started {journal.attempts[key]} times without finishing.')
+                    continue
+                batch.append((key, args))
+
+            if batch:
+                journal.start(key for key, _ in batch)
+                journal.flush()
+                for key, args in batch:
+                    pending[executor.submit(function, args)] = key
+                dispatched += len(batch)
+
+            if not pending:
+                continue
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = pending.pop(future)
+                result = future.result()
+                journal.finish(key, result)
+                yield key, result
+    finally:
+        for future in pending:
+            future.cancel()
+        journal.flush()
+        if verbose and dispatched:
+            print(f'{journal.syncs - syncs} journal fsyncs for {dispatched} tasks '
+                  f'({(journal.syncs - syncs) / dispatched:.3f} per task)')
@@ -6,10 +6,22 @@ __author__ = "Brett Duncan"
 __email__ = "dunca384@umn.edu"
 
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import math
 
 
-@dataclass
+CLOCK_RUNNING = 1
+CHARGING = 2
+DRIVING = 4
+NORMALIZED = 8
+GRID_CHARGING = 16
+RACE_HOURS = 32
+"""
+Bits of `RaceActions.mode`.
+"""
+
+
+@dataclass(slots=True)
 class State:
     """
     State of the race + car.
@@ -20,10 +32,13 @@ class State:
     time: float
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class RaceActions:
     """
     What's currently happening during the race.
+
+    There are only 64 of these, so the simulation looks up the interned instance for a
+    mode (a bitmask of the flags above) with `from_mode` instead of building a new one.
     """
     clock_running: bool
     charging: bool
@@ -31,3 +46,63 @@ class RaceActions:
     normalized: bool
     grid_charging: bool
     race_hours: bool
+    mode: int = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, 'mode', (CLOCK_RUNNING if self.clock_running else 0)
+                           | (CHARGING if self.charging else 0)
+                           | (DRIVING if self.driving else 0)
+                           | (NORMALIZED if self.normalized else 0)
+                           | (GRID_CHARGING if self.grid_charging else 0)
+                           | (RACE_HOURS if self.race_hours else 0))
+
+    @staticmethod
+    def from_mode(mode: int) -> 'RaceActions':
+        """
+        :return: The interned RaceActions for a mode.
+        """
+        return _RACE_ACTIONS[mode]
+
+
+_RACE_ACTIONS = tuple(RaceActions(*(bool(mode & bit) for bit in (CLOCK_RUNNING, CHARGING, DRIVING,
+                                                                  NORMALIZED, GRID_CHARGING, RACE_HOURS)))
+                      for mode in range(64))
+
+STOPPED = RaceActions.from_mode(CHARGING | NORMALIZED)
+"""
+Outside of race hours: overnight and at stage stops.
+"""
+
+AT_CONTROL_STOP = RaceActions.from_mode(CHARGING | NORMALIZED | RACE_HOURS)
+
+RACING = RaceActions.from_mode(CLOCK_RUNNING | CHARGING | DRIVING | RACE_HOURS)
+
+
+@dataclass(frozen=True)
+class EndConditions:
+    """
+    Declarative end condition for `simulate`.
+
+    The simulation fails when the SOC drops to `min_soc` or the time passes `end_time`
+    and succeeds when the distance reaches `finish_distance`. `simulate` checks these
+    itself instead of calling the object every step, but it can also be called like
+    any other `end_simulation` function.
+    """
+    finish_distance: float = math.inf  # <m>
+    end_time: float = math.inf  # <s> since the unix epoch
+    min_soc: float = 0.0
+
+    @staticmethod
+    def for_race(race) -> 'EndConditions':
+        """
+        :return: End conditions for finishing a race before its last time event.
+        """
+        return EndConditions(finish_distance=race.distance_events[-1].distance,
+                             end_time=race.time_events[-1].time)
+
+    def __call__(self, state: State):
+        if state.soc <= self.min_soc or state.time > self.end_time:
+            return False
+        if state.distance >= self.finish_distance:
+            return True
+        return None
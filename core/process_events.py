@@ -9,7 +9,7 @@ __email__ = "dunca384@umn.edu"
 from typing import List, Optional, Tuple
 
 from core.events import StageStop, ControlStop, StartOfDay, EndOfDay, StartGridCharge, EndGridCharge
-from core.objects import RaceActions, State
+from core.objects import AT_CONTROL_STOP, GRID_CHARGING, RACING, STOPPED, RaceActions, State
 
 
 # It would be better to split this up into RaceState and RaceActions
@@ -37,20 +37,10 @@ def process_events(distance_queue: List,
         event = distance_queue.pop(0)
         if isinstance(event, StageStop):
             if state.time <= event.target_arrival:
-                race_state = RaceActions(clock_running=False,
-                                         charging=True,
-                                         driving=False,
-                                         normalized=True,
-                                         grid_charging=False,
-                                         race_hours=False)
+                race_state = STOPPED
             elif state.time <= event.latest_arrival:
                 # TODO: add lateness to stats for scoring
-                race_state = RaceActions(clock_running=False,
-                                         charging=True,
-                                         driving=False,
-                                         normalized=True,
-                                         grid_charging=False,
-                                         race_hours=False)
+                race_state = STOPPED
             else:
                 # Too late to the stage stop
                 print('Too late to stage stop')
@@ -58,12 +48,7 @@ def process_events(distance_queue: List,
         elif isinstance(event, ControlStop):
             if state.time <= event.latest_arrival:
                 checkpoint_time_remaining = event.duration
-                race_state = RaceActions(clock_running=False,
-                                         charging=True,
-                                         driving=False,
-                                         normalized=True,
-                                         grid_charging=False,
-                                         race_hours=True)
+                race_state = AT_CONTROL_STOP
             else:
                 # Too late to checkpoint -> TODO: change this for ASC
                 print('Too late to checkpoint')
@@ -76,33 +61,13 @@ def process_events(distance_queue: List,
         if isinstance(event, StartOfDay):
             # Waiting at the checkpoint at the beginning of the day is handle external to this
             # should we handle this here?
-            race_state = RaceActions(clock_running=True,
-                                     charging=True,
-                                     driving=True,
-                                     normalized=False,
-                                     grid_charging=False,
-                                     race_hours=True)
+            race_state = RACING
         elif isinstance(event, EndOfDay):
-            race_state = RaceActions(clock_running=False,
-                                     charging=True,
-                                     driving=False,
-                                     normalized=True,
-                                     grid_charging=False,
-                                     race_hours=False)
+            race_state = STOPPED
         elif isinstance(event, StartGridCharge):
-            race_state = RaceActions(clock_running=race_state.clock_running,
-                                     charging=race_state.charging,
-                                     driving=race_state.driving,
-                                     normalized=race_state.normalized,
-                                     grid_charging=True,
-                                     race_hours=race_state.race_hours)
+            race_state = RaceActions.from_mode(race_state.mode | GRID_CHARGING)
         elif isinstance(event, EndGridCharge):
-            race_state = RaceActions(clock_running=race_state.clock_running,
-                                     charging=race_state.charging,
-                                     driving=race_state.driving,
-                                     normalized=race_state.normalized,
-                                     grid_charging=False,
-                                     race_hours=race_state.race_hours)
+            race_state = RaceActions.from_mode(race_state.mode & ~GRID_CHARGING)
         else:
             raise NotImplementedError()
 
@@ -27,14 +27,47 @@ class Race:
 
         :param distance: Distance along the race route in meters.
 
-        :return: Tuple of latitude and longitude, both in radians.
+        :return: Tuple of latitude and longitude, both in degrees.
         """
         # TODO: this is hacky to get something working for WSC
-        if distance < 3022 * 1/3:
-            return math.radians(-12.425724), math.radians(130.8632684)
-        if distance < 3022 * 2/3:
-            return math.radians(-29.0135), math.radians(134.7544)
-        return math.radians(-34.9284235), math.radians(138.5657262)
+        if distance < 3022e3 * 1/3:
+            return -12.425724, 130.8632684
+        if distance < 3022e3 * 2/3:
+            return -29.0135, 134.7544
+        return -34.9284235, 138.5657262
+
+    def get_heading(self, distance: float, span: float = 500.0) -> float:
+        """
+        Calculate the direction the car is traveling given distance along the race route.
+
+        With a route this is the bearing between the route's points `span` meters before
+        and after `distance`. Without one it's the bearing between the placeholder
+        locations `get_location` returns, so only a few distinct headings come out.
+
+        :param distance: Distance along the race route in meters.
+        :param span: Distance either side of `distance` to take the bearing over in meters.
+
+        :return: Heading in radians clockwise from north.
+        """
+        if self.route is not None and len(self.route.points) > 1:
+            length = self.route.race_length
+            start = self.route.get_point_from_distance(float(min(max(distance - span, 0.0), length)))
+            end = self.route.get_point_from_distance(float(min(max(distance + span, 0.0), length)))
+            lat1, lon1, lat2, lon2 = start.lat, start.lon, end.lat, end.lon
+        else:
+            # TODO: this is hacky to get something working for WSC
+            lat1, lon1 = self.get_location(distance)
+            lat2, lon2 = self.get_location(distance + 3022e3 * 1/3)
+            if (lat1, lon1) == (lat2, lon2):
+                lat2, lon2 = lat1, lon1
+                lat1, lon1 = self.get_location(distance - 3022e3 * 1/3)
+        lat1, lon1, lat2, lon2 = [math.radians(x) for x in (lat1, lon1, lat2, lon2)]
+
+        # https://www.movable-type.co.uk/scripts/latlong.html (initial bearing)
+        delta_lon = lon2 - lon1
+        return math.atan2(math.sin(delta_lon) * math.cos(lat2),
+                          math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(delta_lon)) \
+            % (2.0 * math.pi)
 
     def determine_speed_limit(self, distance: float) -> float:
         """
@@ -0,0 +1,236 @@
+"""
+Race definition files and their compiled cache.
+
+A race definition is a JSON file listing the race's events, speed limits, and route:
+
+    {
+        "route": {"file": "paths/WSC_2023.kml"},
+        "distance_events": [
+            {"type": "ControlStop", "name": "Control Stop Katherine", "distance": "316 km",
+             "duration": "30 min", "latest_arrival": "2021-10-18T14:30:00+09:30"},
+            ...
+        ],
+        "time_events": [
+            {"type": "StartOfDay", "name": "Day 1 Start", "time": "2021-10-13T08:30:00+09:30"},
+            ...
+        ],
+        "speed_limits": [
+            {"distance": "0 km", "speed_limit": "100 km/h"}
+        ]
+    }
+
+Distances, durations, and speeds are numbers in SI units or strings with a unit that
+`core.units` understands, times are ISO 8601 strings with a UTC offset, and the route
+file is relative to the definition (or the route is null).
+
+Converting the times is slow, so `load_race` compiles the definition the first time
+it's loaded: the events are sorted, every value is converted, and the result is pickled
+into a `.race` file next to the definition. The route's points are compiled into a
+`.route` file the same way, so loading it again doesn't need lxml. Both are rebuilt when
+their source changes, and every later load (in any process) only unpickles them.
+"""
+
+__author__ = "Brett Duncan"
+__email__ = "dunca384@umn.edu"
+
+
+from array import array
+import hashlib
+import json
+import os
+import pickle
+import struct
+import tempfile
+from typing import Any, Dict, Optional, Tuple
+
+from core.events import ControlStop, EndGridCharge, EndOfDay, SpeedLimit, StageStop, StartGridCharge, StartOfDay
+from core.race import Race
+from core.units import date, distance, duration, speed
+
+
+MAGIC = b'SCRD'
+VERSION = 2  # 2: times no longer depend on the timezone of the machine that compiled them
+HEADER = struct.Struct('<4sI32s')  # magic, version, SHA-256 of the source
+
+EVENT_TYPES = {cls.__name__: cls for cls in (StageStop, ControlStop, StartOfDay, EndOfDay,
+                                             StartGridCharge, EndGridCharge)}
+
+_UNITS = {
+    'distance': distance,
+    'duration': duration,
+    'speed_limit': speed,
+}
+
+_TIMES = ('time', 'target_arrival', 'latest_arrival')
+
+_races: Dict[Tuple[str, bool], Race] = {}
+"""
+Races this process has loaded, by the absolute path of their definition and whether the route was loaded.
+"""
+
+
+def _convert(field: str, value: Any) -> Any:
+    if field in _TIMES:
+        return date(value)
+    if field in _UNITS:
+        if isinstance(value, str):
+            number, unit = value.split()
+            return _UNITS[field](float(number), unit=unit)
+        return float(value)
+    return value
+
+
+def _make(cls, fields: Dict[str, Any]):
+    return cls(**{field: _convert(field, value) for field, value in fields.items()})
+
+
+def parse_race_definition(source_path: str) -> Tuple[list, list, list, Optional[str]]:
+    """
+    Read a race definition without compiling it.
+
+    :param source_path: Path of the JSON definition.
+
+    :return: Tuple of the distance events, time events, and speed limits, each sorted,
+    and the path of the route file relative to the definition (None if the race has no route).
+    """
+    with open(source_path) as f:
+        definition = json.load(f)
+
+    distance_events = [_make(EVENT_TYPES[e['type']], {k: v for k, v in e.items() if k != 'type'})
+                       for e in definition['distance_events']]
+    time_events = [_make(EVENT_TYPES[e['type']], {k: v for k, v in e.items() if k != 'type'})
+                   for e in definition['time_events']]
+    speed_limits = [_make(SpeedLimit, e) for e in definition['speed_limits']]
+
+    route = definition.get('route')
+    route_path = route['file'] if route is not None else None
+
+    # Stable sorts keep the order of events that happen at the same place or time
+    return (sorted(distance_events, key=lambda e: e.distance),
+            sorted(time_events, key=lambda e: e.time),
+            sorted(speed_limits, key=lambda e: e.distance),
+            route_path)
+
+
+def _digest(file_path: str) -> bytes:
+    with open(file_path, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+def _read_compiled(file_path: str, digest: bytes) -> Optional[Any]:
+    # The compiled payload, or None if the file is missing or was compiled from a different source
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if len(data) < HEADER.size or HEADER.unpack_from(data) != (MAGIC, VERSION, digest):
+        return None
+    return pickle.loads(data[HEADER.size:])
+
+
+def _try_write_compiled(file_path: str, digest: bytes, payload: Any) -> None:
+    # A cache that can't be written (e.g. a read-only checkout) only costs the next load its time
+    try:
+        _write_compiled(file_path, digest, payload)
+    except OSError:
+        pass
+
+
+def _write_compiled(file_path: str, digest: bytes, payload: Any) -> None:
+    # Written to a temporary file and moved into place, so processes compiling at the
+    # same time never read a partial file
+    data = HEADER.pack(MAGIC, VERSION, digest) + pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def compile_race(source_path: str, compiled_path: Optional[str] = None) -> str:
+    """
+    Compile a race definition, whether or not its compiled file is up to date.
+
+    :param source_path: Path of the JSON definition.
+    :param compiled_path: Path of the compiled file (the definition's path with a `.race`
+    extension by default).
+
+    :return: Path of the compiled file.
+    """
+    if compiled_path is None:
+        compiled_path = os.path.splitext(source_path)[0] + '.race'
+    _write_compiled(compiled_path, _digest(source_path), parse_race_definition(source_path))
+    return compiled_path
+
+
+def _compile_route(route_path: str) -> Tuple[Optional[str], float, array, array, array]:
+    from core.race_path import RacePath
+
+    route = RacePath()
+    route.load_path(route_path)
+    return (route.name,
+            route.race_length,
+            array('d', [p.race_distance for p in route.points]),
+            array('d', [p.coordinate.lon for p in route.points]),
+            array('d', [p.coordinate.lat for p in route.points]))
+
+
+def load_route(route_path: str):
+    """
+    Load a route through its compiled `.route` file, compiling it if it's out of date.
+
+    :param route_path: Path of the KML route.
+
+    :return: RacePath of the route.
+    """
+    from core.race_path import RacePath
+    from core.shared import SharedPoints
+
+    digest = _digest(route_path)
+    compiled_path = os.path.splitext(route_path)[0] + '.route'
+    compiled = _read_compiled(compiled_path, digest)
+    if compiled is None:
+        compiled = _compile_route(route_path)
+        _try_write_compiled(compiled_path, digest, compiled)
+
+    name, race_length, distances, lons, lats = compiled
+    route = RacePath()
+    route.points = SharedPoints(distances, lons, lats)
+    route.race_length = race_length
+    route.name = name
+    return route
+
+
+def load_race(source_path: str, with_route: bool = True) -> Race:
+    """
+    Load a race definition through its compiled `.race` file, compiling it if it's out of date.
+
+    Races are kept for the life of the process, so loading the same definition again is free.
+
+    :param source_path: Path of the JSON definition.
+    :param with_route: Load the race's route too.
+
+    :return: The race.
+    """
+    key = (os.path.abspath(source_path), with_route)
+    if key not in _races:
+        digest = _digest(source_path)
+        compiled_path = os.path.splitext(source_path)[0] + '.race'
+        compiled = _read_compiled(compiled_path, digest)
+        if compiled is None:
+            compiled = parse_race_definition(source_path)
+            _try_write_compiled(compiled_path, digest, compiled)
+
+        distance_events, time_events, speed_limits, route_path = compiled
+        route = None
+        if with_route and route_path is not None:
+            route = load_route(os.path.join(os.path.dirname(key[0]), route_path))
+        _races[key] = Race(distance_events=distance_events,
+                           time_events=time_events,
+                           speed_limits=speed_limits,
+                           route=route)
+    return _races[key]
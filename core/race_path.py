@@ -1,7 +1,6 @@
 
-from typing import Union, Tuple, List, NamedTuple
+from typing import Union, Tuple, List, NamedTuple, Optional
 import math
-from lxml import etree
 
 
 # Coordinate will be immutable since it extends NamedTuple
@@ -168,8 +167,98 @@ class RacePath():
         return closest_race_dist
 
 
+    # index of the last point at or before the given race distance
+    def _find_index(self, distance: float) -> int:
+
+        upper = len(self.points) - 1
+        lower = 0
+
+        while upper - lower > 1:
+            middle = (upper - lower) // 2 + lower
+            if distance < self.points[middle].race_distance:
+                upper = middle
+            else:
+                lower = middle
+
+        return lower
+
+
+    # closest point on the path between two race distances
+    # the path segments are projected onto a flat plane around the coordinate, which is
+    # accurate to well under a meter over the few kilometers covered by a window
+    # returns the race distance and how far the coordinate is from the path in meters
+    def _match_in_window(self, coordinate: Coordinate, start: float, end: float) -> Tuple[float, float]:
+
+        constant = math.pi / 180.0
+        r = 6.371e6 # Earth's radius in meters
+        x_scale = math.cos(coordinate.lat * constant) * constant * r
+        y_scale = constant * r
+
+        least_dist_sq = float('inf')
+        closest_race_dist = 0.0
+
+        first = self._find_index(max(start, 0.0))
+        last = self._find_index(min(end, self.race_length)) + 1
+
+        for i in range(first, min(last, len(self.points) - 1)):
+
+            a = self.points[i]
+            b = self.points[i + 1]
+
+            # positions relative to the coordinate in meters
+            ax = (a.coordinate.lon - coordinate.lon) * x_scale
+            ay = (a.coordinate.lat - coordinate.lat) * y_scale
+            dx = (b.coordinate.lon - coordinate.lon) * x_scale - ax
+            dy = (b.coordinate.lat - coordinate.lat) * y_scale - ay
+
+            # fraction of the way along the segment of the closest point
+            length_sq = dx**2 + dy**2
+            f = 0.0 if length_sq == 0.0 else min(max(-(ax * dx + ay * dy) / length_sq, 0.0), 1.0)
+
+            dist_sq = (ax + f * dx)**2 + (ay + f * dy)**2
+            if dist_sq < least_dist_sq:
+                least_dist_sq = dist_sq
+                closest_race_dist = a.race_distance + f * (b.race_distance - a.race_distance)
+
+        return closest_race_dist, math.sqrt(least_dist_sq)
+
+
+    # map match a batch of fixes that are in order along the route
+    # each fix is matched to the path within window meters of the previous match instead of
+    # searching the whole route, falling back to the full search when the match is more than
+    # max_offset meters from the fix (or for the first fix if there's no start_distance)
+    def get_distances_from_points(self, coordinates: List[Coordinate], start_distance: Optional[float] = None,
+                                  window: float = 5000.0, max_offset: float = 200.0) -> List[float]:
+
+        if len(self.points) == 0:
+            raise Exception('Path not initialized.')
+
+        distances = []
+        previous = start_distance
+
+        for coordinate in coordinates:
+
+            race_dist = None
+
+            if previous is not None:
+                race_dist, offset = self._match_in_window(coordinate, previous - window, previous + window)
+                if offset > max_offset:
+                    race_dist = None # lost track of the car
+
+            if race_dist is None:
+                race_dist = self.get_distance_from_point(coordinate)
+
+            distances.append(race_dist)
+            previous = race_dist
+
+        return distances
+
+
     def load_path(self, file_path: str) -> None:
 
+        # lxml is only needed to parse a route, so it isn't imported with the module
+        from lxml import etree
+
         try:
             tree = etree.parse(file_path)
         except OSError as e:
@@ -0,0 +1,358 @@
+"""
+On-disk columnar store for sweep results.
+
+A store is a directory with a schema file and one file per row group. Records are
+buffered in memory and written a row group at a time, each column as one contiguous
+array, so reading a column only touches that column's bytes:
+
+    schema.json     parameter names, number of stops, and the list of row groups
+    group-NNNNN.col
+        magic       4 bytes  b'SCRG'
+        version     uint32
+        n_rows      uint32
+        header_len  uint32
+        header      JSON {column: [typecode, offset]}
+        columns     little-endian arrays
+
+A row group file is written in full before the schema that lists it is replaced, so a
+crash never leaves a store that lists a partial row group.
+"""
+
+__author__ = "Brett Duncan"
+__email__ = "dunca384@umn.edu"
+
+
+from array import array
+import bisect
+import itertools
+import json
+import math
+import os
+import struct
+import sys
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+
+MAGIC = b'SCRG'
+VERSION = 1
+HEADER = struct.Struct('<4sIII')
+
+METRICS = ('finished', 'min_soc', 'max_distance')
+
+
+class SweepRecord(NamedTuple):
+    parameters: Tuple[float, ...]  # in the order of the store's parameter columns
+    finished: bool
+    min_soc: float
+    max_distance: float  # <m>
+    stops: Tuple[Optional[Tuple[float, float]], ...] = ()  # SOC and arrival time <s> at each stop, None if not reached
+
+
+Condition = Union[float, Tuple[Optional[float], Optional[float]]]
+"""
+A value to match exactly or an inclusive (low, high) range, where None leaves that end open.
+"""
+
+
+def _write_atomic(file_path: str, data: bytes) -> None:
+    temp_path = file_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, file_path)
+
+
+class _RowGroup:
+    """
+    Lazily loaded columns of one row group file.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        with open(file_path, 'rb') as f:
+            magic, version, self.n_rows, header_len = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f'{file_path} is not a version {VERSION} row group.')
+            self.layout = json.loads(f.read(header_len))
+        self._columns: Dict[str, array] = {}
+
+    def column(self, name: str) -> array:
+        if name not in self._columns:
+            typecode, offset = self.layout[name]
+            values = array(typecode)
+            with open(self.file_path, 'rb') as f:
+                f.seek(offset)
+                values.frombytes(f.read(self.n_rows * values.itemsize))
+            if sys.byteorder != 'little':
+                values.byteswap()
+            self._columns[name] = values
+        return self._columns[name]
+
+
+class ResultStore:
+    """
+    Append-only store of sweep records with an index on the parameter columns.
+    """
+
+    def __init__(self,
+                 path: str,
+                 parameters: Sequence[str] = ('vehicle_speed', 'wind_speed', 'array_power_factor'),
+                 n_stops: Optional[int] = None,
+                 row_group_size: int = 1024):
+        """
+        Open a store, creating it if the directory doesn't have one.
+
+        :param path: Directory of the store.
+        :param parameters: Names of the parameter columns (ignored for an existing store).
+        :param n_stops: Number of stops whose SOC and arrival time are kept, usually
+        `len(race.distance_events)`. Required to create a store and ignored for an existing one.
+        :param row_group_size: Number of records buffered before a row group is written.
+        """
+        self.path = path
+        self.row_group_size = row_group_size
+
+        schema_path = os.path.join(path, 'schema.json')
+        if os.path.exists(schema_path):
+            with open(schema_path) as f:
+                schema = json.load(f)
+            if schema['version'] != VERSION:
+                raise ValueError(f'{path} is not a version {VERSION} result store.')
+            self.parameters = tuple(schema['parameters'])
+            self.n_stops = schema['n_stops']
+            group_names = schema['row_groups']
+        else:
+            if n_stops is None:
+                raise ValueError('n_stops is required to create a result store (0 to keep no stops)')
+            os.makedirs(path, exist_ok=True)
+            self.parameters = tuple(parameters)
+            self.n_stops = n_stops
+            group_names = []
+
+        self.columns = self.parameters + METRICS + tuple(itertools.chain.from_iterable(
+            (f'stop_{i}_soc', f'stop_{i}_arrival') for i in range(self.n_stops)))
+
+        self._groups = [_RowGroup(os.path.join(path, name)) for name in group_names]
+        self._group_starts = list(itertools.accumulate((g.n_rows for g in self._groups), initial=0))
+        self._buffer: List[SweepRecord] = []
+
+        # parameter tuple -> row number, and per parameter (value, row number) pairs in order
+        self._index: Dict[Tuple[float, ...], int] = {}
+        for row, key in enumerate(zip(*(self.column(name) for name in self.parameters))):
+            self._index[key] = row
+        self._sorted: Dict[str, List[Tuple[float, int]]] = {}
+
+        if not os.path.exists(schema_path):
+            self._write_schema()
+
+    def _write_schema(self) -> None:
+        schema = {
+            'version': VERSION,
+            'parameters': list(self.parameters),
+            'n_stops': self.n_stops,
+            'row_groups': [os.path.basename(g.file_path) for g in self._groups],
+        }
+        _write_atomic(os.path.join(self.path, 'schema.json'), json.dumps(schema, indent=2).encode())
+
+    def __len__(self) -> int:
+        return self._group_starts[-1] + len(self._buffer)
+
+    def __contains__(self, parameters: Tuple[float, ...]) -> bool:
+        return tuple(parameters) in self._index
+
+    def __enter__(self) -> 'ResultStore':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.flush()
+
+    def append(self, record: SweepRecord) -> None:
+        """
+        Add a record. Records for parameters that are already stored are ignored.
+        """
+        key = tuple(record.parameters)
+        if len(key) != len(self.parameters):
+            raise ValueError(f'Expected {len(self.parameters)} parameters, got {len(key)}')
+        if key in self._index:
+            return
+
+        self._index[key] = len(self)
+        self._sorted.clear()
+        self._buffer.append(record)
+        if len(self._buffer) >= self.row_group_size:
+            self.flush()
+
+    def _buffer_column(self, name: str) -> List[float]:
+        if name in self.parameters:
+            i = self.parameters.index(name)
+            return [r.parameters[i] for r in self._buffer]
+        if name == 'finished':
+            return [1 if r.finished else 0 for r in self._buffer]
+        if name in METRICS:
+            return [getattr(r, name) for r in self._buffer]
+
+        _, stop, field = name.split('_')
+        stop, offset = int(stop), 0 if field == 'soc' else 1
+        values = []
+        for r in self._buffer:
+            value = r.stops[stop] if stop < len(r.stops) else None
+            values.append(math.nan if value is None else value[offset])
+        return values
+
+    def flush(self) -> None:
+        """
+        Write the buffered records as a row group.
+        """
+        if not self._buffer:
+            return
+
+        data = []
+        layout = {}
+        for name in self.columns:
+            values = array('b' if name == 'finished' else 'd', self._buffer_column(name))
+            if sys.byteorder != 'little':
+                values.byteswap()
+            data.append(values.tobytes())
+            layout[name] = values.typecode
+
+        # Offsets depend on the header length, which depends on the offsets
+        header = b''
+        while True:
+            offset = HEADER.size + len(header)
+            offsets = {}
+            for name, chunk in zip(self.columns, data):
+                offsets[name] = [layout[name], offset]
+                offset += len(chunk)
+            new_header = json.dumps(offsets).encode()
+            if len(new_header) == len(header):
+                header = new_header
+                break
+            header = new_header
+
+        file_path = os.path.join(self.path, f'group-{len(self._groups):05d}.col')
+        _write_atomic(file_path, HEADER.pack(MAGIC, VERSION, len(self._buffer), len(header)) + header + b''.join(data))
+
+        self._groups.append(_RowGroup(file_path))
+        self._group_starts.append(self._group_starts[-1] + len(self._buffer))
+        self._buffer = []
+        self._write_schema()
+
+    def column(self, name: str) -> List[float]:
+        """
+        :return: Every value of a column, in the order the records were added.
+        """
+        if name not in self.columns:
+            raise KeyError(name)
+        values = []
+        for group in self._groups:
+            values.extend(group.column(name))
+        values.extend(self._buffer_column(name))
+        return values
+
+    def _value(self, name: str, row: int) -> float:
+        if row >= self._group_starts[-1]:
+            return self._buffer_column(name)[row - self._group_starts[-1]]
+        g = bisect.bisect_right(self._group_starts, row) - 1
+        return self._groups[g].column(name)[row - self._group_starts[g]]
+
+    def _record(self, row: int) -> SweepRecord:
+        if row >= self._group_starts[-1]:
+            return self._buffer[row - self._group_starts[-1]]
+
+        g = bisect.bisect_right(self._group_starts, row) - 1
+        group, i = self._groups[g], row - self._group_starts[g]
+        stops = []
+        for stop in range(self.n_stops):
+            soc = group.column(f'stop_{stop}_soc')[i]
+            arrival = group.column(f'stop_{stop}_arrival')[i]
+            stops.append(None if math.isnan(soc) else (soc, arrival))
+        return SweepRecord(parameters=tuple(group.column(name)[i] for name in self.parameters),
+                           finished=bool(group.column('finished')[i]),
+                           min_soc=group.column('min_soc')[i],
+                           max_distance=group.column('max_distance')[i],
+                           stops=tuple(stops))
+
+    def get(self, parameters: Tuple[float, ...]) -> Optional[SweepRecord]:
+        """
+        :return: The record with exactly these parameters, or None if there isn't one.
+        """
+        row = self._index.get(tuple(parameters))
+        return None if row is None else self._record(row)
+
+    def _sorted_index(self, name: str) -> List[Tuple[float, int]]:
+        if name not in self._sorted:
+            self._sorted[name] = sorted((value, row) for row, value in enumerate(self.column(name)))
+        return self._sorted[name]
+
+    def _matching_rows(self, name: str, condition: Condition) -> List[int]:
+        low, high = condition if isinstance(condition, tuple) else (condition, condition)
+        index = self._sorted_index(name)
+        start = 0 if low is None else bisect.bisect_left(index, (low, -1))
+        end = len(index) if high is None else bisect.bisect_right(index, (high, len(index)))
+        return [row for _, row in index[start:end]]
+
+    def query(self, **conditions: Condition) -> Iterator[SweepRecord]:
+        """
+        Find the records whose parameters meet every condition, e.g.
+
+            store.query(vehicle_speed=(20.0, 25.0), wind_speed=0.0)
+
+        :param conditions: Value or inclusive (low, high) range for each parameter to filter on.
+
+        :return: Iterator of the matching records in the order they were added.
+        """
+        for name in conditions:
+            if name not in self.parameters:
+                raise KeyError(f'{name} is not a parameter of this store')
+
+        rows = None
+        for name, condition in conditions.items():
+            matching = set(self._matching_rows(name, condition))
+            rows = matching if rows is None else rows & matching
+            if not rows:
+                break
+
+        for row in sorted(rows) if rows is not None else range(len(self)):
+            yield self._record(row)
+
+    def interpolate(self, metric: str, **parameters: float) -> float:
+        """
+        Multilinearly interpolate a metric between the stored parameter points around a point.
+
+        The stored points have to form a grid around the point (as a sweep over every
+        combination of parameter values does).
+
+        :param metric: Column to interpolate, e.g. 'min_soc' or 'stop_3_arrival'.
+        :param parameters: Value of every parameter.
+
+        :return: Interpolated value of the metric. `finished` interpolates to a fraction.
+        """
+        if metric not in self.columns or metric in self.parameters:
+            raise KeyError(f'{metric} is not a metric of this store')
+        if set(parameters) != set(self.parameters):
+            raise ValueError(f'Expected values for {", ".join(self.parameters)}')
+
+        brackets = []
+        for name in self.parameters:
+            value = parameters[name]
+            values = sorted({v for v, _ in self._sorted_index(name)})
+            i = bisect.bisect_left(values, value)
+            if i < len(values) and values[i] == value:
+                brackets.append(((value, 1.0),))
+            elif 0 < i < len(values):
+                low, high = values[i - 1], values[i]
+                f = (value - low) / (high - low)
+                brackets.append(((low, 1.0 - f), (high, f)))
+            else:
+                raise ValueError(f'{name}={value} is outside the stored range')
+
+        total = 0.0
+        for corner in itertools.product(*brackets):
+            key = tuple(value for value, _ in corner)
+            row = self._index.get(key)
+            if row is None:
+                raise KeyError(f'No record for {dict(zip(self.parameters, key))} to interpolate from')
+            weight = math.prod(w for _, w in corner)
+            if weight != 0.0:
+                total += weight * self._value(metric, row)
+        return total
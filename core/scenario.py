@@ -0,0 +1,115 @@
+"""
+Declarative, picklable descriptions of a simulation scenario.
+
+The solvers used to build `wind_func`, `array_model`, and `end_simulation` as closures,
+which can't be pickled, so every parallel job had to rebuild them inside the worker.
+The classes here are small frozen dataclasses that can be sent to a worker as is.
+"""
+
+__author__ = "Brett Duncan"
+__email__ = "dunca384@umn.edu"
+
+
+from dataclasses import dataclass, fields
+import math
+from typing import Any, List, Optional, Tuple
+
+from core.car import Car
+from core.irradiance import IrradianceRaster
+from core.objects import EndConditions, State, RaceActions
+from core.race import Race
+from core.simulation import simulate, EULER
+from core.state_log import DECIMATE, StateLog
+
+
+@dataclass(frozen=True)
+class ConstantWind:
+    """
+    Wind model with the same wind speed everywhere.
+    """
+    wind_speed: float = 0.0  # <m/s> in the direction of travel
+
+    def __call__(self, distance: float, time: float) -> float:
+        return self.wind_speed
+
+
+@dataclass(frozen=True)
+class FlatArray:
+    """
+    Flat array model scaled by an array power factor.
+    """
+    array_power_factor: float = 1.0
+    area: float = 5.0  # <m^2>
+    efficiency: float = 0.25
+
+    def __call__(self, irradiance: float, sun_altitude: float, normalized: bool) -> float:
+        normalization_scalar = 1.0 if normalized else math.sin(sun_altitude)
+        return self.array_power_factor * irradiance * normalization_scalar * self.area * self.efficiency
+
+
+@dataclass(frozen=True)
+class ScenarioSpec:
+    """
+    Everything needed to simulate one scenario on a race, starting from a full battery
+    at the start of the race.
+
+    The race itself isn't part of the spec so that many specs can share one copy of it
+    (see `core.shared`).
+    """
+    car: Car
+    target_speeds: Tuple[Tuple[float, float], ...]
+    wind: Any = ConstantWind()  # picklable wind function of (distance, time)
+    array_model: Any = FlatArray()  # picklable array model
+    dt: float = 1.0
+    integrator: str = EULER
+    stationary_integrator: bool = False
+    drive_power_table: bool = False
+    log_budget: Optional[int] = None  # most bytes of log to keep in memory, see StateLog
+    log_overflow: str = DECIMATE
+
+    def __reduce__(self):
+        # Positional arguments instead of the field dictionary keep tasks small
+        return ScenarioSpec, tuple(getattr(self, field.name) for field in fields(self))
+
+    @property
+    def battery_size(self) -> float:
+        battery = self.car.battery
+        return battery.energy_per_cell * (battery.cells_in_series * battery.cells_in_parallel)  # <J>
+
+    def new_log(self) -> StateLog:
+        """
+        :return: Empty log within this scenario's budget.
+        """
+        return StateLog(max_bytes=self.log_budget, overflow=self.log_overflow)
+
+    def simulate(self, race: Race, irradiance_raster: Optional[IrradianceRaster] = None) -> Tuple[Any, State, List[Tuple]]:
+        """
+        Run `simulate` for this scenario.
+
+        :param race: Race to simulate.
+        :param irradiance_raster: Precomputed solar altitude and irradiance along the route.
+
+        :return: The same tuple `simulate` returns.
+        """
+        battery_size = self.battery_size
+        return simulate(race=race,
+                        car=self.car,
+                        wind_func=self.wind,
+                        array_model=self.array_model,
+                        end_simulation=EndConditions.for_race(race),
+                        battery_size=battery_size,
+                        state=State(distance=0.0, energy=battery_size, soc=1.0,
+                                    time=race.time_events[0].time),
+                        race_state=RaceActions(clock_running=False,
+                                               charging=False,
+                                               driving=False,
+                                               normalized=False,
+                                               grid_charging=False,
+                                               race_hours=False),
+                        target_speeds=list(self.target_speeds),
+                        dt=self.dt,
+                        stationary_integrator=self.stationary_integrator,
+                        integrator=self.integrator,
+                        irradiance_raster=irradiance_raster,
+                        drive_power_table=self.drive_power_table,
+                        log=self.new_log())
@@ -0,0 +1,261 @@
+"""
+Shared-memory registry for handing race data to worker processes.
+
+Sending the race to every task pickles the event schedule, route, and irradiance
+raster each time. Instead, the parent process publishes them once with a
+SharedRegistry and every task only carries a small handle. Workers attach to the
+shared memory by name the first time they see a handle and keep it for the rest of
+their life, so later tasks don't copy anything:
+
+    with SharedRegistry() as registry:
+        handle = publish_race(registry, race, irradiance_raster)
+        # send (handle, spec) to the workers, which call handle.attach()
+
+Numeric data (the route and the raster) is read in place. The event schedule is a
+list of Python objects, so it's pickled into shared memory and unpickled once per
+worker.
+"""
+
+__author__ = "Brett Duncan"
+__email__ = "dunca384@umn.edu"
+
+
+from array import array
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+import pickle
+from typing import Any, Dict, List, Optional, Sequence
+
+from core.irradiance import IrradianceRaster
+from core.race import Race
+
+
+_blocks: Dict[str, shared_memory.SharedMemory] = {}
+"""
+Shared memory blocks this process has attached to, by name.
+"""
+
+_objects: Dict[str, Any] = {}
+"""
+Objects this process has attached to, by the name of the block they're stored in.
+"""
+
+
+def _attach_block(name: str) -> shared_memory.SharedMemory:
+    block = _blocks.get(name)
+    if block is None:
+        # Worker processes share the parent's resource tracker, so attaching doesn't
+        # take ownership of the block away from the registry that unlinks it
+        block = shared_memory.SharedMemory(name=name)
+        _blocks[name] = block
+    return block
+
+
+@dataclass(frozen=True)
+class ArrayHandle:
+    """
+    Handle to an array of numbers in shared memory.
+    """
+    name: str
+    typecode: str
+    length: int
+
+    def attach(self) -> memoryview:
+        """
+        :return: Read-only view of the array.
+        """
+        return _attach_block(self.name).buf.cast('B')[:self.length * array(self.typecode).itemsize] \
+            .cast(self.typecode).toreadonly()
+
+
+@dataclass(frozen=True)
+class ObjectHandle:
+    """
+    Handle to a pickled object in shared memory.
+    """
+    name: str
+    size: int
+
+    def attach(self) -> Any:
+        """
+        :return: The object, unpickled the first time this process attaches to it.
+        """
+        if self.name not in _objects:
+            _objects[self.name] = pickle.loads(_attach_block(self.name).buf[:self.size])
+        return _objects[self.name]
+
+
+@dataclass(frozen=True)
+class RasterHandle:
+    """
+    Handle to an irradiance raster in shared memory.
+    """
+    name: str
+
+    def attach(self) -> IrradianceRaster:
+        if self.name not in _objects:
+            _objects[self.name] = IrradianceRaster.from_buffer(_attach_block(self.name).buf)
+        return _objects[self.name]
+
+
+class SharedPoints(Sequence):
+    """
+    Route points read straight out of shared arrays, standing in for `RacePath.points`.
+    """
+
+    def __init__(self, distances: Sequence[float], lons: Sequence[float], lats: Sequence[float]):
+        self.distances = distances
+        self.lons = lons
+        self.lats = lats
+
+    def __len__(self) -> int:
+        return len(self.distances)
+
+    def __getitem__(self, index):
+        from core.race_path import Coordinate, PathPoint
+
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return PathPoint(self.distances[index], Coordinate(self.lons[index], self.lats[index]))
+
+
+@dataclass(frozen=True)
+class RouteHandle:
+    """
+    Handle to a race route in shared memory.
+    """
+    distances: ArrayHandle
+    lons: ArrayHandle
+    lats: ArrayHandle
+    race_length: float
+    route_name: Optional[str]
+
+    def attach(self):
+        """
+        :return: RacePath whose points are read from shared memory.
+        """
+        from core.race_path import RacePath
+
+        route = RacePath()
+        route.points = SharedPoints(self.distances.attach(), self.lons.attach(), self.lats.attach())
+        route.race_length = self.race_length
+        route.name = self.route_name
+        return route
+
+
+@dataclass(frozen=True)
+class RaceHandle:
+    """
+    Handle to a race and its irradiance raster in shared memory.
+    """
+    schedule: ObjectHandle  # distance events, time events, and speed limits
+    route: Optional[RouteHandle] = None
+    irradiance_raster: Optional[RasterHandle] = None
+
+    def attach(self) -> Race:
+        """
+        :return: The race, built once per process.
+        """
+        key = ('race', self.schedule.name)
+        if key not in _objects:
+            distance_events, time_events, speed_limits = self.schedule.attach()
+            _objects[key] = Race(distance_events=distance_events,
+                                 time_events=time_events,
+                                 speed_limits=speed_limits,
+                                 route=self.route.attach() if self.route is not None else None)
+        return _objects[key]
+
+    def attach_irradiance_raster(self) -> Optional[IrradianceRaster]:
+        return self.irradiance_raster.attach() if self.irradiance_raster is not None else None
+
+
+class SharedRegistry:
+    """
+    Owns the shared memory blocks published for a batch of work and unlinks them when closed.
+    """
+
+    def __init__(self):
+        self._blocks: List[shared_memory.SharedMemory] = []
+
+    def _allocate(self, data) -> shared_memory.SharedMemory:
+        data = memoryview(data).cast('B')
+        # Zero sized blocks aren't allowed
+        block = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        block.buf[:len(data)] = data
+        self._blocks.append(block)
+        return block
+
+    def put_array(self, typecode: str, values: Sequence[float]) -> ArrayHandle:
+        """
+        Copy numbers into shared memory.
+
+        :param typecode: `array` type code of the values, e.g. 'd'.
+        :param values: The numbers to share.
+
+        :return: Handle to the shared array.
+        """
+        data = array(typecode, values)
+        return ArrayHandle(name=self._allocate(data).name, typecode=typecode, length=len(data))
+
+    def put_object(self, obj: Any) -> ObjectHandle:
+        """
+        Pickle an object into shared memory.
+
+        :return: Handle to the shared object.
+        """
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        return ObjectHandle(name=self._allocate(data).name, size=len(data))
+
+    def put_irradiance_raster(self, irradiance_raster: IrradianceRaster) -> RasterHandle:
+        """
+        Copy an irradiance raster into shared memory.
+
+        :return: Handle to the shared raster.
+        """
+        return RasterHandle(name=self._allocate(irradiance_raster.buffer).name)
+
+    def close(self) -> None:
+        """
+        Unlink every block. Handles from this registry can't be attached to afterwards.
+        """
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks.clear()
+
+    @property
+    def size_in_bytes(self) -> int:
+        return sum(block.size for block in self._blocks)
+
+    def __enter__(self) -> 'SharedRegistry':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def publish_race(registry: SharedRegistry,
+                 race: Race,
+                 irradiance_raster: Optional[IrradianceRaster] = None) -> RaceHandle:
+    """
+    Put a race, its route, and its irradiance raster into shared memory.
+
+    :param registry: Registry that owns the shared memory.
+    :param race: Race to publish.
+    :param irradiance_raster: Precomputed solar altitude and irradiance along the route.
+
+    :return: Handle that workers attach to.
+    """
+    route = None
+    if race.route is not None:
+        points = race.route.points
+        route = RouteHandle(distances=registry.put_array('d', [p.race_distance for p in points]),
+                            lons=registry.put_array('d', [p.coordinate.lon for p in points]),
+                            lats=registry.put_array('d', [p.coordinate.lat for p in points]),
+                            race_length=race.route.race_length,
+                            route_name=race.route.name)
+
+    return RaceHandle(schedule=registry.put_object((race.distance_events, race.time_events, race.speed_limits)),
+                      route=route,
+                      irradiance_raster=registry.put_irradiance_raster(irradiance_raster)
+                      if irradiance_raster is not None else None)
@@ -6,19 +6,100 @@ __author__ = "Brett Duncan"
 __email__ = "dunca384@umn.edu"
 
 
+from array import array
 import copy
+import math
 from typing import Any, Callable, List, Optional, Tuple
 
+from core.array_model import get_array_power
 from core.car import Car
-from core.functions import charge_current_limit_lookup, get_target_speed
+from core.charging import find_horizon_crossing, integrate_stationary
+from core.drive_power import DrivePowerTable
+from core.irradiance import IrradianceRaster, get_cloud_factor
+from core.functions import charge_current_limit_lookup, get_next_speed_change, get_target_speed
 from core.physics import calculate_power_to_drive, calculate_air_density
-from core.objects import State, RaceActions
+from core.objects import CHARGING, NORMALIZED, RACE_HOURS, RACING, EndConditions, State, RaceActions
 from core.process_events import process_events
 from core.race import Race
 from core.sim_constants import *
+from core.state_log import StateLog
+from core.weather import GriddedWeather
 import core.sun as sun
 
 
+EULER = 'euler'
+RK2 = 'rk2'
+
+MODEL_CHUNK_SIZE = 32
+"""
+Number of steps vectorized models are evaluated for at a time.
+"""
+
+
+class _ModelChunk:
+    """
+    Sun and vectorized model values at the points the car will reach over the next
+    steps if its speed and the race state don't change.
+
+    The points are accumulated the same way the simulation advances the state, so a
+    step that goes as predicted finds its point exactly and any other step misses.
+    """
+
+    def __init__(self,
+                 wind_func: Optional[Callable],
+                 array_model: Optional[Callable],
+                 get_sun_altitude: Callable[[float, float], float],
+                 get_irradiance: Callable[[float, float, float], float],
+                 size: int = MODEL_CHUNK_SIZE):
+        self.wind_func = wind_func
+        self.array_model = array_model
+        self.get_sun_altitude = get_sun_altitude
+        self.get_irradiance = get_irradiance
+        self.size = size
+        self.distances = array('d', [math.nan]) * size
+        self.times = array('d', [math.nan]) * size
+        self.altitudes = array('d', bytes(8 * size))
+        self.irradiances = array('d', bytes(8 * size))
+        self.winds = array('d', bytes(8 * size))
+        self.array_powers = array('d', bytes(8 * size))
+        self.normalized = False
+        self.index = 0
+
+    def find(self, distance: float, time: float) -> int:
+        """
+        :return: Index of the point at this distance and time, or -1 if it wasn't predicted.
+        """
+        i = self.index
+        if self.distances[i] == distance and self.times[i] == time:
+            return i
+        i += 1
+        if i < self.size and self.distances[i] == distance and self.times[i] == time:
+            self.index = i
+            return i
+        return -1
+
+    def fill(self, distance: float, time: float, speed: float, step: float, normalized: bool) -> None:
+        """
+        Predict the next points from the current state and evaluate the models at them.
+        """
+        distances, times, altitudes, irradiances = self.distances, self.times, self.altitudes, self.irradiances
+        for i in range(self.size):
+            distances[i] = distance
+            times[i] = time
+            altitude = self.get_sun_altitude(distance, time)
+            altitudes[i] = altitude
+            irradiances[i] = self.get_irradiance(distance, time, altitude)
+            distance += speed * step
+            time += step
+
+        if self.wind_func is not None:
+            self.wind_func.batch(distances, times, self.winds)
+        if self.array_model is not None:
+            self.array_model.batch(irradiances, altitudes, normalized, self.array_powers)
+        self.normalized = normalized
+        self.index = 0
+
+
 def simulate(race: Race,
              car: Car,
              wind_func: Callable[[float, float], float],
@@ -30,18 +111,32 @@ def simulate(race: Race,
              target_speeds: List[Tuple[float, float]],
              checkpoint_time_remaining=0.0,
              vehicle_speed=0.0,
-             dt=1.0) -> Tuple[bool, State, List[Tuple]]:
+             dt=1.0,
+             stationary_integrator=False,
+             integrator=EULER,
+             weather: Optional[GriddedWeather] = None,
+             irradiance_raster: Optional[IrradianceRaster] = None,
+             drive_power_table=False,
+             log: Optional[StateLog] = None) -> Tuple[bool, State, StateLog]:
     """
     Simulate the race using the provided objects.
 
     :param race: The race to simulate.
     :param car: The car being raced.
     :param wind_func: Function that returns wind speed given distance
-    along the race route and time.
+    along the race route and time. Models with a true `vectorized` attribute also
+    have a `batch(distances, times, out)` method that fills `out` with the wind speed at
+    each point, which the EULER integrator calls for a chunk of upcoming steps at once.
+    Filling a chunk costs more than it saves unless the model is expensive to call, so
+    cheap models like `ConstantWind` should leave `vectorized` unset.
     :param array_model: Function modeling array power given irradiance,
-    solar altitude, and whether the array is normalized.
+    solar altitude, and whether the array is normalized. Models with a true
+    `uses_sun_azimuth` attribute are also passed `sun_azimuth` and `heading`
+    keyword arguments. Models with a true `vectorized` attribute also have a
+    `batch(irradiances, sun_altitudes, normalized, out)` method like wind models.
     :param end_simulation: Function that decides whether to end the
-    simulation given the current state.
+    simulation given the current state. EndConditions are checked by the
+    simulation itself instead of being called every step.
     :param battery_size: Battery size in Joules.
     :param state: State of the environment and the vehicle.
     :param race_state: State of the race.
@@ -49,26 +144,182 @@ def simulate(race: Race,
     :param checkpoint_time_remaining: Seconds remaining before being
     allowed to leave a checkpoint.
     :param vehicle_speed: The car's current speed.
+    :param dt: Time step in seconds.
+    :param stationary_integrator: Advance the car through stops outside of race hours
+    (overnight and at stage stops) in macro-steps using `integrate_stationary`
+    instead of one `dt` at a time. States are logged once per macro-step.
+    :param integrator: EULER steps forward `dt` at a time using the power at the
+    start of each step. RK2 averages the power at both ends of each step (Heun's
+    method) and cuts steps short to land exactly on race events, speed changes,
+    the end of checkpoint stops, sunrise/sunset, and the SOC running out (the
+    EndConditions' `min_soc`, 0 for other end conditions), which allows a much larger `dt`.
+    :param weather: Gridded forecast to take the wind, temperature, humidity, air
+    density, and cloud cover from. When this is provided `wind_func` isn't used, and
+    the clear-sky irradiance is scaled by `get_cloud_factor` unless `irradiance_raster`
+    is provided too.
+    :param irradiance_raster: Precomputed solar altitude and irradiance along the route.
+    When this is provided the sun's position isn't calculated during the simulation,
+    and the irradiance is taken as is: cloud cover only applies if the raster was
+    built with `build_irradiance_raster(weather=...)`.
+    :param drive_power_table: Look up the power to drive in the car's `DrivePowerTable`
+    instead of calling `calculate_power_to_drive`. The table is built the first time a
+    car is simulated and reused by later runs with the same car in the same process.
+    Off the table's nodes a full race ends within a few 1e-4 SOC of the analytic path,
+    but a run that runs out of charge can stop a few hundred meters earlier or later.
+    :param log: StateLog to log to, e.g. one with room for the whole race allocated up
+    front or one with a `max_bytes` budget that decimates or spills to disk instead of
+    growing past it. A new one is used by default. Its `peak_bytes` and `bytes_per_row`
+    (and `core.diagnostics.memory_report` across every log) report the memory it used.
 
     :return: Tuple containing whether or not the race could be completed (bool),
-    final state, and list containing state information.
+    final state, and StateLog of (State, array power, vehicle speed).
     """
 
     # Add the mass of the two passengers to the car
     car = car.copy_with(mass=car.mass+2*80.0)
 
-    state = copy.deepcopy(state)
+    # State only holds floats, so this is a full copy
+    state = copy.copy(state)
 
-    logged_states = [(copy.copy(state), 0.0, 0.0)]
+    logged_states = log if log is not None else StateLog()
+    logged_states.append(state, 0.0, 0.0)
 
     battery_esr = car.battery.cell_esr * \
         (car.battery.cells_in_series / car.battery.cells_in_parallel)  # <ohm>
 
-    distance_queue = copy.deepcopy(race.distance_events)
-    time_queue = copy.deepcopy(race.time_events)
+    # Events are immutable, so only the queues need copying
+    distance_queue = list(race.distance_events)
+    time_queue = list(race.time_events)
 
     total_grid_energy = 0.0  # <J>
 
+    weather_cursor = weather.cursor(race) if weather is not None else None
+
+    # Array models like MultiFacetArray also need to know where the sun is relative to the car
+    array_uses_sun_azimuth = getattr(array_model, 'uses_sun_azimuth', False)
+
+    # The table is for the car with passengers, so build it after they're added
+    drive_power = DrivePowerTable.for_car(car) if drive_power_table else None
+
+    # Air density only changes with real weather
+    temperature, humidity = 30.0, 0.3
+    default_rho = calculate_air_density(
+        temperature=temperature, altitude=0.0, humidity=humidity)  # <kg/m^3>
+
+    def get_sun_altitude(distance: float, time: float) -> float:
+        if irradiance_raster is not None:
+            return irradiance_raster.altitude(distance, time)
+        lat, lon = race.get_location(distance)  # figure out where we are
+        sun_altitude, _ = sun.get_sun_position(time, lon, lat)
+        return sun_altitude
+
+    def get_irradiance(distance: float, time: float, sun_altitude: float) -> float:
+        if irradiance_raster is not None:
+            return irradiance_raster.irradiance(distance, time)
+        return sun.get_sun_power(sun_altitude)
+
+    # Vectorized models are evaluated a chunk of steps at a time. RK2 steps vary in
+    # length and are few enough that it isn't worth it.
+    chunk = None
+    if integrator == EULER:
+        vector_wind = weather_cursor is None and getattr(wind_func, 'vectorized', False)
+        # Cloud cover scales the irradiance after the chunk is filled
+        clouds = weather_cursor is not None and irradiance_raster is None
+        vector_array = not array_uses_sun_azimuth and not clouds and getattr(array_model, 'vectorized', False)
+        if vector_wind or vector_array:
+            chunk = _ModelChunk(wind_func if vector_wind else None,
+                                array_model if vector_array else None,
+                                get_sun_altitude, get_irradiance)
+
+    def get_net_power(distance: float, time: float, soc: float, sun_altitude: float) -> Tuple[float, float, float]:
+        """
+        Calculate the power going into the battery at the given point in the race.
+
+        :return: Tuple of net power into the battery after ESR losses, array power,
+        and grid power, all in watts.
+        """
+
+        """
+        Begin Construction Zone
+
+        This is the code that needs to be modified to really bring everything together.
+        The other important change to make is the ability of the `Race` class to load .kml files.
+        """
+
+        # TODO: calculate this based on where you are along the route
+        angle = 0.0
+
+        i = -1
+        if chunk is not None:
+            i = chunk.find(distance, time)
+            if i < 0 or chunk.normalized != race_state.normalized:
+                chunk.fill(distance, time, vehicle_speed, dt, race_state.normalized)
+                i = 0
+
+        if i >= 0:
+            irradiance = chunk.irradiances[i]
+        else:
+            irradiance = get_irradiance(distance, time, sun_altitude)
+
+        if weather_cursor is not None:
+            wind, _, _, rho, cloud_cover = weather_cursor.sample(distance, time)
+            # A raster already has whatever cloud cover it was built with
+            if irradiance_raster is None:
+                irradiance *= get_cloud_factor(cloud_cover)
+        else:
+            wind = chunk.winds[i] if i >= 0 and chunk.wind_func is not None else wind_func(distance, time)
+            rho = default_rho  # <kg/m^3>
+
+        """
+        End Construction Zone
+        """
+
+        if drive_power is not None:
+            ptd = drive_power(vehicle_speed, wind_speed=wind, angle=angle, rho=rho, soc=soc)
+        else:
+            ptd = calculate_power_to_drive(
+                car, vehicle_speed, wind_speed=wind, angle=angle, rho=rho, soc=soc)
+
+        # Charging Calculations
+
+        cell_voltage = car.battery.estimate_cell_voltage_from_soc(soc)
+        battery_voltage = cell_voltage * car.battery.cells_in_series
+
+        max_grid_dc_current = charge_current_limit_lookup(cell_voltage)
+        dc_grid_current = min((AC_CHARGE_CURRENT * AC_CHARGE_VOLTAGE *
+                              car.charger_efficiency) / battery_voltage, max_grid_dc_current)
+        grid_power = dc_grid_current * battery_voltage if grid_charging else 0.0
+
+        if i >= 0 and chunk.array_model is not None and sun_altitude > 0.0:
+            array_power = chunk.array_powers[i]
+        else:
+            array_power = get_array_power(array_model, race, distance, time, irradiance, sun_altitude,
+                                          race_state.normalized, irradiance_raster)
+
+        # Battery Calculations
+
+        # Calculate the amount of power the battery is receiving
+        # (negative = power out, positive = power in)
+        battery_power = grid_power + array_power - ptd - car.idle_power_loss
+
+        # Use the pack voltage to calculate the current in/out of the battery
+        battery_current = battery_power / battery_voltage  # <A>
+
+        # Use the Equivalent Series Resistance (ESR) and
+        # current to calculate the battery power losses
+        battery_losses = battery_current**2 * battery_esr  # <W>
+
+        # Subtract losses from the power the battery is providing
+        # to the rest of the car to calculate the net power
+        return battery_power - battery_losses, array_power, grid_power
+
+    end_conditions = end_simulation if isinstance(end_simulation, EndConditions) else None
+    min_soc = 0.0
+    if end_conditions is not None:
+        finish_distance = end_conditions.finish_distance
+        latest_time = end_conditions.end_time
+        min_soc = end_conditions.min_soc
+
     while True:
 
         maybe: Optional[Tuple[RaceActions, float]] = process_events(distance_queue=distance_queue,
@@ -85,38 +336,34 @@ def simulate(race: Race,
 
         grid_charging = race_state.grid_charging and state.soc < 1.0
 
-        simulation_end_reason = end_simulation(state)
-
-        if simulation_end_reason is not None:
-            return simulation_end_reason, state, logged_states
+        if end_conditions is not None:
+            if state.soc <= min_soc or state.time > latest_time:
+                return False, state, logged_states
+            if state.distance >= finish_distance:
+                return True, state, logged_states
+        else:
+            simulation_end_reason = end_simulation(state)
 
-        lat, lon = race.get_location(state.distance)  # figure out where we are
+            if simulation_end_reason is not None:
+                return simulation_end_reason, state, logged_states
 
-        sun_altitude, _ = sun.get_sun_position(state.time, lon, lat)
+        i = chunk.find(state.distance, state.time) if chunk is not None else -1
+        sun_altitude = chunk.altitudes[i] if i >= 0 else get_sun_altitude(state.distance, state.time)
 
         # is this all we need for determining if the car is on?
         car_is_on = sun_altitude > 0.0 or grid_charging
 
-        if checkpoint_time_remaining > 0.0 and race_state.race_hours:
+        serving_checkpoint = checkpoint_time_remaining > 0.0 and race_state.race_hours
+
+        if serving_checkpoint:
             # print('stopping at checkpoint')
             # Don't allow driving if we have time to serve at the checkpoint
-            race_state = RaceActions(clock_running=False,
-                                     charging=race_state.charging,
-                                     driving=False,
-                                     normalized=race_state.normalized,
-                                     grid_charging=False,
-                                     race_hours=True)
-            checkpoint_time_remaining -= dt
+            race_state = RaceActions.from_mode((race_state.mode & (CHARGING | NORMALIZED)) | RACE_HOURS)
             # print('waiting')
         elif race_state.race_hours:
             # Go ahead and resume driving if it is during race hours and
             # there is no more checkpoint time to serve
-            race_state = RaceActions(clock_running=True,
-                                     charging=True,
-                                     driving=True,
-                                     normalized=False,
-                                     grid_charging=False,
-                                     race_hours=True)
+            race_state = RACING
 
         # Determine the speed limit given the car's current location
         speed_limit = race.determine_speed_limit(state.distance)
@@ -128,63 +375,80 @@ def simulate(race: Race,
         prev_speed = vehicle_speed
         vehicle_speed = target_speed if race_state.driving else 0.0
 
-        if car_is_on:
-
-            """
-            Begin Construction Zone
-
-            This is the code that needs to be modified to really bring everything together.
-            The other important change to make is the ability of the `Race` class to load .kml files.
-            """
-
-            # TODO: calculate this based on where you are along the route
-            angle = 0.0
-            altitude = 0.0
-
-            # TODO: use the irradiance func instead of calculating power from the sun
-            # irradiance = irradiance_func(state.distance, state.time)
-            irradiance = sun.get_sun_power(sun_altitude)
-
-            # TODO: use weather_func to use real weather
-            wind = wind_func(state.distance, state.time)
-            temperature, humidity = 30.0, 0.3
-
-            """
-            End Construction Zone
-            """
-
-            rho = calculate_air_density(
-                temperature=temperature, altitude=altitude, humidity=humidity)  # <kg/m^3>
-
-            ptd = calculate_power_to_drive(
-                car, vehicle_speed, wind_speed=wind, angle=angle, rho=rho, soc=state.soc)
-
-            # Charging Calculations
-
-            cell_voltage = car.battery.estimate_cell_voltage_from_soc(
-                state.soc)
-            battery_voltage = cell_voltage * car.battery.cells_in_series
-
-            max_grid_dc_current = charge_current_limit_lookup(cell_voltage)
-            dc_grid_current = min((AC_CHARGE_CURRENT * AC_CHARGE_VOLTAGE *
-                                  car.charger_efficiency) / battery_voltage, max_grid_dc_current)
-            grid_power = dc_grid_current * battery_voltage if grid_charging else 0.0
+        if stationary_integrator and not race_state.race_hours and time_queue \
+                and vehicle_speed == 0.0 and prev_speed == 0.0:
+            # Nothing happens until the next time event other than charging, so
+            # skip ahead instead of stepping through the night one dt at a time
+            step, delta_energy, grid_energy, array_power = integrate_stationary(
+                race, car, array_model, state.distance, state.time, state.soc,
+                battery_size, battery_esr, race_state.grid_charging,
+                race_state.normalized, time_queue[0].time,
+                irradiance_raster=irradiance_raster, weather_cursor=weather_cursor)
+
+            state.energy += delta_energy
+            state.soc = state.energy / battery_size
+            total_grid_energy += grid_energy
+            state.time += step
+
+            if car_is_on:
+                logged_states.append(state, array_power, 0.0)
+
+            continue
+
+        step = dt
+
+        # When these are set the step was cut short to land exactly on an event
+        next_distance = None
+        next_time = None
+
+        if integrator == RK2:
+            if time_queue and time_queue[0].time - state.time <= step:
+                step = time_queue[0].time - state.time
+                next_time = time_queue[0].time
+
+            if serving_checkpoint and checkpoint_time_remaining < step:
+                step = checkpoint_time_remaining
+                next_time = None
+
+            if vehicle_speed > 0.0 and car_is_on:
+                upcoming = get_next_speed_change(
+                    target_speeds, race.speed_limits, state.distance)
+                if distance_queue:
+                    upcoming = min(upcoming, distance_queue[0].distance)
+                if upcoming - state.distance < vehicle_speed * step:
+                    step = (upcoming - state.distance) / vehicle_speed
+                    next_distance = upcoming
+                    next_time = None
+
+            # The car turns on and off with the sun, so stop where it crosses the horizon
+            end_altitude = get_sun_altitude(state.distance, state.time + step)
+            if (end_altitude > 0.0) != (sun_altitude > 0.0):
+                step = find_horizon_crossing(state.time, state.time + step,
+                                             lambda t: get_sun_altitude(state.distance, t) > 0.0) - state.time
+                next_distance = None
+                next_time = None
+
+        if serving_checkpoint:
+            checkpoint_time_remaining -= step
 
-            array_power = array_model(
-                irradiance, sun_altitude, race_state.normalized) if sun_altitude > 0.0 else 0.0
+        if car_is_on:
+            net_power, array_power, grid_power = get_net_power(
+                state.distance, state.time, state.soc, sun_altitude)
 
-            # Battery Calculations
+            if integrator == RK2:
+                # Heun's method: average the net power at the start of the step
+                # with the net power at the predicted end of the step
+                end_distance = state.distance + vehicle_speed * step
+                end_time = state.time + step
+                end_soc = (state.energy + net_power * step) / battery_size
 
-            # Calculate the amount of power the battery is receiving
-            # (negative = power out, positive = power in)
-            battery_power = grid_power + array_power - ptd - car.idle_power_loss
+                end_altitude = get_sun_altitude(end_distance, end_time)
 
-            # Use the pack voltage to calculate the current in/out of the battery
-            battery_current = battery_power / battery_voltage  # <A>
+                end_net_power, array_power, end_grid_power = get_net_power(
+                    end_distance, end_time, end_soc, end_altitude)
 
-            # Use the Equivalent Series Resistance (ESR) and
-            # current to calculate the battery power losses
-            battery_losses = battery_current**2 * battery_esr  # <W>
+                net_power = 0.5 * (net_power + end_net_power)
+                grid_power = 0.5 * (grid_power + end_grid_power)
 
             # Calculate the change in kinetic energy from changing speeds
             # Calculate this assuming that on regen we only recover some
@@ -196,25 +460,45 @@ def simulate(race: Race,
                 delta_energy = 0.5 * car.mass * \
                     (vehicle_speed - prev_speed)**2 * REGEN_FACTOR
 
-            # Finish Up
+            # Stop where the battery runs out instead of up to a whole step past it,
+            # with the power still averaged over the full step
+            ran_out = False
+            if integrator == RK2 and net_power < 0.0:
+                min_energy = min_soc * battery_size
+                if state.energy > min_energy >= state.energy + net_power * step - delta_energy:
+                    shortened = max((state.energy - delta_energy - min_energy) / -net_power, 0.0)
+                    if serving_checkpoint:
+                        checkpoint_time_remaining += step - shortened
+                    step = shortened
+                    next_distance = None
+                    next_time = None
+                    ran_out = True
 
-            # Subtract losses from the power the battery is providing
-            # to the rest of the car to calculate the net power
-            net_power = battery_power - battery_losses
+            # Finish Up
 
-            state.distance += vehicle_speed * dt
+            state.distance += vehicle_speed * step
 
-            state.energy += net_power * dt - delta_energy
+            state.energy += net_power * step - delta_energy
 
             state.soc = state.energy / battery_size
+            if ran_out:
+                # Rounding mustn't leave the SOC just above the end condition
+                state.soc = min(state.soc, min_soc)
+
+            total_grid_energy += grid_power * step
 
-            total_grid_energy += grid_power * dt
+            state.time += step
 
-            state.time += dt
+            if next_distance is not None:
+                state.distance = next_distance
+            if next_time is not None:
+                state.time = next_time
 
-            logged_states.append(
-                (copy.copy(state), array_power, vehicle_speed))
+            logged_states.append(state, array_power, vehicle_speed)
 
         else:
             # Only increment the time if the car is not on
-            state.time += dt
+            state.time += step
+
+            if next_time is not None:
+                state.time = next_time
@@ -0,0 +1,94 @@
+"""
+Fixed-size streaming summaries for aggregating large numbers of simulations.
+"""
+
+__author__ = "Brett Duncan"
+__email__ = "dunca384@umn.edu"
+
+
+from array import array
+import math
+
+
+class HistogramSketch:
+    """
+    Streaming quantile sketch backed by a fixed-width histogram.
+
+    Memory use doesn't depend on how many values are added. Quantiles are exact to
+    within one bin width for values inside [low, high). Sketches with the same
+    bins can be merged, so workers can each build one and combine them.
+    """
+
+    def __init__(self, low: float, high: float, bins: int = 200):
+        if high <= low or bins < 1:
+            raise ValueError('HistogramSketch needs high > low and at least one bin.')
+        self.low = low
+        self.high = high
+        self.bins = bins
+        self.counts = array('q', bytes(8 * bins))
+        self.below = 0
+        self.above = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float) -> None:
+        """
+        Add a value to the sketch.
+        """
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+        if value < self.low:
+            self.below += 1
+        elif value >= self.high:
+            self.above += 1
+        else:
+            self.counts[int((value - self.low) / (self.high - self.low) * self.bins)] += 1
+
+    def merge(self, other: 'HistogramSketch') -> None:
+        """
+        Add all of the values from another sketch with the same bins.
+        """
+        if (self.low, self.high, self.bins) != (other.low, other.high, other.bins):
+            raise ValueError('Only sketches with the same bins can be merged.')
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.below += other.below
+        self.above += other.above
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else math.nan
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile by interpolating inside the bin that contains it.
+
+        :param q: Quantile in [0.0, 1.0].
+
+        :return: Estimated value, or NaN if the sketch is empty.
+        """
+        if self.count == 0:
+            return math.nan
+
+        rank = q * self.count
+        if rank <= self.below:
+            return self.min
+
+        seen = self.below
+        width = (self.high - self.low) / self.bins
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= rank:
+                value = self.low + (i + (rank - seen) / c) * width
+                return min(max(value, self.min), self.max)
+            seen += c
+
+        return self.max
@@ -0,0 +1,365 @@
+"""
+Module containing the segment-wise target speed optimizer.
+"""
+
+__author__ = "Brett Duncan"
+__email__ = "dunca384@umn.edu"
+
+
+from dataclasses import dataclass
+import math
+from typing import Callable, Dict, List, Optional, Tuple
+
+from core.array_model import get_array_power
+from core.car import Car
+from core.functions import charge_current_limit_lookup, get_next_speed_change
+from core.irradiance import IrradianceRaster
+from core.objects import State, RaceActions
+from core.physics import calculate_power_to_drive, calculate_air_density
+from core.process_events import process_events
+from core.race import Race
+from core.sim_constants import *
+import core.sun as sun
+
+
+DEFAULT_SPEEDS = tuple(speed / 3.6 for speed in range(60, 105, 5))  # <m/s>
+
+
+@dataclass(frozen=True)
+class SpeedPlan:
+    """
+    Target speeds chosen by `optimize_target_speeds` and the outcome it predicts.
+    """
+    target_speeds: List[Tuple[float, float]]
+    finish_time: float  # <s> since the unix epoch
+    final_soc: float
+    min_soc: float
+
+
+@dataclass(frozen=True)
+class _Label:
+    """
+    Car at the start of a segment, before any events at that distance are handled.
+    """
+    distance: float  # <m>
+    time: float  # <s>
+    energy: float  # <J>
+    min_soc: float
+    race_state: RaceActions
+    checkpoint_time_remaining: float  # <s>
+    distance_index: int  # number of distance events already handled
+    time_index: int  # number of time events already handled
+    parent: Optional['_Label']
+    speed: float  # <m/s> target speed of the segment that ended here
+    vehicle_speed: float  # <m/s> speed the car was moving at when it got here
+
+
+class _SegmentModel:
+    """
+    Coarse model of driving one segment at a constant target speed.
+
+    Like `estimate_energy_budget` it steps through the race events in steps of up to
+    `max_step` seconds with the power taken at the middle of each step. The battery
+    voltage and ESR losses are taken from the SOC at the start of each step, and speed
+    changes cost the same kinetic energy they do in `simulate`.
+    """
+
+    def __init__(self,
+                 race: Race,
+                 car: Car,
+                 wind_speed: float,
+                 array_model: Callable,
+                 battery_size: float,
+                 reserve_soc: float,
+                 max_step: float,
+                 irradiance_raster: Optional[IrradianceRaster]):
+        self.race = race
+        self.car = car
+        self.wind_speed = wind_speed
+        self.array_model = array_model
+        self.battery_size = battery_size
+        self.reserve_soc = reserve_soc
+        self.max_step = max_step
+        self.irradiance_raster = irradiance_raster
+        self.end_time = race.time_events[-1].time
+        self.battery_esr = car.battery.cell_esr * \
+            (car.battery.cells_in_series / car.battery.cells_in_parallel)  # <ohm>
+        self.rho = calculate_air_density(temperature=30.0, altitude=0.0, humidity=0.3)
+        self.drive_power: Dict[Tuple[float, bool], float] = {}
+
+    def get_drive_power(self, speed: float, soc: float) -> float:
+        # Only the speed and which motor efficiency applies change the power to drive
+        key = (speed, soc > 0.2)
+        power = self.drive_power.get(key)
+        if power is None:
+            power = calculate_power_to_drive(self.car, speed, wind_speed=self.wind_speed, rho=self.rho, soc=soc)
+            self.drive_power[key] = power
+        return power
+
+    def get_sun(self, distance: float, time: float) -> Tuple[float, float]:
+        if self.irradiance_raster is not None:
+            return self.irradiance_raster.altitude(distance, time), self.irradiance_raster.irradiance(distance, time)
+        lat, lon = self.race.get_location(distance)
+        altitude, _ = sun.get_sun_position(time, lon, lat)
+        return altitude, sun.get_sun_power(altitude)
+
+    def drive(self, label: _Label, end_distance: float, target_speed: float) -> Optional[_Label]:
+        """
+        Drive from a label to `end_distance`.
+
+        :return: Label at `end_distance`, or None if the car missed a deadline, ran out
+        of time, or dropped below the reserve SOC.
+        """
+        race = self.race
+        car = self.car
+
+        distance_queue = list(race.distance_events[label.distance_index:])
+        time_queue = list(race.time_events[label.time_index:])
+        state = State(distance=label.distance, energy=label.energy,
+                      soc=label.energy / self.battery_size, time=label.time)
+        race_state = label.race_state
+        checkpoint_time_remaining = label.checkpoint_time_remaining
+        min_soc = label.min_soc
+        target_speeds = [(label.distance, target_speed)]
+        vehicle_speed = label.vehicle_speed
+
+        while state.distance < end_distance:
+
+            # Check deadlines here so infeasible branches are dropped without `process_events` printing
+            for event in distance_queue:
+                if event.distance > state.distance:
+                    break
+                if state.time > event.latest_arrival:
+                    return None
+
+            race_state, checkpoint_time_remaining = process_events(distance_queue=distance_queue,
+                                                                   time_queue=time_queue,
+                                                                   state=state,
+                                                                   race_state=race_state,
+                                                                   checkpoint_time_remaining=checkpoint_time_remaining)
+
+            driving = race_state.race_hours and checkpoint_time_remaining <= 0.0
+            normalized = race_state.normalized and not driving
+
+            speed = min(race.determine_speed_limit(state.distance), target_speed) if driving else 0.0
+
+            # Cut the step short at the next event so it is handled on time
+            h = self.max_step
+            if time_queue:
+                h = min(h, time_queue[0].time - state.time)
+            if checkpoint_time_remaining > 0.0 and race_state.race_hours:
+                h = min(h, checkpoint_time_remaining)
+            arrives = False
+            if speed > 0.0:
+                next_distance = min(end_distance,
+                                    get_next_speed_change(target_speeds, race.speed_limits, state.distance))
+                if distance_queue:
+                    next_distance = min(next_distance, distance_queue[0].distance)
+                if (next_distance - state.distance) / speed <= h:
+                    h = (next_distance - state.distance) / speed
+                    arrives = True
+            h = max(h, 1.0) if not arrives else h
+
+            middle_distance = state.distance + 0.5 * speed * h
+            sun_altitude, irradiance = self.get_sun(middle_distance, state.time + 0.5 * h)
+
+            grid_charging = race_state.grid_charging and state.soc < 1.0
+
+            power = 0.0
+            grid_power = 0.0
+            if sun_altitude > 0.0 or grid_charging:
+                array_power = get_array_power(self.array_model, race, middle_distance, state.time + 0.5 * h,
+                                              irradiance, sun_altitude, normalized, self.irradiance_raster)
+
+                cell_voltage = car.battery.estimate_cell_voltage_from_soc(state.soc)
+                battery_voltage = cell_voltage * car.battery.cells_in_series
+
+                if grid_charging:
+                    grid_power = min(AC_CHARGE_CURRENT * AC_CHARGE_VOLTAGE * car.charger_efficiency,
+                                     charge_current_limit_lookup(cell_voltage) * battery_voltage)
+
+                ptd = self.get_drive_power(speed, state.soc) if speed > 0.0 else 0.0
+                power = array_power + grid_power - ptd - car.idle_power_loss
+                power -= (power / battery_voltage)**2 * self.battery_esr
+            else:
+                # The car is off, so it can't be driven either
+                speed = 0.0
+                arrives = False
+
+            # Same change in kinetic energy as `simulate`
+            if speed > vehicle_speed:
+                power -= 0.5 * car.mass * (speed - vehicle_speed)**2 / h
+            elif speed < vehicle_speed:
+                power -= 0.5 * car.mass * (speed - vehicle_speed)**2 * REGEN_FACTOR / h
+            vehicle_speed = speed
+
+            state.distance = next_distance if arrives else state.distance + speed * h
+            state.energy += power * h
+
+            # Grid charging stops once the pack is full
+            if grid_power > 0.0 and state.energy > self.battery_size:
+                state.energy -= min(state.energy - self.battery_size, grid_power * h)
+            state.soc = state.energy / self.battery_size
+            state.time += h
+
+            if driving:
+                checkpoint_time_remaining = 0.0
+            elif race_state.race_hours:
+                checkpoint_time_remaining -= h
+
+            min_soc = min(min_soc, state.soc)
+            if state.soc < self.reserve_soc or state.time > self.end_time:
+                return None
+
+        return _Label(distance=end_distance,
+                      time=state.time,
+                      energy=state.energy,
+                      min_soc=min_soc,
+                      race_state=race_state,
+                      checkpoint_time_remaining=checkpoint_time_remaining,
+                      distance_index=len(race.distance_events) - len(distance_queue),
+                      time_index=len(race.time_events) - len(time_queue),
+                      parent=label,
+                      speed=target_speed,
+                      vehicle_speed=vehicle_speed)
+
+
+def optimize_target_speeds(race: Race,
+                           car: Car,
+                           array_model: Callable[[float, float, bool], float],
+                           battery_size: float,
+                           wind_speed: float = 0.0,
+                           speeds: Tuple[float, ...] = DEFAULT_SPEEDS,
+                           segment_length: float = 50e3,
+                           reserve_soc: float = 0.0,
+                           soc_bins: int = 40,
+                           max_step: float = 600.0,
+                           irradiance_raster: Optional[IrradianceRaster] = None,
+                           state: Optional[State] = None,
+                           race_state: Optional[RaceActions] = None,
+                           checkpoint_time_remaining: float = 0.0,
+                           vehicle_speed: float = 0.0) -> Optional[SpeedPlan]:
+    """
+    Choose a target speed for each segment of the route to finish as early as possible.
+
+    The route is split into segments at every stop and every `segment_length` meters in
+    between. Dynamic programming walks the segments in order, keeping for every SOC bin
+    the earliest time the car can reach the end of the segment (and the most energy
+    among ties), and drops bins that a higher SOC bin reaches no later. Each transition
+    drives the segment at one of `speeds` with a coarse model of the race schedule, so
+    the overnight stops, stage stops, and grid charging windows are all included. Plans
+    that miss a stop's latest arrival or drop below `reserve_soc` are discarded.
+
+    The segment model is coarser than `simulate` (it agrees to within about 0.005 SOC at
+    a constant speed on WSC), so check the plan with it and keep some `reserve_soc`.
+
+    :param race: Race to plan.
+    :param car: Car being raced (without the passengers).
+    :param array_model: Array model with the same signature `simulate` uses.
+    :param battery_size: Battery size in Joules.
+    :param wind_speed: Constant wind speed in the direction of travel in m/s.
+    :param speeds: Target speeds to choose between in m/s.
+    :param segment_length: Longest segment in meters.
+    :param reserve_soc: Lowest SOC the plan may reach.
+    :param soc_bins: Number of SOC bins between 0 and 1.
+    :param max_step: Longest step taken inside a segment in seconds.
+    :param irradiance_raster: Precomputed solar altitude and irradiance along the route.
+    :param state: State to plan from (defaults to the start of the race with a full battery).
+    Distance events before the state's distance and time events up to its time are
+    taken as already handled.
+    :param race_state: Race actions at `state` (required along with `state`).
+    :param checkpoint_time_remaining: Time remaining at the current checkpoint.
+    :param vehicle_speed: The car's current speed.
+
+    :return: SpeedPlan, or None if no combination of speeds finishes.
+    """
+
+    # Match the passengers that `simulate` adds
+    car = car.copy_with(mass=car.mass+2*80.0)
+
+    model = _SegmentModel(race, car, wind_speed, array_model, battery_size,
+                          reserve_soc, max_step, irradiance_raster)
+
+    if state is None:
+        state = State(distance=0.0, energy=battery_size, soc=1.0, time=race.time_events[0].time)
+        race_state = RaceActions(clock_running=False,
+                                 charging=False,
+                                 driving=False,
+                                 normalized=False,
+                                 grid_charging=False,
+                                 race_hours=False)
+        distance_index, time_index = 0, 0
+    else:
+        if race_state is None:
+            raise ValueError('`race_state` is required when planning from a `state`')
+        distance_index = sum(1 for event in race.distance_events if event.distance <= state.distance)
+        time_index = sum(1 for event in race.time_events if event.time <= state.time)
+
+    start = _Label(distance=state.distance,
+                   time=state.time,
+                   energy=state.energy,
+                   min_soc=state.energy / battery_size,
+                   race_state=race_state,
+                   checkpoint_time_remaining=checkpoint_time_remaining,
+                   distance_index=distance_index,
+                   time_index=time_index,
+                   parent=None,
+                   speed=math.nan,
+                   vehicle_speed=vehicle_speed)
+
+    finish_distance = race.distance_events[-1].distance
+    boundaries = {event.distance for event in race.distance_events}
+    boundaries.update(segment_length * i for i in range(1, math.ceil(finish_distance / segment_length)))
+    boundaries = sorted(d for d in boundaries if state.distance < d <= finish_distance)
+
+    labels = [start]
+    for end_distance in boundaries:
+        best: Dict[int, _Label] = {}
+        for label in labels:
+            for target_speed in speeds:
+                reached = model.drive(label, end_distance, target_speed)
+                if reached is None:
+                    continue
+                soc_bin = min(max(int(reached.energy / battery_size * soc_bins), 0), soc_bins)
+                current = best.get(soc_bin)
+                if current is None or (reached.time, -reached.energy) < (current.time, -current.energy):
+                    best[soc_bin] = reached
+
+        # Drop labels that a label with more charge reaches no later
+        labels = []
+        earliest = math.inf
+        for soc_bin in sorted(best, reverse=True):
+            if best[soc_bin].time < earliest:
+                labels.append(best[soc_bin])
+                earliest = best[soc_bin].time
+
+        if not labels:
+            return None
+
+    # The finish hasn't been handled yet, so check its deadline here
+    labels = [label for label in labels
+              if all(label.time <= event.latest_arrival
+                     for event in race.distance_events[label.distance_index:]
+                     if event.distance <= label.distance)]
+    if not labels:
+        return None
+
+    end = min(labels, key=lambda label: (label.time, -label.energy))
+
+    segments = []
+    label = end
+    while label.parent is not None:
+        segments.append((label.parent.distance, label.speed))
+        label = label.parent
+    segments.reverse()
+
+    # Merge neighboring segments with the same speed
+    target_speeds = []
+    for distance, target_speed in segments:
+        if not target_speeds or target_speeds[-1][1] != target_speed:
+            target_speeds.append((distance, target_speed))
+
+    return SpeedPlan(target_speeds=target_speeds,
+                     finish_time=end.time,
+                     final_soc=end.energy / battery_size,
+                     min_soc=end.min_soc)
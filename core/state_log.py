@@ -0,0 +1,266 @@
+"""
+Module containing the StateLog class.
+"""
+
+__author__ = "Brett Duncan"
+__email__ = "dunca384@umn.edu"
+
+
+from array import array
+import operator
+import tempfile
+from typing import BinaryIO, List, Optional, Sequence, Tuple
+import weakref
+
+from core.objects import State
+
+
+CHUNK_SIZE = 256
+"""
+Rows per chunk. Row numbers within a chunk are small ints, which CPython doesn't allocate.
+"""
+
+_ROW_NUMBERS = tuple(range(CHUNK_SIZE))
+
+COLUMNS = ('distance', 'energy', 'soc', 'time', 'array_power', 'vehicle_speed')
+
+CHUNK_BYTES = len(COLUMNS) * 8 * CHUNK_SIZE
+
+DECIMATE = 'decimate'
+"""
+Overflow policy that halves the logging resolution every time the log runs out of budget.
+"""
+
+SPILL = 'spill'
+"""
+Overflow policy that moves the oldest rows to a file every time the log runs out of budget.
+"""
+
+_live_logs = weakref.WeakSet()
+
+
+def live_logs() -> List['StateLog']:
+    """
+    :return: Every StateLog in this process that hasn't been garbage collected.
+    """
+    return list(_live_logs)
+
+
+class StateLog(Sequence):
+    """
+    Log of the simulation as (State, array power, vehicle speed) rows.
+
+    Rows are copied into columns of doubles in fixed-size chunks instead of keeping a
+    State object per row, so logging a step doesn't allocate anything until a chunk
+    fills up. Reading a row builds a new State.
+
+    A log with a `max_bytes` budget never holds more than that in memory. When it's full,
+    the DECIMATE policy drops every other row and from then on only logs every other
+    step (so `stride` doubles each time), which makes the minimum SOC and the arrival
+    at each stop only as exact as the stride. The SPILL policy keeps every row by writing
+    the oldest chunk to a file and reading it back from there when it's asked for.
+    """
+
+    def __init__(self,
+                 capacity: int = 0,
+                 max_bytes: Optional[int] = None,
+                 overflow: str = DECIMATE,
+                 spill_path: Optional[str] = None):
+        """
+        :param capacity: Number of rows to allocate up front.
+        :param max_bytes: Most bytes of rows to keep in memory, or None for no limit.
+        :param overflow: DECIMATE or SPILL, what to do when `max_bytes` is reached.
+        :param spill_path: File to spill rows to (a temporary file by default).
+        """
+        if overflow not in (DECIMATE, SPILL):
+            raise ValueError(f'Unknown overflow policy {overflow!r}')
+        if max_bytes is not None and max_bytes < 2 * CHUNK_BYTES:
+            raise ValueError(f'max_bytes has to be at least {2 * CHUNK_BYTES} (two chunks)')
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.spill_path = spill_path
+
+        if max_bytes is not None:
+            capacity = min(capacity, max_bytes // CHUNK_BYTES * CHUNK_SIZE)
+
+        # Every chunk in memory in order, with the preallocated ones that haven't been used yet at the end
+        self._chunks: List[Tuple[array, ...]] = []
+        for _ in range(-(-capacity // CHUNK_SIZE)):
+            self._chunks.append(self._new_chunk())
+        # Unused preallocated chunks along with iterators over their row numbers
+        self._spare = iter([(chunk, iter(_ROW_NUMBERS)) for chunk in self._chunks])
+        self._chunk = None
+        self._rows = iter(())  # free row numbers in the current chunk
+
+        # Logging every `_stride`th step, `_skipped` steps since the last one that was logged
+        self._stride = 1.0
+        self._skipped = 0.0
+
+        # Chunks before the ones in memory, written to `_spill_file` in order
+        self._spilled = 0
+        self._spill_file: Optional[BinaryIO] = None
+        self._loaded: Tuple[int, Optional[Tuple[array, ...]]] = (-1, None)  # last spilled chunk read back
+
+        self.peak_bytes = self.size_in_bytes
+        _live_logs.add(self)
+
+    @staticmethod
+    def _new_chunk() -> Tuple[array, ...]:
+        return tuple(array('d', bytes(8 * CHUNK_SIZE)) for _ in COLUMNS)
+
+    def _next_chunk(self) -> None:
+        spare = next(self._spare, None)
+        if spare is not None:
+            self._chunk, self._rows = spare
+        elif self.max_bytes is not None and self.size_in_bytes + CHUNK_BYTES > self.max_bytes:
+            if self.overflow == SPILL:
+                self._spill_oldest()
+            else:
+                self._decimate()
+        else:
+            self._chunk = self._new_chunk()
+            self._chunks.append(self._chunk)
+            self._rows = iter(_ROW_NUMBERS)
+            self.peak_bytes = max(self.peak_bytes, self.size_in_bytes)
+
+    def _spill_oldest(self) -> None:
+        # Every chunk in memory is full, so the oldest one is written out and reused
+        if self._spill_file is None:
+            self._spill_file = open(self.spill_path, 'w+b') if self.spill_path is not None \
+                else tempfile.TemporaryFile()
+        chunk = self._chunks.pop(0)
+        self._spill_file.seek(self._spilled * CHUNK_BYTES)
+        for column in chunk:
+            self._spill_file.write(column)
+        self._spilled += 1
+        self._chunks.append(chunk)
+        self._chunk = chunk
+        self._rows = iter(_ROW_NUMBERS)
+
+    def _decimate(self) -> None:
+        # Every chunk in memory is full, so keeping every other row frees half of them
+        kept = len(self._chunks) * CHUNK_SIZE // 2
+        for column in range(len(COLUMNS)):
+            values = array('d')
+            for chunk in self._chunks:
+                values.extend(chunk[column][::2])
+            for start in range(0, len(values), CHUNK_SIZE):
+                kept_rows = values[start:start + CHUNK_SIZE]
+                self._chunks[start // CHUNK_SIZE][column][:len(kept_rows)] = kept_rows
+
+        current, row = divmod(kept, CHUNK_SIZE)
+        self._chunk = self._chunks[current]
+        self._rows = iter(_ROW_NUMBERS[row:])
+        self._spare = iter([(chunk, iter(_ROW_NUMBERS)) for chunk in self._chunks[current + 1:]])
+        self._stride *= 2.0
+        self._skipped = 0.0
+
+    def append(self, state: State, array_power: float, vehicle_speed: float) -> None:
+        """
+        Log a copy of a state.
+        """
+        if self._stride != 1.0:
+            self._skipped += 1.0
+            if self._skipped < self._stride:
+                return
+            self._skipped = 0.0
+        row = next(self._rows, None)
+        if row is None:
+            self._next_chunk()
+            row = next(self._rows)
+        chunk = self._chunk
+        chunk[0][row] = state.distance
+        chunk[1][row] = state.energy
+        chunk[2][row] = state.soc
+        chunk[3][row] = state.time
+        chunk[4][row] = array_power
+        chunk[5][row] = vehicle_speed
+
+    def __len__(self) -> int:
+        if self._chunk is None:
+            return 0
+        used = self._spilled + len(self._chunks) - operator.length_hint(self._spare)
+        return used * CHUNK_SIZE - operator.length_hint(self._rows)
+
+    def _chunk_at(self, index: int) -> Tuple[array, ...]:
+        if index >= self._spilled:
+            return self._chunks[index - self._spilled]
+        if self._loaded[0] != index:
+            self._spill_file.seek(index * CHUNK_BYTES)
+            chunk = self._new_chunk()
+            for column in chunk:
+                self._spill_file.readinto(column)
+            self._loaded = (index, chunk)
+        return self._loaded[1]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError('StateLog index out of range')
+
+        chunk = self._chunk_at(index // CHUNK_SIZE)
+        row = index % CHUNK_SIZE
+        return (State(distance=chunk[0][row], energy=chunk[1][row], soc=chunk[2][row], time=chunk[3][row]),
+                chunk[4][row], chunk[5][row])
+
+    def __iter__(self):
+        remaining = len(self)
+        index = 0
+        while remaining > 0:
+            chunk = self._chunk_at(index)
+            for row in range(min(remaining, CHUNK_SIZE)):
+                yield (State(distance=chunk[0][row], energy=chunk[1][row], soc=chunk[2][row], time=chunk[3][row]),
+                       chunk[4][row], chunk[5][row])
+            remaining -= CHUNK_SIZE
+            index += 1
+
+    def column(self, name: str) -> List[float]:
+        """
+        :return: Every logged value of one of COLUMNS without building States.
+        """
+        column = COLUMNS.index(name)
+        values = []
+        for index in range(self._spilled + len(self._chunks)):
+            values.extend(self._chunk_at(index)[column])
+        del values[len(self):]
+        return values
+
+    @property
+    def stride(self) -> int:
+        """
+        :return: Number of steps per logged row, more than 1 once the log has been decimated.
+        """
+        return int(self._stride)
+
+    @property
+    def size_in_bytes(self) -> int:
+        """
+        :return: Bytes allocated in memory for rows, including unused rows in the last chunk.
+        """
+        return len(self._chunks) * CHUNK_BYTES
+
+    @property
+    def spilled_bytes(self) -> int:
+        """
+        :return: Bytes of rows written to the spill file.
+        """
+        return self._spilled * CHUNK_BYTES
+
+    @property
+    def bytes_per_row(self) -> float:
+        """
+        :return: Bytes in memory and on disk per logged row.
+        """
+        return (self.size_in_bytes + self.spilled_bytes) / max(len(self), 1)
+
+    def close(self) -> None:
+        """
+        Close the spill file. Spilled rows can't be read afterwards.
+        """
+        if self._spill_file is not None:
+            self._spill_file.close()
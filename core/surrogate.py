@@ -0,0 +1,183 @@
+"""
+Cheap energy budget estimate used to screen scenarios before running `simulate`.
+"""
+
+__author__ = "Brett Duncan"
+__email__ = "dunca384@umn.edu"
+
+
+from dataclasses import dataclass
+from typing import Callable, List, Tuple
+
+from core.array_model import get_array_power
+from core.car import Car
+from core.functions import charge_current_limit_lookup, get_target_speed
+from core.objects import State, RaceActions
+from core.physics import calculate_power_to_drive
+from core.process_events import process_events
+from core.race import Race
+from core.sim_constants import *
+import core.sun as sun
+
+
+FINISH = 'finish'
+NO_FINISH = 'no-finish'
+UNCERTAIN = 'uncertain'
+
+UNCERTAINTY = 0.1
+"""
+Default half width of the SOC band around zero where the verdict is UNCERTAIN.
+
+The estimate ignores ESR losses and acceleration, so its minimum SOC is off from the
+simulated one. On the WSC race (14-30 m/s, array power factors 0.8-1.2) it was always
+pessimistic, by up to 0.082 SOC (22 m/s at 0.8 estimated -0.064 and simulated 0.018).
+That leaves less than 0.02 of slack in this band, so widen it for cars or races that
+are far from that one.
+"""
+
+
+@dataclass(frozen=True)
+class EnergyBudget:
+    """
+    Result of an energy budget estimate.
+    """
+    verdict: str  # FINISH, NO_FINISH, or UNCERTAIN
+    margin: float  # estimated minimum SOC, negative when the battery runs short
+    max_distance: float  # <m>
+    on_time: bool  # whether every stop was reached before its latest arrival
+
+
+def estimate_energy_budget(race: Race,
+                           car: Car,
+                           wind_speed: float,
+                           array_model: Callable[[float, float, bool], float],
+                           battery_size: float,
+                           target_speeds: List[Tuple[float, float]],
+                           uncertainty: float = UNCERTAINTY,
+                           dt: float = 600.0) -> EnergyBudget:
+    """
+    Estimate whether the car can finish the race from a coarse energy budget.
+
+    The race is walked in steps of up to `dt` seconds that are cut short at race
+    events, so the daily solar energy, drive energy, idle losses, and grid charging
+    are integrated with the midpoint rule instead of once per second. Battery ESR
+    losses and acceleration are ignored and the battery is allowed to go negative
+    so that the size of the shortfall is known.
+
+    :param race: The race to estimate.
+    :param car: The car being raced.
+    :param wind_speed: Constant wind speed in the direction of travel in m/s.
+    :param array_model: Array model with the same signature `simulate` uses.
+    :param battery_size: Battery size in Joules.
+    :param target_speeds: List of target speed tuples.
+    :param uncertainty: Half width of the SOC band around zero where the
+    verdict is UNCERTAIN, see UNCERTAINTY.
+    :param dt: Longest step to take in seconds.
+
+    :return: EnergyBudget containing the verdict and SOC margin.
+    """
+
+    # Match the passengers that `simulate` adds
+    car = car.copy_with(mass=car.mass+2*80.0)
+
+    distance_queue = list(race.distance_events)
+    time_queue = list(race.time_events)
+
+    race_state = RaceActions(clock_running=False,
+                             charging=False,
+                             driving=False,
+                             normalized=False,
+                             grid_charging=False,
+                             race_hours=False)
+    checkpoint_time_remaining = 0.0
+
+    state = State(distance=0.0, energy=battery_size, soc=1.0,
+                  time=race.time_events[0].time)
+    min_soc = 1.0
+    on_time = True
+
+    finish_distance = race.distance_events[-1].distance
+    end_time = race.time_events[-1].time
+
+    while state.distance < finish_distance and state.time <= end_time:
+
+        maybe = process_events(distance_queue=distance_queue,
+                               time_queue=time_queue,
+                               state=state,
+                               race_state=race_state,
+                               checkpoint_time_remaining=checkpoint_time_remaining)
+        if not maybe:
+            on_time = False
+            break
+        race_state, checkpoint_time_remaining = maybe
+
+        driving = race_state.race_hours and checkpoint_time_remaining <= 0.0
+        normalized = race_state.normalized and not driving
+
+        speed = 0.0
+        if driving:
+            speed = min(race.determine_speed_limit(state.distance),
+                        get_target_speed(target_speeds, state.distance))
+
+        # Cut the step short at the next event so it is handled on time
+        h = dt
+        if time_queue:
+            h = min(h, time_queue[0].time - state.time)
+        if checkpoint_time_remaining > 0.0 and race_state.race_hours:
+            h = min(h, checkpoint_time_remaining)
+        if speed > 0.0 and distance_queue:
+            h = min(h, (distance_queue[0].distance - state.distance) / speed)
+        h = max(h, 1.0)
+
+        lat, lon = race.get_location(state.distance + 0.5 * speed * h)
+        sun_altitude, _ = sun.get_sun_position(state.time + 0.5 * h, lon, lat)
+
+        grid_charging = race_state.grid_charging and state.soc < 1.0
+
+        power = 0.0
+        if sun_altitude > 0.0 or grid_charging:
+            array_power = get_array_power(array_model, race, state.distance + 0.5 * speed * h,
+                                          state.time + 0.5 * h, sun.get_sun_power(sun_altitude),
+                                          sun_altitude, normalized)
+
+            grid_power = 0.0
+            if grid_charging:
+                cell_voltage = car.battery.estimate_cell_voltage_from_soc(state.soc)
+                battery_voltage = cell_voltage * car.battery.cells_in_series
+                grid_power = min(AC_CHARGE_CURRENT * AC_CHARGE_VOLTAGE * car.charger_efficiency,
+                                 charge_current_limit_lookup(cell_voltage) * battery_voltage)
+
+            ptd = calculate_power_to_drive(car, speed, wind_speed=wind_speed,
+                                           soc=state.soc) if speed > 0.0 else 0.0
+
+            power = array_power + grid_power - ptd - car.idle_power_loss
+        else:
+            # The car is off, so it can't be driven either
+            speed = 0.0
+
+        state.distance += speed * h
+        state.energy += power * h
+        state.soc = state.energy / battery_size
+        state.time += h
+
+        if driving:
+            checkpoint_time_remaining = 0.0
+        elif race_state.race_hours:
+            checkpoint_time_remaining -= h
+
+        min_soc = min(min_soc, state.soc)
+
+    if state.distance < finish_distance:
+        on_time = False
+
+    if not on_time or min_soc < -uncertainty:
+        verdict = NO_FINISH
+    elif min_soc > uncertainty:
+        verdict = FINISH
+    else:
+        verdict = UNCERTAIN
+
+    return EnergyBudget(verdict=verdict,
+                        margin=min_soc,
+                        max_distance=min(state.distance, finish_distance),
+                        on_time=on_time)
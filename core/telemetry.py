@@ -0,0 +1,247 @@
+"""
+Streaming replay of logged telemetry against a simulation run.
+"""
+
+__author__ = "Brett Duncan"
+__email__ = "dunca384@umn.edu"
+
+
+import csv
+import math
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from core.objects import State
+from core.race import Race
+
+
+DEFAULT_COLUMNS = {
+    'time': 'time',
+    'lat': 'lat',
+    'lon': 'lon',
+    'distance': 'distance',
+    'soc': 'soc',
+    'speed': 'speed',
+    'array_power': 'array_power',
+}
+"""
+CSV column name for each telemetry field. Fields without a column in the file are NaN.
+"""
+
+CHANNELS = ('distance', 'soc', 'speed', 'array_power')
+
+
+class TelemetrySample(NamedTuple):
+    time: float  # <s> since the unix epoch
+    distance: float  # <m>
+    soc: float
+    speed: float  # <m/s>
+    array_power: float  # <W>
+
+
+class ResidualStats:
+    """
+    Running statistics of the residuals (actual - simulated) for one channel.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.max_abs = 0.0
+
+    def add(self, residual: float) -> None:
+        # Welford's algorithm so the variance doesn't need the residuals to be kept
+        self.count += 1
+        delta = residual - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (residual - self.mean)
+        self.max_abs = max(self.max_abs, abs(residual))
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else math.nan
+
+    @property
+    def rms(self) -> float:
+        return math.sqrt(self.mean**2 + self._m2 / self.count) if self.count else math.nan
+
+    def __repr__(self):
+        return f'<count: {self.count}, mean: {self.mean:.6g}, std: {self.std:.6g}, ' \
+               f'rms: {self.rms:.6g}, max abs: {self.max_abs:.6g}>'
+
+
+def read_telemetry(file_path: str,
+                   columns: Dict[str, str] = DEFAULT_COLUMNS,
+                   chunk_size: int = 10000) -> Iterator[List[Dict[str, float]]]:
+    """
+    Read a telemetry CSV log in chunks of rows.
+
+    :param file_path: Path of the CSV file (with a header row).
+    :param columns: CSV column name for each telemetry field.
+    :param chunk_size: Number of rows per chunk.
+
+    :return: Iterator of chunks, each a list of rows with a float (or NaN) for every field.
+    """
+    with open(file_path, newline='') as f:
+        reader = csv.DictReader(f)
+        chunk = []
+        for row in reader:
+            values = {}
+            for field, column in columns.items():
+                value = row.get(column)
+                values[field] = float(value) if value not in (None, '') else math.nan
+            chunk.append(values)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def map_match(chunks: Iterable[List[Dict[str, float]]],
+              race: Race,
+              window: float = 5000.0) -> Iterator[List[TelemetrySample]]:
+    """
+    Convert chunks of telemetry rows into samples with a distance along the route.
+
+    Rows that already have a distance keep it. Otherwise the GPS fixes in each chunk
+    are matched to the race's route in one batch with `RacePath.get_distances_from_points`,
+    searching around the previous match (carried over between chunks).
+
+    :param chunks: Chunks of rows from `read_telemetry`.
+    :param race: Race whose route the fixes are matched to.
+    :param window: Distance around the previous match to search in meters.
+
+    :return: Iterator of chunks of samples.
+    """
+    previous = None
+
+    for chunk in chunks:
+        unmatched = [i for i, row in enumerate(chunk)
+                     if math.isnan(row['distance']) and not math.isnan(row['lat']) and not math.isnan(row['lon'])]
+
+        distances = [row['distance'] for row in chunk]
+        if unmatched:
+            if race.route is None:
+                raise ValueError('Telemetry without a distance needs a race with a route to match GPS fixes to')
+
+            from core.race_path import Coordinate
+            matched = race.route.get_distances_from_points(
+                [Coordinate(lon=chunk[i]['lon'], lat=chunk[i]['lat']) for i in unmatched],
+                start_distance=previous, window=window)
+            for i, distance in zip(unmatched, matched):
+                distances[i] = distance
+
+        for distance in reversed(distances):
+            if not math.isnan(distance):
+                previous = distance
+                break
+
+        yield [TelemetrySample(time=row['time'],
+                               distance=distance,
+                               soc=row['soc'],
+                               speed=row['speed'],
+                               array_power=row['array_power'])
+               for row, distance in zip(chunk, distances)]
+
+
+def compare_to_simulation(samples: Iterable[List[TelemetrySample]],
+                          logged_states: List[Tuple],
+                          max_gap: float = 10.0,
+                          output_path: Optional[str] = None) -> Dict[str, ResidualStats]:
+    """
+    Resample telemetry onto the times of a simulation's logged states and accumulate the residuals.
+
+    Telemetry is linearly interpolated to each logged time that falls between two samples
+    no more than `max_gap` seconds apart. Both inputs have to be in time order, and only
+    the two telemetry samples around the current logged time are kept, so memory use
+    doesn't depend on the length of the log.
+
+    :param samples: Chunks of samples from `map_match`.
+    :param logged_states: Logged states from `simulate` as (State, array power, vehicle speed).
+    :param max_gap: Longest gap in the telemetry to interpolate across in seconds.
+    :param output_path: Path to write every residual to as CSV (not written when None).
+
+    :return: Dictionary of the residual statistics for each channel in CHANNELS.
+    """
+    stats = {channel: ResidualStats() for channel in CHANNELS}
+
+    output = open(output_path, 'w', newline='') if output_path is not None else None
+    writer = csv.writer(output) if output is not None else None
+    if writer is not None:
+        writer.writerow(('time',) + CHANNELS)
+
+    try:
+        index = 0
+        previous: Optional[TelemetrySample] = None
+
+        for chunk in samples:
+            for sample in chunk:
+                if previous is not None and sample.time < previous.time:
+                    raise ValueError(f'Telemetry is out of order at time {sample.time}')
+
+                # Every logged time up to the previous sample was handled with the previous sample
+                while index < len(logged_states) and logged_states[index][0].time <= sample.time:
+                    state, array_power, vehicle_speed = logged_states[index]
+                    index += 1
+
+                    if previous is None:
+                        # Only compare logged states from before the telemetry starts if they line up
+                        if state.time != sample.time:
+                            continue
+                        actual = sample
+                    elif sample.time - previous.time <= max_gap:
+                        f = (state.time - previous.time) / (sample.time - previous.time)
+                        actual = TelemetrySample(*(p + f * (c - p) for p, c in zip(previous, sample)))
+                    else:
+                        continue
+
+                    simulated = (state.distance, state.soc, vehicle_speed, array_power)
+                    residuals = [getattr(actual, channel) - value for channel, value in zip(CHANNELS, simulated)]
+                    for channel, residual in zip(CHANNELS, residuals):
+                        if not math.isnan(residual):
+                            stats[channel].add(residual)
+                    if writer is not None:
+                        writer.writerow([state.time] + residuals)
+
+                previous = sample
+    finally:
+        if output is not None:
+            output.close()
+
+    return stats
+
+
+def replay_telemetry(file_path: str,
+                     race: Race,
+                     logged_states: List[Tuple],
+                     columns: Dict[str, str] = DEFAULT_COLUMNS,
+                     chunk_size: int = 10000,
+                     window: float = 5000.0,
+                     max_gap: float = 10.0,
+                     output_path: Optional[str] = None,
+                     verbose: bool = True) -> Dict[str, ResidualStats]:
+    """
+    Stream a telemetry CSV log through map matching and compare it to a simulation run.
+
+    :param file_path: Path of the CSV file (with a header row).
+    :param race: Race the telemetry was logged on.
+    :param logged_states: Logged states from a `simulate` run of the same race.
+    :param columns: CSV column name for each telemetry field.
+    :param chunk_size: Number of rows read and map matched at a time.
+    :param window: Distance around the previous match to search in meters.
+    :param max_gap: Longest gap in the telemetry to interpolate across in seconds.
+    :param output_path: Path to write every residual to as CSV (not written when None).
+    :param verbose: Print the residual statistics.
+
+    :return: Dictionary of the residual statistics for each channel in CHANNELS.
+    """
+    chunks = read_telemetry(file_path, columns=columns, chunk_size=chunk_size)
+    stats = compare_to_simulation(map_match(chunks, race, window=window), logged_states,
+                                  max_gap=max_gap, output_path=output_path)
+
+    if verbose:
+        for channel, channel_stats in stats.items():
+            print(f'{channel:>12}: {channel_stats}')
+
+    return stats
@@ -6,7 +6,6 @@ __author__ = "Brett Duncan"
 __email__ = "dunca384@umn.edu"
 
 
-import time
 from datetime import datetime
 
 
@@ -18,18 +17,8 @@ def date(t: str) -> float:
 
     :return: seconds since unix epoch
     """
-    tz_agnostic = time.mktime(datetime.strptime(
-        t, "%Y-%m-%dT%H:%M:%S%z").timetuple())
-
-    sign = t[-6]
-    h_offset, m_offset = [int(x) for x in t[-5:].split(':')]
-    offset = (h_offset * 60 + m_offset) * 60
-    if sign == '+':
-        offset = -offset
-
-    tz_aware = tz_agnostic + offset
-
-    return tz_aware
+    # The string's own UTC offset is used, so the result doesn't depend on the local timezone
+    return datetime.strptime(t, "%Y-%m-%dT%H:%M:%S%z").timestamp()
 
 
 def distance(d: float, unit: str = 'm') -> float:
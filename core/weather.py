@@ -0,0 +1,219 @@
+"""
+Module containing the gridded weather provider.
+
+Forecasts are stored on a grid of distance along the race route by time in a
+simple binary file so they can be memory-mapped instead of parsed:
+
+    magic          4 bytes   b'SCWX'
+    version        uint32
+    n_distance     uint32
+    n_time         uint32
+    distance axis  float64[n_distance]  <m>, increasing
+    time axis      float64[n_time]      <s since unix epoch>, increasing
+    fields         float64[n_distance * n_time] for each of FIELDS,
+                   row-major with distance as the outer index
+
+All values are little-endian.
+"""
+
+__author__ = "Brett Duncan"
+__email__ = "dunca384@umn.edu"
+
+
+from array import array
+import math
+import mmap
+import struct
+import sys
+from typing import Sequence, Tuple
+
+from core.physics import calculate_air_density
+from core.race import Race
+
+
+MAGIC = b'SCWX'
+VERSION = 1
+HEADER = struct.Struct('<4sIII')
+
+FIELDS = ('wind_east', 'wind_north', 'temperature', 'humidity', 'cloud_cover')
+"""
+Gridded fields in file order. Wind components are in m/s in the direction the air
+is moving, temperature is in Celsius, and humidity and cloud cover are fractions.
+"""
+
+
+def write_weather_grid(file_path: str,
+                       distances: Sequence[float],
+                       times: Sequence[float],
+                       wind_east: Sequence[Sequence[float]],
+                       wind_north: Sequence[Sequence[float]],
+                       temperature: Sequence[Sequence[float]],
+                       humidity: Sequence[Sequence[float]],
+                       cloud_cover: Sequence[Sequence[float]]) -> None:
+    """
+    Write a weather grid file.
+
+    Each field is indexed as `field[distance_index][time_index]`.
+
+    :param file_path: Path of the file to write.
+    :param distances: Distance axis in meters along the race route.
+    :param times: Time axis in seconds since the unix epoch.
+    """
+    if any(b <= a for a, b in zip(distances, distances[1:])) or \
+            any(b <= a for a, b in zip(times, times[1:])):
+        raise ValueError('Grid axes must be strictly increasing.')
+
+    with open(file_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(distances), len(times)))
+        for values in (distances, times):
+            _write_doubles(f, values)
+        for field in (wind_east, wind_north, temperature, humidity, cloud_cover):
+            if len(field) != len(distances) or any(len(row) != len(times) for row in field):
+                raise ValueError('Field shape does not match the grid axes.')
+            _write_doubles(f, [value for row in field for value in row])
+
+
+def _write_doubles(f, values: Sequence[float]) -> None:
+    doubles = array('d', values)
+    if sys.byteorder != 'little':
+        doubles.byteswap()
+    doubles.tofile(f)
+
+
+class GriddedWeather:
+    """
+    Memory-mapped weather forecast on a distance by time grid.
+    """
+
+    def __init__(self, file_path: str):
+        with open(file_path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, n_distance, n_time = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{file_path} is not a version {VERSION} weather grid.')
+        if sys.byteorder != 'little':
+            raise NotImplementedError('Weather grids are only mapped on little-endian machines.')
+
+        doubles = memoryview(self._mmap)[HEADER.size:].cast('d')
+        size = n_distance * n_time
+
+        self.distances = doubles[:n_distance]
+        self.times = doubles[n_distance:n_distance + n_time]
+
+        offset = n_distance + n_time
+        for name in FIELDS:
+            setattr(self, name, doubles[offset:offset + size])
+            offset += size
+
+        # Air density is filled in per grid cell the first time it's needed
+        self._rho = array('d', [math.nan]) * size
+
+    def get_air_density(self, index: int) -> float:
+        """
+        Air density at a grid node, calculated once and cached.
+
+        :param index: Flat index of the grid node.
+
+        :return: Air density in kg/m/m/m.
+        """
+        rho = self._rho[index]
+        if math.isnan(rho):
+            rho = calculate_air_density(temperature=self.temperature[index],
+                                        altitude=0.0,
+                                        humidity=self.humidity[index])
+            self._rho[index] = rho
+        return rho
+
+    def cursor(self, race: Race) -> 'WeatherCursor':
+        """
+        Create a cursor for sampling the weather along a race route during one simulation.
+
+        :param race: Race whose route the car follows.
+
+        :return: WeatherCursor for the race.
+        """
+        return WeatherCursor(self, race)
+
+
+class WeatherCursor:
+    """
+    Samples a GriddedWeather along a race route.
+
+    The wind is projected onto the route heading once per grid node when the cursor is
+    created, and the cursor remembers the last grid cell it sampled. Simulations move
+    forward through distance and time in small steps, so finding the cell for the next
+    sample is O(1).
+    """
+
+    def __init__(self, weather: GriddedWeather, race: Race):
+        self.weather = weather
+
+        n_time = len(weather.times)
+        along_route = array('d', bytes(8 * len(weather.distances) * n_time))
+        for i, distance in enumerate(weather.distances):
+            heading = race.get_heading(distance)
+            east, north = math.sin(heading), math.cos(heading)
+            for j in range(i * n_time, (i + 1) * n_time):
+                along_route[j] = weather.wind_east[j] * east + weather.wind_north[j] * north
+        self.along_route = along_route
+
+        self._distance_index = 0
+        self._time_index = 0
+
+    def sample(self, distance: float, time: float) -> Tuple[float, float, float, float, float]:
+        """
+        Interpolate the weather at a point along the route.
+
+        Values outside of the grid are clamped to its edges.
+
+        :param distance: Distance along the race route in meters.
+        :param time: Time in seconds since the unix epoch.
+
+        :return: Tuple of wind speed in the direction of travel (m/s), temperature (C),
+        relative humidity, air density (kg/m/m/m), and cloud cover.
+        """
+        weather = self.weather
+
+        i, fd = _advance(weather.distances, self._distance_index, distance)
+        j, ft = _advance(weather.times, self._time_index, time)
+        self._distance_index = i
+        self._time_index = j
+
+        n_time = len(weather.times)
+        a = i * n_time + j
+        b = a + n_time if i + 1 < len(weather.distances) else a
+        da = 1 if j + 1 < n_time else 0
+
+        w00 = (1.0 - fd) * (1.0 - ft)
+        w01 = (1.0 - fd) * ft
+        w10 = fd * (1.0 - ft)
+        w11 = fd * ft
+
+        def interpolate(field):
+            return w00 * field[a] + w01 * field[a + da] + w10 * field[b] + w11 * field[b + da]
+
+        rho = w00 * weather.get_air_density(a) + w01 * weather.get_air_density(a + da) + \
+            w10 * weather.get_air_density(b) + w11 * weather.get_air_density(b + da)
+
+        return interpolate(self.along_route), interpolate(weather.temperature), \
+            interpolate(weather.humidity), rho, interpolate(weather.cloud_cover)
+
+
+def _advance(axis: Sequence[float], index: int, value: float) -> Tuple[int, float]:
+    """
+    Move a cursor along an axis to the cell containing `value`.
+
+    :return: Tuple of the index of the lower edge of the cell and the fraction of
+    the way across the cell, clamped to [0, 1].
+    """
+    last = len(axis) - 1
+    while index < last - 1 and axis[index + 1] <= value:
+        index += 1
+    while index > 0 and axis[index] > value:
+        index -= 1
+
+    if last == 0:
+        return 0, 0.0
+    span = axis[index + 1] - axis[index]
+    return index, min(max((value - axis[index]) / span, 0.0), 1.0)
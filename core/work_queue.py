@@ -0,0 +1,315 @@
+"""
+Coordinator and workers for spreading a sweep across machines.
+
+The coordinator listens on a TCP port and hands out tasks to any worker that connects
+with the same authkey. A worker gets the sweep's function and shared context (e.g.
+the race and car) once when it connects, then repeatedly pulls a batch of tasks,
+runs them, and pushes the results back. Tasks are leased to a worker: while it runs
+them it heartbeats to renew the lease, and tasks whose lease runs out or whose worker
+disconnects are queued again for someone else.
+
+Start the sweep on the coordinator, e.g. `solver.distributed_configuration_checker`,
+then on each machine run
+
+    python -c "from core.work_queue import run_worker; run_worker(('coordinator-host', 5600), b'secret')"
+
+Everything sent over the connection is unpickled on the other end, so anyone who can
+connect with the authkey can run code on the coordinator and the workers. There is no
+default authkey, and coordinators only listen on localhost unless given another
+address. Only listen on a network you trust, with a random authkey that isn't shared
+elsewhere (e.g. `secrets.token_bytes(32)`).
+"""
+
+__author__ = "Brett Duncan"
+__email__ = "dunca384@umn.edu"
+
+
+import collections
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+import queue
+import socket
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+
+class Coordinator:
+    """
+    Serves the tasks of one sweep to workers over TCP.
+    """
+
+    def __init__(self,
+                 function: Callable[[Any, Any], Any],
+                 context: Any,
+                 authkey: bytes,
+                 address: Tuple[str, int] = ('127.0.0.1', 5600),
+                 lease_timeout: float = 60.0,
+                 max_attempts: int = 3):
+        """
+        :param function: Module-level function the workers call as `function(context, args)`.
+        :param context: Picklable data sent to each worker once, shared by every task.
+        :param authkey: Secret key workers have to authenticate with.
+        :param address: Host and port to listen on (port 0 picks a free port, see `address`).
+        Listening on anything but localhost lets other machines connect.
+        :param lease_timeout: Time in seconds without a heartbeat before a worker's tasks are queued again.
+        :param max_attempts: Number of times a task can raise before the sweep is stopped.
+        """
+        if not authkey:
+            raise ValueError('An authkey is required')
+        self.function = function
+        self.context = context
+        self.authkey = authkey
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+
+        self._listener = Listener(address, family='AF_INET', authkey=authkey)
+        self.address = self._listener.address
+
+        self._lock = threading.Lock()
+        self._tasks: Dict[Hashable, Any] = {}
+        self._pending = collections.deque()
+        self._leases: Dict[Hashable, Tuple[int, float]] = {}  # key -> (worker, deadline)
+        self._failures: Dict[Hashable, int] = {}
+        self._done = set()
+        self._results = queue.Queue()
+        self._next_worker = 0
+        self._closed = False
+
+        self.requeued = 0
+        self.workers = 0
+
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                if self._closed:
+                    return
+                continue  # a client that failed to authenticate
+            with self._lock:
+                worker = self._next_worker
+                self._next_worker += 1
+                self.workers += 1
+            threading.Thread(target=self._serve, args=(conn, worker), daemon=True).start()
+
+    def _requeue(self, keys: Iterable[Hashable]) -> None:
+        # needs the lock
+        for key in keys:
+            if key in self._leases and key not in self._done:
+                del self._leases[key]
+                self._pending.appendleft(key)
+                self.requeued += 1
+
+    def _serve(self, conn: Connection, worker: int) -> None:
+        try:
+            while True:
+                message = conn.recv()
+                kind = message[0]
+                now = time.monotonic()
+
+                if kind == 'hello':
+                    conn.send(('context', self.function, self.context))
+
+                elif kind == 'get':
+                    with self._lock:
+                        batch = []
+                        while self._pending and len(batch) < message[1]:
+                            key = self._pending.popleft()
+                            if key in self._done:
+                                continue
+                            self._leases[key] = (worker, now + self.lease_timeout)
+                            batch.append((key, self._tasks[key]))
+                        finished = self._closed or (self._tasks and not self._pending and not self._leases)
+                    if batch:
+                        conn.send(('tasks', batch))
+                    elif finished:
+                        conn.send(('stop',))
+                        return
+                    else:
+                        conn.send(('wait', min(1.0, self.lease_timeout / 4)))
+
+                elif kind == 'heartbeat':
+                    with self._lock:
+                        for key in message[1]:
+                            if self._leases.get(key, (None,))[0] == worker:
+                                self._leases[key] = (worker, now + self.lease_timeout)
+                    conn.send(('ok',))
+
+                elif kind == 'results':
+                    with self._lock:
+                        for key, ok, value in message[1]:
+                            if key in self._done or key not in self._tasks:
+                                continue  # a requeued task that finished twice
+                            self._leases.pop(key, None)
+                            if ok:
+                                self._done.add(key)
+                                self._results.put((key, True, value))
+                            else:
+                                self._failures[key] = self._failures.get(key, 0) + 1
+                                if self._failures[key] >= self.max_attempts:
+                                    self._results.put((key, False, value))
+                                else:
+                                    self._pending.append(key)
+                    conn.send(('ok',))
+
+        except (EOFError, OSError):
+            pass  # the worker went away
+        finally:
+            with self._lock:
+                self._requeue([key for key, (owner, _) in self._leases.items() if owner == worker])
+                self.workers -= 1
+            conn.close()
+
+    def run(self, tasks: Iterable[Tuple[Hashable, Any]], verbose: bool = True) -> Iterator[Tuple[Hashable, Any]]:
+        """
+        Serve tasks until every one of them has a result.
+
+        :param tasks: Iterable of (key, args) pairs with unique, picklable keys.
+        :param verbose: Print progress and requeued tasks.
+
+        :return: Iterator of (key, result) pairs in the order they finish.
+        """
+        with self._lock:
+            for key, args in tasks:
+                if key not in self._tasks:
+                    self._tasks[key] = args
+                    self._pending.append(key)
+            remaining = len(self._tasks) - len(self._done)
+
+        # Leases are checked on a schedule rather than only when no results are coming
+        # in, or a hung worker's tasks would never expire while the others keep reporting
+        check_interval = min(1.0, self.lease_timeout / 4)
+        next_check = time.monotonic() + check_interval
+
+        while remaining:
+            now = time.monotonic()
+            if now >= next_check:
+                with self._lock:
+                    expired = [key for key, (_, deadline) in self._leases.items() if deadline < now]
+                    self._requeue(expired)
+                if verbose and expired:
+                    print(f'Requeued {len(expired)} task(s) whose leases ran out.')
+                next_check = now + check_interval
+
+            try:
+                key, ok, value = self._results.get(timeout=max(next_check - now, 0.0))
+            except queue.Empty:
+                continue
+
+            if not ok:
+                raise RuntimeError(f'Task {key!r} failed {self.max_attempts} times:\n{value}')
+            remaining -= 1
+            if verbose:
+                print(f'{len(self._tasks) - remaining}/{len(self._tasks)} tasks done, {self.workers} worker(s).')
+            yield key, value
+
+    def close(self) -> None:
+        """
+        Stop accepting workers. Connected workers are told to stop the next time they ask for work.
+        """
+        with self._lock:
+            self._closed = True
+        self._listener.close()
+
+    def __enter__(self) -> 'Coordinator':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class _Heartbeat(threading.Thread):
+    """
+    Renews the leases on the tasks a worker is running.
+    """
+
+    def __init__(self, conn: Connection, lock: threading.Lock, keys: List[Hashable], interval: float):
+        super().__init__(daemon=True)
+        self.conn = conn
+        self.lock = lock
+        self.keys = keys
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                self.conn.send(('heartbeat', self.keys))
+                self.conn.recv()
+
+
+def run_worker(address: Tuple[str, int],
+               authkey: bytes,
+               batch_size: int = 4,
+               heartbeat_interval: float = 5.0,
+               retry_interval: Optional[float] = 5.0,
+               verbose: bool = True) -> int:
+    """
+    Pull tasks from a coordinator and run them until it says the sweep is done.
+
+    :param address: Host and port of the coordinator.
+    :param authkey: Secret key the coordinator was started with.
+    :param batch_size: Number of tasks to ask for at a time.
+    :param heartbeat_interval: Time between heartbeats in seconds. Keep it well under
+    the coordinator's lease timeout.
+    :param retry_interval: Time to wait between attempts to connect to a coordinator
+    that isn't up yet in seconds, or None to fail right away.
+    :param verbose: Print the tasks as they finish.
+
+    :return: Number of tasks run.
+    """
+    while True:
+        try:
+            conn = Client(address, family='AF_INET', authkey=authkey)
+            break
+        except (ConnectionRefusedError, socket.timeout):
+            if retry_interval is None:
+                raise
+            time.sleep(retry_interval)
+
+    lock = threading.Lock()
+    count = 0
+
+    def request(message):
+        with lock:
+            conn.send(message)
+            return conn.recv()
+
+    try:
+        _, function, context = request(('hello',))
+
+        while True:
+            reply = request(('get', batch_size))
+            if reply[0] == 'stop':
+                break
+            if reply[0] == 'wait':
+                time.sleep(reply[1])
+                continue
+
+            batch = reply[1]
+            heartbeat = _Heartbeat(conn, lock, [key for key, _ in batch], heartbeat_interval)
+            heartbeat.start()
+            results = []
+            try:
+                for key, args in batch:
+                    try:
+                        results.append((key, True, function(context, args)))
+                    except Exception:
+                        results.append((key, False, traceback.format_exc()))
+                    count += 1
+                    if verbose:
+                        print(f'Finished task {key!r}.')
+            finally:
+                heartbeat.stopped.set()
+                heartbeat.join()
+            request(('results', results))
+    except EOFError:
+        pass  # the coordinator went away
+    finally:
+        conn.close()
+
+    return count
@@ -0,0 +1,342 @@
+"""
+Live re-planning service that turns telemetry into updated target speeds during the race.
+
+Telemetry arrives as one JSON object per line with `time`, `soc`, `speed`, and either
+`distance` or `lat` and `lon`, e.g.
+
+    {"time": 1634100000.0, "soc": 0.82, "speed": 22.2, "lat": -14.46, "lon": 132.26}
+
+from a local TCP socket (`serve_socket`) or a file being appended to (`follow_file`),
+which stands in for the real telemetry link.
+"""
+
+__author__ = "Brett Duncan"
+__email__ = "dunca384@umn.edu"
+
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import json
+from typing import Any, Callable, Dict, Optional, Set
+
+from core.car import Car
+from core.events import StageStop, StartOfDay
+from core.irradiance import IrradianceRaster
+from core.objects import GRID_CHARGING, STOPPED, State, RaceActions
+from core.process_events import process_events
+from core.race import Race
+from core.sketches import HistogramSketch
+from core.speed_optimizer import SpeedPlan, optimize_target_speeds
+
+
+@dataclass(frozen=True)
+class Telemetry:
+    """
+    One telemetry message from the car.
+    """
+    time: float  # <s> since the unix epoch
+    soc: float
+    speed: float  # <m/s>
+    distance: Optional[float] = None  # <m> along the route
+    lat: Optional[float] = None  # <deg>
+    lon: Optional[float] = None  # <deg>
+
+
+@dataclass(frozen=True)
+class PlanUpdate:
+    """
+    Plan published to subscribers.
+    """
+    telemetry: Telemetry
+    distance: float  # <m> the telemetry was mapped to
+    plan: Optional[SpeedPlan]  # None if no plan finishes from this state
+    latency: float  # <s> from receiving the telemetry to publishing the plan
+    coalesced: int  # number of newer messages folded into this plan while it waited
+
+
+def parse_telemetry(line: str) -> Telemetry:
+    """
+    Parse one line of JSON telemetry.
+
+    :param line: JSON object with the fields of `Telemetry`.
+
+    :return: Telemetry message.
+    """
+    fields = json.loads(line)
+    return Telemetry(time=float(fields['time']),
+                     soc=float(fields['soc']),
+                     speed=float(fields['speed']),
+                     distance=float(fields['distance']) if fields.get('distance') is not None else None,
+                     lat=float(fields['lat']) if fields.get('lat') is not None else None,
+                     lon=float(fields['lon']) if fields.get('lon') is not None else None)
+
+
+def get_race_state(race: Race, distance: float, time: float, vehicle_speed: float,
+                   stop_radius: float = 1000.0, stopped_since: Optional[float] = None) -> RaceActions:
+    """
+    Work out what's happening in the race from the schedule and where the car is.
+
+    Race hours and grid charging come from the time events. Telemetry doesn't say when
+    the car reached a stop, so a car that's stopped within `stop_radius` past a stage stop
+    is taken to be done for the day unless a day has started since it stopped (it's
+    about to leave in the morning), and control stops are taken as already served.
+
+    :param race: Race being run.
+    :param distance: Distance along the route in meters.
+    :param time: Time in seconds since the unix epoch.
+    :param vehicle_speed: The car's current speed.
+    :param stop_radius: How far past a stage stop a stopped car counts as being at it in meters.
+    :param stopped_since: Time the car has been stopped since (`time` by default, which
+    takes a car at a stage stop to have just arrived).
+
+    :return: RaceActions at the given point.
+    """
+    race_state = RaceActions(clock_running=False,
+                             charging=False,
+                             driving=False,
+                             normalized=False,
+                             grid_charging=False,
+                             race_hours=False)
+    time_queue = [event for event in race.time_events if event.time <= time]
+    race_state, _ = process_events(distance_queue=[],
+                                   time_queue=time_queue,
+                                   state=State(distance=distance, energy=0.0, soc=0.0, time=time),
+                                   race_state=race_state,
+                                   checkpoint_time_remaining=0.0)
+
+    at_stage_stop = any(isinstance(event, StageStop) and 0.0 <= distance - event.distance <= stop_radius
+                        for event in race.distance_events)
+    if stopped_since is None:
+        stopped_since = time
+    # Only parked if the car hasn't had a night (an EndOfDay and then a StartOfDay) since it stopped
+    day_started = any(isinstance(event, StartOfDay) and stopped_since < event.time <= time
+                      for event in race.time_events)
+    if race_state.race_hours and at_stage_stop and vehicle_speed == 0.0 and not day_started:
+        race_state = RaceActions.from_mode(STOPPED.mode | (race_state.mode & GRID_CHARGING))
+
+    return race_state
+
+
+_planner: Dict[str, Any] = {}
+"""
+Planning context for the worker process, set once by `_init_planner`.
+"""
+
+
+def _init_planner(race: Race,
+                  car: Car,
+                  array_model: Callable,
+                  battery_size: float,
+                  planner_options: Dict[str, Any]) -> None:
+    _planner.update(race=race, car=car, array_model=array_model,
+                    battery_size=battery_size, planner_options=planner_options)
+
+
+def _plan(state: State, race_state: RaceActions, vehicle_speed: float) -> Optional[SpeedPlan]:
+    return optimize_target_speeds(race=_planner['race'],
+                                  car=_planner['car'],
+                                  array_model=_planner['array_model'],
+                                  battery_size=_planner['battery_size'],
+                                  state=state,
+                                  race_state=race_state,
+                                  vehicle_speed=vehicle_speed,
+                                  **_planner['planner_options'])
+
+
+class ReplanningService:
+    """
+    Re-plans the target speeds from the latest telemetry in a worker pool.
+
+    Only the newest message matters, so messages that arrive while a plan is running
+    replace each other and the next plan starts from whichever is newest. Each
+    subscriber gets a queue that only ever holds the latest PlanUpdate.
+    """
+
+    def __init__(self,
+                 race: Race,
+                 car: Car,
+                 array_model: Callable[[float, float, bool], float],
+                 battery_size: float,
+                 max_workers: int = 1,
+                 irradiance_raster: Optional[IrradianceRaster] = None,
+                 **planner_options):
+        """
+        :param race: Race being run.
+        :param car: Car being raced.
+        :param array_model: Array model for `optimize_target_speeds`. It's sent to the
+        worker processes so it has to be picklable (a module-level function or MultiFacetArray).
+        :param battery_size: Battery size in Joules.
+        :param max_workers: Number of worker processes.
+        :param irradiance_raster: Precomputed solar altitude and irradiance along the route.
+        :param planner_options: Other keyword arguments for `optimize_target_speeds`.
+        """
+        self.race = race
+        self.battery_size = battery_size
+        self.executor = ProcessPoolExecutor(max_workers=max_workers,
+                                            initializer=_init_planner,
+                                            initargs=(race, car, array_model, battery_size,
+                                                      dict(planner_options, irradiance_raster=irradiance_raster)))
+        self.latency = HistogramSketch(0.0, 60.0, bins=600)  # <s>
+        self.plans = 0
+        self.coalesced = 0
+        self.latest: Optional[PlanUpdate] = None
+
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._pending: Optional[Telemetry] = None
+        self._pending_received = 0.0
+        self._pending_coalesced = 0
+        self._stopped_since: Optional[float] = None  # time of the first message since the car stopped
+        self._wakeup = asyncio.Event()
+
+    def subscribe(self) -> asyncio.Queue:
+        """
+        :return: Queue that the newest PlanUpdate is put on.
+        """
+        queue = asyncio.Queue(maxsize=1)
+        if self.latest is not None:
+            queue.put_nowait(self.latest)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._subscribers.discard(queue)
+
+    def submit(self, telemetry: Telemetry) -> None:
+        """
+        Queue telemetry to be planned from, replacing any telemetry that hasn't been planned yet.
+        """
+        # Tracked for every message, including ones that get coalesced
+        if telemetry.speed != 0.0:
+            self._stopped_since = None
+        elif self._stopped_since is None:
+            self._stopped_since = telemetry.time
+
+        if self._pending is not None:
+            self._pending_coalesced += 1
+            self.coalesced += 1
+        else:
+            self._pending_received = asyncio.get_running_loop().time()
+        self._pending = telemetry
+        self._wakeup.set()
+
+    def _submit_line(self, line: str) -> None:
+        # A malformed message is dropped instead of stopping the rest from being read
+        try:
+            telemetry = parse_telemetry(line)
+        except (ValueError, KeyError, TypeError) as e:
+            print(f'Skipping malformed telemetry {line.strip()!r}: {e!r}')
+            return
+        self.submit(telemetry)
+
+    def get_distance(self, telemetry: Telemetry) -> float:
+        """
+        Map a telemetry message to distance along the route.
+        """
+        if telemetry.distance is not None:
+            return telemetry.distance
+        if self.race.route is None or telemetry.lat is None or telemetry.lon is None:
+            raise ValueError('Telemetry needs a `distance` unless the race has a route to map `lat`/`lon` onto')
+
+        from core.race_path import Coordinate
+        return self.race.route.get_distance_from_point(Coordinate(lon=telemetry.lon, lat=telemetry.lat))
+
+    def _publish(self, update: PlanUpdate) -> None:
+        self.latest = update
+        for queue in self._subscribers:
+            # Replace a plan the subscriber hasn't picked up yet
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(update)
+
+    async def run(self) -> None:
+        """
+        Plan from the newest telemetry until cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+
+                telemetry, received, coalesced = self._pending, self._pending_received, self._pending_coalesced
+                self._pending, self._pending_coalesced = None, 0
+                stopped_since = self._stopped_since if telemetry.speed == 0.0 else None
+
+                # A message or plan that fails is skipped, the next message plans again
+                try:
+                    distance = self.get_distance(telemetry)
+
+                    state = State(distance=distance,
+                                  energy=telemetry.soc * self.battery_size,
+                                  soc=telemetry.soc,
+                                  time=telemetry.time)
+                    race_state = get_race_state(self.race, distance, telemetry.time, telemetry.speed,
+                                                stopped_since=stopped_since)
+
+                    plan = await loop.run_in_executor(self.executor, _plan, state, race_state, telemetry.speed)
+                except Exception as e:
+                    print(f'Failed to plan from {telemetry}: {e!r}')
+                    continue
+
+                latency = loop.time() - received
+                self.latency.add(latency)
+                self.plans += 1
+                self._publish(PlanUpdate(telemetry=telemetry,
+                                         distance=distance,
+                                         plan=plan,
+                                         latency=latency,
+                                         coalesced=coalesced))
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def serve_socket(self, host: str = '127.0.0.1', port: int = 5555) -> None:
+        """
+        Accept telemetry over TCP, one JSON message per line, until cancelled.
+        """
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                async for line in reader:
+                    if line.strip():
+                        self._submit_line(line.decode())
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def follow_file(self, file_path: str, poll_interval: float = 0.25, from_start: bool = True) -> None:
+        """
+        Read telemetry from a file as lines are appended to it, until cancelled.
+
+        :param file_path: Path of the file to follow.
+        :param poll_interval: Time to wait for a new line in seconds.
+        :param from_start: Read the lines already in the file instead of only new ones.
+        """
+        with open(file_path) as f:
+            if not from_start:
+                f.seek(0, 2)
+            partial = ''
+            while True:
+                line = f.readline()
+                if not line:
+                    await asyncio.sleep(poll_interval)
+                    continue
+                partial += line
+                # Wait for the rest of a line that's still being written
+                if not partial.endswith('\n'):
+                    continue
+                if partial.strip():
+                    self._submit_line(partial)
+                partial = ''
+
+    def latency_report(self) -> str:
+        """
+        :return: Summary of the planning latency.
+        """
+        if not self.latency.count:
+            return 'no plans yet'
+        return (f'{self.plans} plans, {self.coalesced} messages coalesced, latency '
+                f'mean {self.latency.mean:.2f} s, p50 {self.latency.quantile(0.5):.2f} s, '
+                f'p95 {self.latency.quantile(0.95):.2f} s, max {self.latency.max:.2f} s')
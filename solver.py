@@ -1,23 +1,183 @@
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import contextlib
+import csv
+import dataclasses
+from dataclasses import dataclass, field
 import itertools
 import math
-from typing import Dict, List, Tuple
+import os
+import random
+import shelve
+import tempfile
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 from core.car import Battery, Car
-from core.objects import State, RaceActions
+from core.diagnostics import LogStats, LogUsage
+from core.events import StageStop
+from core.irradiance import IrradianceRaster, build_irradiance_raster
+from core.journal import Journal, run_journaled
+from core.objects import EndConditions, State, RaceActions
 from core.race import Race
-from core.simulation import simulate
+from core.result_store import ResultStore, SweepRecord
+from core.scenario import ConstantWind, FlatArray, ScenarioSpec
+from core.shared import RaceHandle, SharedRegistry, publish_race
+from core.sketches import HistogramSketch
+from core.simulation import simulate, EULER, RK2
+from core.state_log import DECIMATE, StateLog
+from core.surrogate import EnergyBudget, NO_FINISH, UNCERTAINTY, estimate_energy_budget
+from core.work_queue import Coordinator
 
 
 __author__ = "Brett Duncan"
 __email__ = "dunca384@umn.edu"
 
 
+BATTERY_MASS_PER_PARALLEL_CELL = 2.0  # <kg>
+"""
+Mass added to the car for every cell in parallel.
+"""
+
+
+def _make_array_model(array_power_factor: float) -> FlatArray:
+    """
+    Create the flat array model used by the solvers.
+
+    :param array_power_factor: Scalar applied to the array power.
+
+    :return: Picklable array model for `simulate`.
+    """
+    return FlatArray(array_power_factor=array_power_factor)
+
+
+def _stop_states(race: Race, logged_states: List[Tuple]) -> List[Optional[Tuple[float, float]]]:
+    """
+    Reduce a log from the start of the race to the SOC and arrival time (seconds after
+    the start of the race) at each stop, or None for stops that weren't reached.
+    """
+    start_time = race.time_events[0].time
+    stops = []
+    logged = iter(logged_states)
+    state = next(logged)[0]
+    for event in race.distance_events:
+        while state is not None and state.distance < event.distance:
+            state = next(logged, (None,))[0]
+        stops.append(None if state is None else (state.soc, state.time - start_time))
+    return stops
+
+
+def _simulate_configuration(race: Race,
+                            car: Car,
+                            vehicle_speed: float,
+                            wind_speed: float,
+                            array_power_factor: float,
+                            log_budget: Optional[int] = None,
+                            log_overflow: str = DECIMATE) -> Tuple[bool, float, float, List[Optional[Tuple[float, float]]], LogStats]:
+    """
+    Simulate a single race + car configuration at a constant target speed.
+
+    :param race: Race to evaluate.
+    :param car: Car to evaluate the race with.
+    :param vehicle_speed: Target speed in m/s.
+    :param wind_speed: Constant wind speed in m/s.
+    :param array_power_factor: Scalar applied to the array power.
+    :param log_budget: Most bytes of log to keep in memory, or None for no limit.
+    :param log_overflow: What the log does when it reaches the budget, see StateLog.
+
+    :return: Tuple of whether or not the car finished (bool), minimum SOC,
+        maximum distance completed, the SOC and arrival time at each stop, and the
+        memory the log used.
+    """
+    end_simulation = EndConditions.for_race(race)
+
+    wind_func = ConstantWind(wind_speed)
+
+    array_model = _make_array_model(array_power_factor)
+
+    race_state = RaceActions(clock_running=False,
+                             charging=False,
+                             driving=False,
+                             normalized=False,
+                             grid_charging=False,
+                             race_hours=False)
+
+    # start with a full battery
+    energy = car.battery.energy_per_cell * \
+        (car.battery.cells_in_series * car.battery.cells_in_parallel)
+    state = State(distance=0.0, energy=energy, soc=1.0,
+                  time=race.time_events[0].time)
+
+    target_speeds = [(0.0, vehicle_speed)]
+
+    result, end_state, logged_states = simulate(race=race, car=car, wind_func=wind_func, array_model=array_model,
+                                                end_simulation=end_simulation, battery_size=energy, state=state, race_state=race_state, target_speeds=target_speeds,
+                                                log=StateLog(max_bytes=log_budget, overflow=log_overflow))
+    if not result and end_state.time > end_simulation.end_time:
+        print('out of time')
+
+    min_soc = min(logged_states, key=lambda s: s[0].soc)[0].soc
+    max_distance = max(logged_states, key=lambda s: s[0].distance)[
+        0].distance
+
+    return result, min_soc, max_distance, _stop_states(race, logged_states), LogStats.of(logged_states)
+
+
+def _run_configuration(race: Race,
+                       car: Car,
+                       vehicle_speed: float,
+                       wind_speed: float,
+                       array_power_factor: float) -> Tuple[bool, float, float]:
+    """
+    Simulate a single race + car configuration at a constant target speed.
+
+    Defined at module level so it can be dispatched to worker processes.
+
+    :return: Tuple of whether or not the car finished (bool), minimum SOC,
+        and maximum distance completed.
+    """
+    return _simulate_configuration(race, car, vehicle_speed, wind_speed, array_power_factor)[:3]
+
+
+def _estimate_configuration(race: Race,
+                            car: Car,
+                            vehicle_speed: float,
+                            wind_speed: float,
+                            array_power_factor: float,
+                            uncertainty: float = UNCERTAINTY) -> EnergyBudget:
+    """
+    Energy budget estimate for the same configuration `_run_configuration` simulates.
+    """
+    battery_size = car.battery.energy_per_cell * \
+        (car.battery.cells_in_series * car.battery.cells_in_parallel)
+
+    return estimate_energy_budget(race=race,
+                                  car=car,
+                                  wind_speed=wind_speed,
+                                  array_model=_make_array_model(array_power_factor),
+                                  battery_size=battery_size,
+                                  target_speeds=[(0.0, vehicle_speed)],
+                                  uncertainty=uncertainty)
+
+
+def _attached(args: Tuple) -> Tuple:
+    # Task arguments that start with a RaceHandle, with the handle replaced by its race
+    return (args[0].attach(), *args[1:])
+
+
+def _run_configuration_args(args: Tuple) -> Tuple[bool, float, float]:
+    return _run_configuration(*_attached(args))
+
+
 def configuration_checker(race: Race,
                           car: Car,
                           vehicle_speeds: List[float],
                           wind_speeds: List[float],
-                          array_power_factors: List[float]) -> Dict[Tuple[float, float, float], Tuple[bool, State, List]]:
+                          array_power_factors: List[float],
+                          prescreen: bool = False,
+                          uncertainty: float = UNCERTAINTY,
+                          store: Optional[ResultStore] = None,
+                          log_budget: Optional[int] = None,
+                          log_overflow: str = DECIMATE) -> Dict[Tuple[float, float, float], Tuple[bool, float, float]]:
     """
     Check under what conditions the given race + car configuration will allow you to finish.
 
@@ -26,73 +186,363 @@ def configuration_checker(race: Race,
     :param vehicle_speeds:
     :param wind_speeds:
     :param array_power_factors:
+    :param prescreen: Skip the simulation when the energy budget estimate is clearly not
+    a finish. Those configurations don't finish, their minimum SOC is NaN (not simulated),
+    and their maximum distance is the estimate's. Everything else is simulated.
+    :param uncertainty: Half width of the estimate's SOC band around zero. Only
+    configurations estimated below `-uncertainty` are skipped, so widen it when the
+    estimate may be further off than `core.surrogate.UNCERTAINTY` describes.
+    :param store: Result store to skip configurations that are already in and to add
+    simulated configurations to. Its parameters are vehicle speed, wind speed, and array
+    power factor (the default) and it keeps up to `n_stops` of the race's stops, e.g.
+    `ResultStore(path, n_stops=len(race.distance_events))` to keep every stop.
+    :param log_budget: Most bytes of log each simulation keeps in memory, or None for no limit.
+    :param log_overflow: What the logs do when they reach the budget, see StateLog.
 
     :return: A dictionary containing keys that are a tuple of vehicle speed, wind speed,
         and array power factor and values that are a tuple of whether or not the car finished
-        (bool), minimum SOC, and maximum distance completed.
+        (bool), minimum SOC, and maximum distance completed. Configurations skipped by the
+        prescreen have a NaN minimum SOC, and ones already in the store have the stored values.
+        Only simulated configurations are added to the store.
     """
-    def end_simulation(state: State):
-        # out of power
-        if state.soc <= 0.0:
-            return False
-        if state.time > race.time_events[-1].time:
-            print('out of time')
-            return False
-        # end of the race
-        if state.distance >= race.distance_events[-1].distance:
-            return True
-        return None
+    if store is not None and len(store.parameters) != 3:
+        raise ValueError('The store needs vehicle speed, wind speed, and array power factor parameters')
 
     results = {}
+    log_usage = LogUsage()
 
     for vehicle_speed, wind_speed, array_power_factor in itertools.product(vehicle_speeds, wind_speeds, array_power_factors):
 
+        key = (vehicle_speed, wind_speed, array_power_factor)
+        if store is not None and key in store:
+            print(
+                f'Skipping vehicle_speed={vehicle_speed} m/s; wind_speed={wind_speed} m/s; array_power_factor={array_power_factor} (already stored).')
+            record = store.get(key)
+            results[key] = record.finished, record.min_soc, record.max_distance
+            continue
+
+        if prescreen:
+            budget = _estimate_configuration(
+                race, car, vehicle_speed, wind_speed, array_power_factor, uncertainty)
+            # The estimate ignores ESR losses, so it's only trusted to rule configurations out
+            if budget.verdict == NO_FINISH:
+                print(
+                    f'Skipping vehicle_speed={vehicle_speed} m/s; wind_speed={wind_speed} m/s; array_power_factor={array_power_factor} (estimated {budget.verdict}).')
+                results[key] = False, math.nan, budget.max_distance
+                continue
+
         print(
             f'Running simulation with vehicle_speed={vehicle_speed} m/s; wind_speed={wind_speed} m/s; array_power_factor={array_power_factor}...')
 
-        race_state = RaceActions(clock_running=False,
-                                 charging=False,
-                                 driving=False,
-                                 normalized=False,
-                                 grid_charging=False,
-                                 race_hours=False)
+        # save the result
+        result, min_soc, max_distance, stops, log_stats = _simulate_configuration(
+            race, car, vehicle_speed, wind_speed, array_power_factor, log_budget, log_overflow)
+        results[key] = result, min_soc, max_distance
+        log_usage.add(log_stats)
+        if store is not None:
+            _store_configuration(store, key, (result, min_soc, max_distance, stops))
 
-        # start with a full battery
-        energy = car.battery.energy_per_cell * \
-            (car.battery.cells_in_series * car.battery.cells_in_parallel)
-        state = State(distance=0.0, energy=energy, soc=1.0,
-                      time=race.time_events[0].time)
+        print('Simulation complete.')
 
-        def wind_func(distance: float, time: float):
-            return wind_speed  # <m/s>
+    if store is not None:
+        store.flush()
 
-        def array_model(irradiance: float, sun_altitude: float, normalized: bool):
-            normalization_scalar = 1.0 if normalized else math.sin(
-                sun_altitude)
-            # TODO: don't hardcode these values
-            # area = 5.0 m^2, efficiency = 0.25
-            return array_power_factor * irradiance * normalization_scalar * 5.0 * 0.25
+    print(f'Done! Logs: {log_usage}')
 
-        target_speeds = [(0.0, vehicle_speed)]
+    return results
 
-        result, end_state, logged_states = simulate(race=race, car=car, wind_func=wind_func, array_model=array_model,
-                                                    end_simulation=end_simulation, battery_size=energy, state=state, race_state=race_state, target_speeds=target_speeds)
 
-        min_soc = min(logged_states, key=lambda s: s[0].soc)[0].soc
-        max_distance = max(logged_states, key=lambda s: s[0].distance)[
-            0].distance
+def _store_configuration(store: ResultStore,
+                         key: Tuple[float, float, float],
+                         outcome: Tuple[bool, float, float, List[Optional[Tuple[float, float]]]]) -> None:
+    result, min_soc, max_distance, stops = outcome[:4]
+    store.append(SweepRecord(parameters=key,
+                             finished=bool(result),
+                             min_soc=min_soc,
+                             max_distance=max_distance,
+                             stops=tuple(stops[:store.n_stops])))
 
-        # save the result
-        results[(vehicle_speed, wind_speed, array_power_factor)
-                ] = result, min_soc, max_distance
 
-        print('Simulation complete.')
+def _configuration_task(context: Tuple[Race, Car], args: Tuple[float, float, float]):
+    return _simulate_configuration(*context, *args)
 
-    print('Done!')
+
+def distributed_configuration_checker(race: Race,
+                                      car: Car,
+                                      vehicle_speeds: List[float],
+                                      wind_speeds: List[float],
+                                      array_power_factors: List[float],
+                                      authkey: bytes,
+                                      address: Tuple[str, int] = ('127.0.0.1', 5600),
+                                      lease_timeout: float = 120.0,
+                                      store: Optional[ResultStore] = None) -> Dict[Tuple[float, float, float], Tuple[bool, float, float]]:
+    """
+    `configuration_checker` with the simulations run by workers on other machines.
+
+    Starts a coordinator on `address` and waits for workers started with
+    `core.work_queue.run_worker` to run every configuration that isn't in the store yet.
+
+    :param authkey: Secret key the workers have to authenticate with. Anyone who has it
+    can run code on the coordinator, see `core.work_queue`.
+    :param address: Host and port for the coordinator to listen on. Use e.g.
+    ('0.0.0.0', 5600) for workers on other machines of a trusted network.
+    :param lease_timeout: Time in seconds without a heartbeat before a worker's
+    configurations are handed to another worker.
+    :param store: Result store to skip configurations that are already in and to add
+    the new results to.
+
+    :return: The same dictionary `configuration_checker` returns.
+    """
+    results = {}
+    log_usage = LogUsage()
+    tasks = []
+    for key in itertools.product(vehicle_speeds, wind_speeds, array_power_factors):
+        if store is not None and key in store:
+            record = store.get(key)
+            results[key] = record.finished, record.min_soc, record.max_distance
+        else:
+            tasks.append((key, key))
+
+    with Coordinator(_configuration_task, (race, car), authkey=authkey, address=address,
+                     lease_timeout=lease_timeout) as coordinator:
+        print(f'Serving {len(tasks)} configurations on {coordinator.address} '
+              f'({len(results)} already stored)...')
+        for key, outcome in coordinator.run(tasks):
+            results[key] = outcome[:3]
+            log_usage.add(outcome[4])
+            if store is not None:
+                _store_configuration(store, key, outcome)
+
+    if store is not None:
+        store.flush()
+
+    print(f'Done! Logs: {log_usage}')
 
     return results
 
 
+@dataclass
+class FeasibilityMap:
+    """
+    Result of an adaptive feasibility sweep.
+
+    `samples` has the same layout as the dictionary returned by `configuration_checker`.
+    `boundary_cells` contains the finest cells whose corners disagree on whether or
+    not the car finished, each given as one (low, high) pair per axis.
+    """
+    samples: Dict[Tuple[float, float, float], Tuple[bool, float, float]]
+    boundary_cells: List[Tuple[Tuple[float, float], ...]]
+    _axes: List[Tuple[float, float, int]]
+    _coarse_cells: List[Tuple[Tuple[int, ...], Tuple[int, ...]]]
+    _subdivided: Set[Tuple[Tuple[int, ...], Tuple[int, ...]]]
+    _finished: Dict[Tuple[int, ...], bool]
+
+    def is_feasible(self, vehicle_speed: float, wind_speed: float, array_power_factor: float) -> bool:
+        """
+        Estimate whether or not the car finishes at the given point.
+
+        Points inside a cell whose corners agree take the value of the corners.
+        Points inside a boundary cell take the value of the nearest sampled corner.
+
+        :param vehicle_speed: Vehicle speed in m/s.
+        :param wind_speed: Wind speed in m/s.
+        :param array_power_factor: Array power factor.
+
+        :return: Whether or not the car is expected to finish.
+        """
+        point = (vehicle_speed, wind_speed, array_power_factor)
+        position = [_to_lattice(axis, value)
+                    for axis, value in zip(self._axes, point)]
+
+        cell = next((c for c in self._coarse_cells if _cell_contains(c, position)),
+                    None)
+        if cell is None:
+            raise ValueError(f'{point} is outside of the sampled region.')
+
+        while cell in self._subdivided:
+            cell = next(c for c in _split_cell(cell)
+                        if _cell_contains(c, position))
+
+        corners = _cell_corners(cell)
+        values = {self._finished[c] for c in corners}
+        if len(values) == 1:
+            return values.pop()
+
+        nearest = min(corners, key=lambda c: sum(
+            (p - i)**2 for p, i in zip(position, c)))
+        return self._finished[nearest]
+
+
+def _lattice_value(axis: Tuple[float, float, int], index: int) -> float:
+    low, high, size = axis
+    return low if size == 0 else low + (high - low) * index / size
+
+
+def _to_lattice(axis: Tuple[float, float, int], value: float) -> float:
+    low, high, size = axis
+    return 0.0 if size == 0 else (value - low) / (high - low) * size
+
+
+def _cell_corners(cell: Tuple[Tuple[int, ...], Tuple[int, ...]]) -> List[Tuple[int, ...]]:
+    lower, size = cell
+    return list(itertools.product(*[(l, l + s) if s else (l,) for l, s in zip(lower, size)]))
+
+
+def _cell_contains(cell: Tuple[Tuple[int, ...], Tuple[int, ...]], position: List[float]) -> bool:
+    lower, size = cell
+    return all(l <= p <= l + s for l, s, p in zip(lower, size, position))
+
+
+def _split_cell(cell: Tuple[Tuple[int, ...], Tuple[int, ...]]) -> List[Tuple[Tuple[int, ...], Tuple[int, ...]]]:
+    lower, size = cell
+    halves = []
+    for l, s in zip(lower, size):
+        if s > 1:
+            halves.append([(l, s // 2), (l + s // 2, s // 2)])
+        else:
+            halves.append([(l, s)])
+    return [(tuple(h[0] for h in combo), tuple(h[1] for h in combo))
+            for combo in itertools.product(*halves)]
+
+
+def find_feasibility_boundary(race: Race,
+                              car: Car,
+                              vehicle_speed_range: Tuple[float, float],
+                              wind_speed_range: Tuple[float, float],
+                              array_power_factor_range: Tuple[float, float],
+                              coarse_points: Tuple[int, int, int],
+                              resolution: Tuple[float, float, float],
+                              max_workers: Optional[int] = None) -> FeasibilityMap:
+    """
+    Map the feasibility frontier by adaptively refining a coarse grid.
+
+    The coarse grid is simulated first. Any cell whose corners disagree on whether or
+    not the car finished is split in half along every axis that is still coarser than
+    the requested resolution, and only the new corners are simulated. Each refinement
+    level is run as one parallel batch.
+
+    :param race: Race to evaluate.
+    :param car: Car to evaluate the race with.
+    :param vehicle_speed_range: (min, max) vehicle speed in m/s.
+    :param wind_speed_range: (min, max) wind speed in m/s.
+    :param array_power_factor_range: (min, max) array power factor.
+    :param coarse_points: Number of coarse grid points along each axis.
+    An axis whose range has a single value should use 1.
+    :param resolution: Finest cell size to refine to along each axis.
+    :param max_workers: Number of worker processes (defaults to the number of CPUs).
+
+    :return: FeasibilityMap containing every sampled point and the boundary cells.
+    """
+    ranges = (vehicle_speed_range, wind_speed_range, array_power_factor_range)
+
+    # Each axis is a lattice of integer indices. The number of halvings needed to
+    # reach the resolution determines the spacing between coarse points.
+    axes = []
+    coarse_step = []
+    for (low, high), points, target in zip(ranges, coarse_points, resolution):
+        if points < 2 or high == low:
+            axes.append((low, low, 0))
+            coarse_step.append(0)
+            continue
+        levels = max(0, math.ceil(math.log2((high - low) / (points - 1) / target)))
+        axes.append((low, high, (points - 1) * 2**levels))
+        coarse_step.append(2**levels)
+
+    coarse_cells = [(lower, tuple(coarse_step))
+                    for lower in itertools.product(*[range(0, size, step) if step else (0,)
+                                                     for (_, _, size), step in zip(axes, coarse_step)])]
+
+    samples = {}
+    finished = {}
+    subdivided = set()
+
+    def evaluate(executor, handle, cells):
+        pending = sorted({c for cell in cells for c in _cell_corners(cell)} - finished.keys())
+        points = [tuple(_lattice_value(axis, i) for axis, i in zip(axes, corner))
+                  for corner in pending]
+
+        print(f'Simulating {len(points)} points...')
+
+        outcomes = executor.map(_run_configuration_args,
+                                [(handle, car, *point) for point in points])
+        for corner, point, outcome in zip(pending, points, outcomes):
+            samples[point] = outcome
+            finished[corner] = bool(outcome[0])
+
+    cells = coarse_cells
+    boundary = []
+
+    # One pool for every level, so the workers start and attach the race only once
+    with contextlib.ExitStack() as stack:
+        handle = publish_race(stack.enter_context(SharedRegistry()), race)
+        executor = stack.enter_context(ProcessPoolExecutor(max_workers=max_workers))
+        while cells:
+            evaluate(executor, handle, cells)
+
+            mixed = [cell for cell in cells
+                     if len({finished[c] for c in _cell_corners(cell)}) > 1]
+
+            cells = []
+            for cell in mixed:
+                if any(s > 1 for s in cell[1]):
+                    subdivided.add(cell)
+                    cells.extend(_split_cell(cell))
+                else:
+                    boundary.append(cell)
+
+    boundary_cells = [tuple((_lattice_value(axis, l), _lattice_value(axis, l + s))
+                            for axis, l, s in zip(axes, *cell))
+                      for cell in boundary]
+
+    print('Done!')
+
+    return FeasibilityMap(samples=samples,
+                          boundary_cells=boundary_cells,
+                          _axes=axes,
+                          _coarse_cells=coarse_cells,
+                          _subdivided=subdivided,
+                          _finished=finished)
+
+
+def _smallest_possible_battery(estimate: Callable[[int], EnergyBudget],
+                               min_parallel_cells: int,
+                               cell_increment: int,
+                               verbose: bool = False) -> int:
+    """
+    Smallest number of cells in parallel (`min_parallel_cells` plus a multiple of
+    `cell_increment`) whose energy budget estimate isn't NO_FINISH.
+
+    The step doubles until a size isn't ruled out, then the last gap is bisected, so
+    this takes a logarithmic number of estimates. It assumes a bigger battery never
+    makes the estimate worse. If the car is estimated to be late, a bigger battery
+    can't help, so the search returns the current size and leaves it to the simulation.
+    """
+
+    def estimate_at(steps: int) -> EnergyBudget:
+        budget = estimate(min_parallel_cells + steps * cell_increment)
+        if verbose:
+            print(min_parallel_cells + steps * cell_increment, budget.verdict, budget.margin)
+        return budget
+
+    # Sizes up to `low` steps are ruled out and `high` steps isn't
+    low, high, step = -1, 0, 1
+    budget = estimate_at(high)
+    while budget.verdict == NO_FINISH:
+        if not budget.on_time:
+            break
+        low, high, step = high, high + step, step * 2
+        budget = estimate_at(high)
+    else:
+        while high - low > 1:
+            middle = (low + high) // 2
+            if estimate_at(middle).verdict == NO_FINISH:
+                low = middle
+            else:
+                high = middle
+
+    return min_parallel_cells + high * cell_increment
+
+
 # TODO: allow speeds and array power to be parameterized as a list or function
 def find_smallest_battery(race: Race,
                           car: Car,
@@ -101,52 +551,60 @@ def find_smallest_battery(race: Race,
                           array_power_factor: float,
                           min_parallel_cells: int,
                           cell_increment: int,
-                          verbose: bool = False) -> int:
+                          verbose: bool = False,
+                          prescreen: bool = False,
+                          uncertainty: float = UNCERTAINTY) -> int:
+    """
+    Find the smallest number of cells in parallel that allows the car to finish.
 
-    def end_simulation(state: State):
-        # out of power
-        if state.soc <= 0.0:
-            return False
-        if state.time > race.time_events[-1].time:
-            print('out of time')
-            return False
-        # end of the race
-        if state.distance >= race.distance_events[-1].distance:
-            return True
-        return None
+    :param race: Race to evaluate.
+    :param car: Car to evaluate the race with.
+    :param vehicle_speed: Target speed in m/s.
+    :param wind_speed: Constant wind speed in m/s.
+    :param array_power_factor: Scalar applied to the array power.
+    :param min_parallel_cells: Number of cells in parallel to start the search at.
+    :param cell_increment: Number of cells in parallel to add after each failure.
+    :param verbose: Print the result of each simulation.
+    :param prescreen: Start the search at the smallest battery size the energy budget
+    estimate doesn't rule out, found by bisecting on the estimate. The search simulates
+    from there as usual.
+    :param uncertainty: Half width of the estimate's SOC band around zero, see
+    `configuration_checker`.
 
-    def wind_func(distance: float, time: float):
-        return wind_speed  # <m/s>
+    :return: Number of cells in parallel.
+    """
 
-    def array_model(irradiance: float, sun_altitude: float, normalized: bool):
-        normalization_scalar = 1.0 if normalized else math.sin(
-            sun_altitude)
-        # TODO: don't hardcode these values
-        # area = 5.0 m^2, efficiency = 0.25
-        return array_power_factor * irradiance * normalization_scalar * 5.0 * 0.25
+    end_simulation = EndConditions.for_race(race)
 
-    result = False
+    wind_func = ConstantWind(wind_speed)
 
-    # Cells in parallel
-    parallel = min_parallel_cells
+    array_model = _make_array_model(array_power_factor)
 
-    # Loop until we're able to finish the race
-    while True:
+    result = False
 
-        # Add an additional 2 kg for every cell in parallel
-        mass = car.mass + parallel * 2.0
+    def make_car(parallel: int) -> Car:
+        mass = car.mass + parallel * BATTERY_MASS_PER_PARALLEL_CELL
 
         battery = Battery(car.battery.cell_esr,
                           car.battery.cells_in_series,
                           parallel,
                           car.battery.energy_per_cell)
 
-        new_car = Car(mass,
-                      car.cda,
-                      car.crr,
-                      car.powertrain_efficiency,
-                      car.motor_efficiency,
-                      battery)
+        return car.copy_with(mass=mass, battery=battery)
+
+    # Cells in parallel
+    parallel = min_parallel_cells
+
+    if prescreen:
+        parallel = _smallest_possible_battery(
+            lambda p: _estimate_configuration(race, make_car(p), vehicle_speed, wind_speed,
+                                              array_power_factor, uncertainty),
+            min_parallel_cells, cell_increment, verbose)
+
+    # Loop until we're able to finish the race
+    while True:
+
+        new_car = make_car(parallel)
 
         race_state = RaceActions(clock_running=False,
                                  charging=False,
@@ -175,6 +633,8 @@ def find_smallest_battery(race: Race,
                                                     state=state,
                                                     race_state=race_state,
                                                     target_speeds=target_speeds)
+        if not result and end_state.time > end_simulation.end_time:
+            print('out of time')
 
         min_soc = min(logged_states, key=lambda s: s[0].soc)[0].soc
         max_distance = max(logged_states, key=lambda s: s[0].distance)[
@@ -197,30 +657,1240 @@ def find_smallest_battery_cda_range(race: Race,
                                     wind_speed: float,
                                     array_power_factor: float,
                                     min_parallel_cells: int,
-                                    cell_increment: int) -> Dict[float, int]:
+                                    cell_increment: int,
+                                    journal_path: Optional[str] = None) -> Dict[float, int]:
+    """
+    Find the smallest battery for each CdA from 0.17 to 0.25.
 
+    :param journal_path: Path of a journal to record each CdA's result in. Rerunning
+    with the same journal skips the CdAs that are already done.
+    """
     results = {}
 
     cda = 0.17
 
     parallel = min_parallel_cells
 
-    while cda < 0.25:
+    with contextlib.ExitStack() as stack:
+        journal = None
+        if journal_path is not None:
+            journal = stack.enter_context(Journal(journal_path, fingerprint=(
+                'find_smallest_battery_cda_range', vehicle_speed, wind_speed, array_power_factor,
+                min_parallel_cells, cell_increment, car)))
+
+        while cda < 0.25:
 
-        new_car = Car(car.mass,
-                      cda,
-                      car.crr,
-                      car.powertrain_efficiency,
-                      car.motor_efficiency,
-                      car.battery)
+            key = round(cda, 6)
+            if journal is not None and key in journal.completed:
+                parallel = journal.completed[key]
+            else:
+                new_car = car.copy_with(cda=cda)
 
-        parallel = find_smallest_battery(
-            race, new_car, vehicle_speed, wind_speed, array_power_factor, parallel, cell_increment)
+                parallel = find_smallest_battery(
+                    race, new_car, vehicle_speed, wind_speed, array_power_factor, parallel, cell_increment)
 
-        results[cda] = parallel
+                if journal is not None:
+                    journal.finish(key, parallel)
+                    journal.flush()
 
-        print(cda, parallel)
+            results[cda] = parallel
 
-        cda += 0.01
+            print(cda, parallel)
+
+            cda += 0.01
 
     return results
+
+
+@dataclass(frozen=True)
+class StageRun:
+    """
+    Outcome of simulating one stage from a given starting SOC and time.
+    """
+    start_soc: float
+    start_time: float  # <s>
+    result: Any
+    end_soc: float
+    end_time: float  # <s>
+    min_soc: float
+    max_distance: float  # <m>
+
+
+@dataclass(frozen=True)
+class StitchedRace:
+    """
+    Result of `simulate_stages_parallel`.
+    """
+    result: Any
+    min_soc: float
+    max_distance: float  # <m>
+    stages: List[StageRun]  # the simulated run backing each stage that was reached
+    iterations: int
+    simulations: int
+    converged: bool  # False if the stages didn't stitch together and the race was simulated serially
+
+
+def _split_stages(race: Race) -> List[Tuple[float, float]]:
+    """
+    Split the race into stages that end at each `StageStop`.
+
+    :return: List of (start distance, end distance) tuples.
+    """
+    stops = [event.distance for event in race.distance_events
+             if isinstance(event, StageStop)]
+    if not stops or stops[-1] < race.distance_events[-1].distance:
+        stops.append(race.distance_events[-1].distance)
+    return list(zip([0.0] + stops[:-1], stops))
+
+
+def _run_stage(race: Race,
+               car: Car,
+               vehicle_speed: float,
+               wind_speed: float,
+               array_power_factor: float,
+               start_distance: float,
+               end_distance: float,
+               start_soc: float,
+               start_time: float,
+               dt: float,
+               integrator: str) -> StageRun:
+    """
+    Simulate a single stage starting from the given SOC and time.
+
+    The first stage starts the same way `_run_configuration` does. Later stages
+    start stopped at the previous stage stop, with only the events that haven't
+    happened yet.
+    """
+    end_simulation = EndConditions(finish_distance=end_distance, end_time=race.time_events[-1].time)
+
+    wind_func = ConstantWind(wind_speed)
+
+    if start_distance == 0.0:
+        stage = race
+        race_state = RaceActions(clock_running=False,
+                                 charging=False,
+                                 driving=False,
+                                 normalized=False,
+                                 grid_charging=False,
+                                 race_hours=False)
+    else:
+        stage = Race(distance_events=[e for e in race.distance_events
+                                      if start_distance < e.distance <= end_distance],
+                     time_events=[e for e in race.time_events if e.time >= start_time],
+                     speed_limits=race.speed_limits,
+                     route=race.route)
+        # Same as arriving at a stage stop
+        race_state = RaceActions(clock_running=False,
+                                 charging=True,
+                                 driving=False,
+                                 normalized=True,
+                                 grid_charging=False,
+                                 race_hours=False)
+
+    battery_size = car.battery.energy_per_cell * \
+        (car.battery.cells_in_series * car.battery.cells_in_parallel)
+    state = State(distance=start_distance, energy=start_soc * battery_size,
+                  soc=start_soc, time=start_time)
+
+    result, end_state, logged_states = simulate(race=stage,
+                                                car=car,
+                                                wind_func=wind_func,
+                                                array_model=_make_array_model(array_power_factor),
+                                                end_simulation=end_simulation,
+                                                battery_size=battery_size,
+                                                state=state,
+                                                race_state=race_state,
+                                                target_speeds=[(0.0, vehicle_speed)],
+                                                dt=dt,
+                                                integrator=integrator)
+    if not result and end_state.time > end_simulation.end_time:
+        print('out of time')
+
+    return StageRun(start_soc=start_soc,
+                    start_time=start_time,
+                    result=result,
+                    end_soc=end_state.soc,
+                    end_time=end_state.time,
+                    min_soc=min(s[0].soc for s in logged_states),
+                    max_distance=max(s[0].distance for s in logged_states))
+
+
+def _run_stage_args(args: Tuple) -> StageRun:
+    return _run_stage(*_attached(args))
+
+
+def simulate_stages_parallel(race: Race,
+                             car: Car,
+                             vehicle_speed: float,
+                             wind_speed: float,
+                             array_power_factor: float,
+                             dt: float = 1.0,
+                             integrator: str = EULER,
+                             soc_spread: float = 0.05,
+                             soc_tolerance: float = 0.002,
+                             time_tolerance: float = 60.0,
+                             coarse_dt: float = 60.0,
+                             max_iterations: int = 10,
+                             max_workers: Optional[int] = None,
+                             fallback: bool = True) -> StitchedRace:
+    """
+    Simulate the race with every stage running at the same time in worker processes.
+
+    Stages only depend on each other through the SOC and arrival time at each stage stop,
+    so this works like parareal. A cheap RK2 run of the whole race guesses those boundary
+    values. Every stage is then simulated in parallel from the guessed arrival time and a
+    few SOCs around the guessed SOC. The stages are stitched together in order by
+    interpolating each stage's outcome at the SOC the previous stage actually ended with.
+    Stages whose stitched start isn't within tolerance of a run that was actually done
+    are re-run from the stitched start, again all in parallel, until the chain is consistent.
+
+    The outcome only comes from a chain of stages that were all actually simulated. If
+    the chain still relies on an interpolated stage after `max_iterations` rounds, the
+    whole race is simulated serially instead (or a RuntimeError is raised).
+
+    :param race: Race to simulate.
+    :param car: Car to simulate the race with.
+    :param vehicle_speed: Target speed in m/s.
+    :param wind_speed: Constant wind speed in m/s.
+    :param array_power_factor: Scalar applied to the array power.
+    :param dt: Time step for the stage simulations.
+    :param integrator: Integrator for the stage simulations.
+    :param soc_spread: Spacing of the SOCs run around the first guess for each stage.
+    :param soc_tolerance: How close a stage's starting SOC has to be to the stitched SOC.
+    :param time_tolerance: How close a stage's starting time has to be to the stitched time.
+    :param coarse_dt: Time step for the RK2 run that makes the first guesses.
+    :param max_iterations: Maximum number of parallel rounds.
+    :param max_workers: Number of worker processes (defaults to the number of CPUs).
+    :param fallback: Simulate the race serially if the stages don't converge, instead of
+    raising a RuntimeError.
+
+    :return: StitchedRace with the overall outcome and the run used for each stage.
+    """
+    stages = _split_stages(race)
+
+    # Coarse run of the whole race to guess the SOC and time at each stage stop
+    battery_size = car.battery.energy_per_cell * \
+        (car.battery.cells_in_series * car.battery.cells_in_parallel)
+
+    _, _, coarse_states = simulate(race=race,
+                                   car=car,
+                                   wind_func=ConstantWind(wind_speed),
+                                   array_model=_make_array_model(array_power_factor),
+                                   end_simulation=EndConditions.for_race(race),
+                                   battery_size=battery_size,
+                                   state=State(distance=0.0, energy=battery_size, soc=1.0,
+                                               time=race.time_events[0].time),
+                                   race_state=RaceActions(clock_running=False,
+                                                          charging=False,
+                                                          driving=False,
+                                                          normalized=False,
+                                                          grid_charging=False,
+                                                          race_hours=False),
+                                   target_speeds=[(0.0, vehicle_speed)],
+                                   dt=coarse_dt,
+                                   integrator=RK2,
+                                   stationary_integrator=True)
+
+    guesses = [(1.0, race.time_events[0].time)]
+    for start_distance, _ in stages[1:]:
+        arrival = next((s for s, _, _ in coarse_states if s.distance >= start_distance),
+                       coarse_states[-1][0])
+        guesses.append((min(max(arrival.soc, soc_spread), 1.0), arrival.time))
+
+    def is_close(run, soc, time):
+        return abs(run.start_soc - soc) <= soc_tolerance and abs(run.start_time - time) <= time_tolerance
+
+    runs: List[List[StageRun]] = [[] for _ in stages]
+
+    # First round: every stage at a few SOCs around its guess
+    tasks = []
+    for index, ((start_distance, end_distance), (soc, time)) in enumerate(zip(stages, guesses)):
+        socs = [soc] if index == 0 else \
+            sorted({min(max(soc + offset * soc_spread, 0.0), 1.0) for offset in (-1, 0, 1)})
+        tasks.extend((index, s, time) for s in socs)
+
+    iterations = 0
+    simulations = 0
+    chain: List[StageRun] = []
+    simulated = 0
+
+    with SharedRegistry() as registry, ProcessPoolExecutor(max_workers=max_workers) as executor:
+        handle = publish_race(registry, race)
+
+        while tasks and iterations < max_iterations:
+            iterations += 1
+            simulations += len(tasks)
+
+            outcomes = executor.map(_run_stage_args,
+                                    [(handle, car, vehicle_speed, wind_speed, array_power_factor,
+                                      *stages[index], soc, time, dt, integrator)
+                                     for index, soc, time in tasks])
+            for (index, _, _), run in zip(tasks, outcomes):
+                runs[index].append(run)
+
+            # Stitch the stages together in order
+            tasks = []
+            chain = []
+            simulated = 0  # stages at the start of the chain that don't rely on an interpolated stage
+            soc, time = guesses[0]
+            for index in range(len(stages)):
+                exact = [run for run in runs[index] if is_close(run, soc, time)]
+                if exact:
+                    run = min(exact, key=lambda r: abs(r.start_soc - soc))
+                    if simulated == len(chain):
+                        simulated += 1
+                else:
+                    # Interpolate between the runs that started at about the same time
+                    tasks.append((index, soc, time))
+                    run = _interpolate_stage(
+                        [r for r in runs[index] if abs(r.start_time - time) <= time_tolerance],
+                        soc, time)
+                    if run is None:
+                        break
+
+                chain.append(run)
+                if not run.result:
+                    break
+                soc, time = run.end_soc, run.end_time
+
+    # Stitching only left no tasks if every stage in the chain was simulated from its stitched start
+    if not tasks:
+        return StitchedRace(result=all(run.result for run in chain) and len(chain) == len(stages),
+                            min_soc=min(run.min_soc for run in chain),
+                            max_distance=max(run.max_distance for run in chain),
+                            stages=chain,
+                            iterations=iterations,
+                            simulations=simulations,
+                            converged=True)
+
+    if not fallback:
+        raise RuntimeError(f'The stages didn\'t converge in {max_iterations} iterations')
+    print(f'The stages didn\'t converge in {max_iterations} iterations, simulating the race serially.')
+
+    serial = _run_stage(race, car, vehicle_speed, wind_speed, array_power_factor,
+                        0.0, stages[-1][1], 1.0, race.time_events[0].time, dt, integrator)
+    return StitchedRace(result=serial.result,
+                        min_soc=serial.min_soc,
+                        max_distance=serial.max_distance,
+                        stages=chain[:simulated],
+                        iterations=iterations,
+                        simulations=simulations + 1,
+                        converged=False)
+
+
+def _interpolate_stage(runs: List[StageRun], soc: float, time: float) -> Optional[StageRun]:
+    """
+    Linearly interpolate the outcome of a stage between runs that started at different SOCs.
+
+    :return: Interpolated StageRun, or None if `soc` isn't bracketed by successful runs.
+    """
+    below = [run for run in runs if run.start_soc <= soc]
+    above = [run for run in runs if run.start_soc >= soc]
+    if not below or not above:
+        return None
+
+    low = max(below, key=lambda r: r.start_soc)
+    high = min(above, key=lambda r: r.start_soc)
+    if not (low.result and high.result):
+        return None
+
+    f = 0.0 if high.start_soc == low.start_soc else \
+        (soc - low.start_soc) / (high.start_soc - low.start_soc)
+
+    def lerp(a, b):
+        return a + f * (b - a)
+
+    return StageRun(start_soc=soc,
+                    start_time=time,
+                    result=True,
+                    end_soc=lerp(low.end_soc, high.end_soc),
+                    end_time=lerp(low.end_time, high.end_time),
+                    min_soc=lerp(low.min_soc, high.min_soc),
+                    max_distance=high.max_distance)
+
+
+@dataclass
+class EnsembleSummary:
+    """
+    Streaming aggregate of a Monte Carlo weather ensemble.
+
+    The stop sketches are keyed by the stop's index in `race.distance_events`, since
+    names can repeat or be missing. Arrival times are in seconds after the start of the
+    race. Stops that a member never reached don't contribute to that stop's sketches.
+    """
+    members: int
+    finished: int
+    min_soc: HistogramSketch
+    stop_soc: Dict[int, HistogramSketch]
+    stop_arrival: Dict[int, HistogramSketch]
+    log_usage: LogUsage = field(default_factory=LogUsage)  # memory the members' logs used
+
+    @property
+    def finish_probability(self) -> float:
+        return self.finished / self.members if self.members else math.nan
+
+    def add(self, result: Any, min_soc: float, stops: List[Optional[Tuple[float, float]]]) -> None:
+        """
+        Fold one member into the aggregate.
+
+        :param result: Whether or not the member finished.
+        :param min_soc: Minimum SOC of the member.
+        :param stops: SOC and arrival time at each of the race's stops in order,
+        or None for stops that weren't reached.
+        """
+        self.members += 1
+        self.finished += 1 if result else 0
+        self.min_soc.add(min_soc)
+        for index, stop in enumerate(stops):
+            if stop is not None:
+                self.stop_soc[index].add(stop[0])
+                self.stop_arrival[index].add(stop[1])
+
+
+def _batched(iterable, n: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, n)):
+        yield batch
+
+
+def _sample_member(seed: int,
+                   index: int,
+                   wind_speed: Tuple[float, float],
+                   array_power_factor: Tuple[float, float]) -> Tuple[float, float]:
+    """
+    Sample the weather for one ensemble member.
+
+    Each member has its own generator so results don't depend on how members are
+    batched or which worker runs them.
+
+    :return: Tuple of wind speed and array power factor.
+    """
+    rng = random.Random(seed * 1_000_003 + index)
+    return rng.gauss(*wind_speed), max(rng.gauss(*array_power_factor), 0.0)
+
+
+def _run_member(race: Race,
+                car: Car,
+                vehicle_speed: float,
+                wind_speed: float,
+                array_power_factor: float,
+                dt: float,
+                integrator: str,
+                log_budget: Optional[int] = None,
+                log_overflow: str = DECIMATE) -> Tuple[Any, float, List[Optional[Tuple[float, float]]], LogStats]:
+    """
+    Simulate one ensemble member and reduce its log to the SOC and time at each stop
+    and the memory it used.
+    """
+    battery_size = car.battery.energy_per_cell * \
+        (car.battery.cells_in_series * car.battery.cells_in_parallel)
+    start_time = race.time_events[0].time
+
+    result, _, logged_states = simulate(race=race,
+                                        car=car,
+                                        wind_func=ConstantWind(wind_speed),
+                                        array_model=_make_array_model(array_power_factor),
+                                        end_simulation=EndConditions.for_race(race),
+                                        battery_size=battery_size,
+                                        state=State(distance=0.0, energy=battery_size,
+                                                    soc=1.0, time=start_time),
+                                        race_state=RaceActions(clock_running=False,
+                                                               charging=False,
+                                                               driving=False,
+                                                               normalized=False,
+                                                               grid_charging=False,
+                                                               race_hours=False),
+                                        target_speeds=[(0.0, vehicle_speed)],
+                                        dt=dt,
+                                        integrator=integrator,
+                                        log=StateLog(max_bytes=log_budget, overflow=log_overflow))
+
+    return result, min(s[0].soc for s in logged_states), _stop_states(race, logged_states), LogStats.of(logged_states)
+
+
+def _run_member_args(args: Tuple) -> Tuple[Any, float, List[Optional[Tuple[float, float]]], LogStats]:
+    return _run_member(*_attached(args))
+
+
+def run_weather_ensemble(race: Race,
+                         car: Car,
+                         vehicle_speed: float,
+                         members: int,
+                         seed: int = 0,
+                         wind_speed: Tuple[float, float] = (0.0, 2.0),
+                         array_power_factor: Tuple[float, float] = (1.0, 0.1),
+                         dt: float = 1.0,
+                         integrator: str = EULER,
+                         batch_size: int = 256,
+                         max_workers: Optional[int] = None,
+                         journal_path: Optional[str] = None,
+                         log_budget: Optional[int] = None,
+                         log_overflow: str = DECIMATE) -> EnsembleSummary:
+    """
+    Run a Monte Carlo ensemble of weather and array performance at a constant target speed.
+
+    Each member draws a wind speed and an array power factor from normal distributions.
+    Members run in parallel and are folded into fixed-size aggregates as they finish,
+    so memory use doesn't grow with the number of members.
+
+    :param race: Race to evaluate.
+    :param car: Car to evaluate the race with.
+    :param vehicle_speed: Target speed in m/s.
+    :param members: Number of ensemble members.
+    :param seed: Seed for the ensemble. The same seed always gives the same members.
+    :param wind_speed: (mean, standard deviation) of the wind speed in m/s.
+    :param array_power_factor: (mean, standard deviation) of the array power factor.
+    :param dt: Time step for each simulation.
+    :param integrator: Integrator for each simulation.
+    :param batch_size: Number of members handed to the pool at a time.
+    :param max_workers: Number of worker processes (defaults to the number of CPUs).
+    :param journal_path: Path of a journal to record each member's outcome in. Rerunning
+    with the same journal only runs the members that aren't done yet.
+    :param log_budget: Most bytes of log each member keeps in memory, or None for no
+    limit. Bounds the memory of every worker process when members run for many days.
+    :param log_overflow: What the logs do when they reach the budget, see StateLog.
+
+    :return: EnsembleSummary with the finish probability and distributions at each stop.
+    """
+    duration = race.time_events[-1].time - race.time_events[0].time
+    stops = range(len(race.distance_events))
+
+    summary = EnsembleSummary(members=0,
+                              finished=0,
+                              min_soc=HistogramSketch(-0.1, 1.1),
+                              stop_soc={index: HistogramSketch(-0.1, 1.1) for index in stops},
+                              stop_arrival={index: HistogramSketch(0.0, duration) for index in stops})
+
+    def tasks():
+        for index in range(members):
+            yield index, (handle, car, vehicle_speed,
+                          *_sample_member(seed, index, wind_speed, array_power_factor),
+                          dt, integrator, log_budget, log_overflow)
+
+    with contextlib.ExitStack() as stack:
+        handle = publish_race(stack.enter_context(SharedRegistry()), race)
+        executor = stack.enter_context(ProcessPoolExecutor(max_workers=max_workers))
+
+        if journal_path is not None:
+            fingerprint = ('run_weather_ensemble', vehicle_speed, members, seed, wind_speed,
+                           array_power_factor, dt, integrator, car)
+            if log_budget is not None and log_overflow == DECIMATE:
+                # decimated logs give slightly different stop times
+                fingerprint += (log_budget,)
+            journal = stack.enter_context(Journal(journal_path, fingerprint=fingerprint))
+            outcomes = (outcome for _, outcome in run_journaled(journal, executor, _run_member_args, tasks(),
+                                                                window=batch_size))
+        else:
+            outcomes = itertools.chain.from_iterable(
+                executor.map(_run_member_args, [args for _, args in batch])
+                for batch in _batched(tasks(), batch_size))
+
+        for outcome in outcomes:
+            summary.add(*outcome[:3])
+            if len(outcome) > 3:  # journals written before the stats were returned don't have them
+                summary.log_usage.add(outcome[3])
+
+            if summary.members % batch_size == 0 or summary.members == members:
+                print(f'{summary.members}/{members} members, '
+                      f'finish probability {summary.finish_probability:.3f}')
+
+    print(f'Logs: {summary.log_usage}')
+
+    return summary
+
+
+SENSITIVITY_PARAMETERS = ('mass', 'cda', 'crr', 'powertrain_efficiency', 'idle_power_loss', 'battery')
+"""
+Car parameters `car_sensitivities` can perturb. `battery` perturbs the energy per cell,
+which scales the battery size without changing the pack voltage or ESR.
+"""
+
+
+@dataclass(frozen=True)
+class Outcome:
+    """
+    Summary of one simulation used by the sensitivity analysis and design searches.
+    """
+    result: Any
+    final_soc: float
+    min_soc: float
+    finish_time: float  # <s> after the start of the race, NaN if the car didn't finish
+    end_distance: float  # <m>
+    end_time: float  # <s> since the unix epoch
+
+
+@dataclass
+class SensitivityReport:
+    """
+    Central difference sensitivities of the race outcome to the car parameters.
+
+    `sensitivities[parameter][metric]` is the derivative of the metric (`final_soc`,
+    `min_soc`, or `finish_time`) with respect to the parameter in the parameter's own
+    units (per Joule per cell for `battery`).
+    """
+    baseline: Outcome
+    steps: Dict[str, float]
+    sensitivities: Dict[str, Dict[str, float]]
+    crosses_boundary: Set[str]  # parameters where one side finished and the other didn't
+
+    def elasticity(self, car: Car, parameter: str, metric: str) -> float:
+        """
+        Change in the metric for a 1% change in the parameter.
+
+        :param car: Car the report was made for.
+        :param parameter: Name of the car parameter.
+        :param metric: Name of the outcome metric.
+
+        :return: Change in the metric in the metric's units.
+        """
+        return 0.01 * _get_parameter(car, parameter) * self.sensitivities[parameter][metric]
+
+
+def _get_parameter(car: Car, parameter: str) -> float:
+    if parameter == 'battery':
+        return car.battery.energy_per_cell
+    return getattr(car, parameter)
+
+
+def _set_parameter(car: Car, parameter: str, value: float) -> Car:
+    if parameter == 'battery':
+        return car.copy_with(battery=dataclasses.replace(car.battery, energy_per_cell=value))
+    return car.copy_with(**{parameter: value})
+
+
+def _reduce_run(race: Race, result: Any, end_state: State, logged_states: List[Tuple]) -> Outcome:
+    """
+    Reduce a run from a full battery at the start of the race to an Outcome.
+    """
+    return Outcome(result=result,
+                   final_soc=end_state.soc,
+                   min_soc=min(s[0].soc for s in logged_states),
+                   finish_time=end_state.time - race.time_events[0].time if result else math.nan,
+                   end_distance=end_state.distance,
+                   end_time=end_state.time)
+
+
+def _outcome_spec(car: Car,
+                  vehicle_speed: float,
+                  wind_speed: float,
+                  array_power_factor: float,
+                  dt: float,
+                  integrator: str) -> ScenarioSpec:
+    """
+    Scenario for a run at a constant target speed from a full battery, for `_run_scenario`.
+    """
+    return ScenarioSpec(car=car,
+                        target_speeds=((0.0, vehicle_speed),),
+                        wind=ConstantWind(wind_speed),
+                        array_model=FlatArray(array_power_factor),
+                        dt=dt,
+                        integrator=integrator)
+
+
+def _run_scenario(handle: RaceHandle, spec: ScenarioSpec) -> Outcome:
+    """
+    Attach to a race published with `publish_race` and simulate a scenario on it.
+    """
+    race = handle.attach()
+    return _reduce_run(race, *spec.simulate(race, handle.attach_irradiance_raster()))
+
+
+def run_scenarios(race: Race,
+                  specs: List[ScenarioSpec],
+                  irradiance_raster: Optional[IrradianceRaster] = None,
+                  max_workers: Optional[int] = None) -> List[Outcome]:
+    """
+    Simulate many scenarios of one race in parallel.
+
+    The race and irradiance raster are put into shared memory once, so each task only
+    sends its ScenarioSpec and a handle to the race (under a kilobyte) to the workers.
+
+    :param race: Race to simulate.
+    :param specs: Scenarios to simulate.
+    :param irradiance_raster: Precomputed solar altitude and irradiance along the route.
+    :param max_workers: Number of worker processes (defaults to the CPU count).
+
+    :return: Outcome of each scenario in the same order as `specs`.
+    """
+    with SharedRegistry() as registry:
+        handle = publish_race(registry, race, irradiance_raster)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(_run_scenario, itertools.repeat(handle, len(specs)), specs))
+
+
+def car_sensitivities(race: Race,
+                      car: Car,
+                      vehicle_speed: float,
+                      wind_speed: float = 0.0,
+                      array_power_factor: float = 1.0,
+                      parameters: Tuple[str, ...] = SENSITIVITY_PARAMETERS,
+                      relative_step: float = 0.01,
+                      dt: float = 1.0,
+                      integrator: str = EULER,
+                      irradiance_raster: Optional[IrradianceRaster] = None,
+                      max_workers: Optional[int] = None,
+                      verbose: bool = True) -> SensitivityReport:
+    """
+    Calculate the sensitivity of the final SOC, minimum SOC, and finish time to the car parameters.
+
+    Each parameter is perturbed up and down by `relative_step` of its value with
+    `Car.copy_with` and the derivative is taken from the central difference, so the
+    baseline plus 2 runs per parameter are simulated together in one parallel batch.
+    Every run uses the same irradiance raster so the sun's position is only calculated
+    once. The finish time is NaN when either side didn't finish.
+
+    :param race: Race to evaluate.
+    :param car: Car to evaluate the race with.
+    :param vehicle_speed: Target speed in m/s.
+    :param wind_speed: Constant wind speed in m/s.
+    :param array_power_factor: Scalar applied to the array power.
+    :param parameters: Names of the car parameters to perturb (see SENSITIVITY_PARAMETERS).
+    :param relative_step: Size of the perturbation relative to each parameter's value.
+    :param dt: Time step for each simulation.
+    :param integrator: Integrator for each simulation.
+    :param irradiance_raster: Raster to share between the runs. One is built for the
+    race in a temporary file when this isn't provided.
+    :param max_workers: Number of worker processes (defaults to the number of CPUs).
+    :param verbose: Print a table of the elasticities.
+
+    :return: SensitivityReport with the derivatives of each metric.
+    """
+    for parameter in parameters:
+        if parameter not in SENSITIVITY_PARAMETERS:
+            raise ValueError(f'Unknown sensitivity parameter `{parameter}`')
+
+    with tempfile.TemporaryDirectory() as directory:
+        if irradiance_raster is None:
+            irradiance_raster = build_irradiance_raster(race, os.path.join(directory, 'irradiance.bin'))
+
+        steps = {parameter: relative_step * abs(_get_parameter(car, parameter)) for parameter in parameters}
+
+        cars = [car]
+        for parameter in parameters:
+            value = _get_parameter(car, parameter)
+            cars.append(_set_parameter(car, parameter, value + steps[parameter]))
+            cars.append(_set_parameter(car, parameter, value - steps[parameter]))
+
+        specs = [_outcome_spec(c, vehicle_speed, wind_speed, array_power_factor, dt, integrator) for c in cars]
+        outcomes = run_scenarios(race, specs, irradiance_raster, max_workers)
+
+    baseline = outcomes[0]
+    sensitivities = {}
+    crosses_boundary = set()
+    for i, parameter in enumerate(parameters):
+        up, down = outcomes[1 + 2 * i], outcomes[2 + 2 * i]
+        if up.result != down.result:
+            crosses_boundary.add(parameter)
+        h = 2.0 * steps[parameter]
+        sensitivities[parameter] = {metric: (getattr(up, metric) - getattr(down, metric)) / h if h else math.nan
+                                    for metric in ('final_soc', 'min_soc', 'finish_time')}
+
+    report = SensitivityReport(baseline=baseline,
+                               steps=steps,
+                               sensitivities=sensitivities,
+                               crosses_boundary=crosses_boundary)
+
+    if verbose:
+        print(f'baseline: result={baseline.result} final soc={baseline.final_soc:.4f} '
+              f'min soc={baseline.min_soc:.4f} finish time={baseline.finish_time:.0f} s')
+        print('change for +1% of each parameter')
+        print('parameter               final soc     min soc  finish time (s)')
+        for parameter in parameters:
+            flag = '  (crosses finish boundary)' if parameter in crosses_boundary else ''
+            print(f'{parameter:<22}'
+                  f'{report.elasticity(car, parameter, "final_soc"):10.5f}'
+                  f'{report.elasticity(car, parameter, "min_soc"):12.5f}'
+                  f'{report.elasticity(car, parameter, "finish_time"):17.1f}{flag}')
+
+    return report
+
+
+@dataclass(frozen=True)
+class Design:
+    """
+    One candidate car design for the Pareto explorer.
+    """
+    cda: float  # <m^2>
+    crr: float
+    mass: float  # <kg> without the battery
+    parallel: int  # cells in parallel
+    array_power_factor: float
+
+
+@dataclass(frozen=True)
+class DesignResult:
+    """
+    Simulated outcome of a candidate design.
+    """
+    design: Design
+    battery_mass: float  # <kg>
+    outcome: Outcome
+
+
+class ParetoArchive:
+    """
+    Incrementally maintained set of the non-dominated designs that finish.
+
+    A design dominates another when it is no worse on every objective and better on
+    at least one. The objectives are lower battery mass, higher finish margin (minimum
+    SOC over the race), and lower cda.
+    """
+
+    COLUMNS = ('cda', 'crr', 'mass', 'parallel', 'array_power_factor',
+               'battery_mass', 'min_soc', 'final_soc', 'finish_time')
+
+    def __init__(self):
+        self.members: List[DesignResult] = []
+
+    @staticmethod
+    def _objectives(r: DesignResult) -> Tuple[float, float, float]:
+        # All minimized
+        return r.battery_mass, -r.outcome.min_soc, r.design.cda
+
+    @staticmethod
+    def dominates(a: DesignResult, b: DesignResult) -> bool:
+        """
+        :return: Whether or not `a` dominates `b`.
+        """
+        a_objectives = ParetoArchive._objectives(a)
+        b_objectives = ParetoArchive._objectives(b)
+        return all(x <= y for x, y in zip(a_objectives, b_objectives)) and a_objectives != b_objectives
+
+    def add(self, result: DesignResult) -> bool:
+        """
+        Add a design to the archive, dropping any members it dominates.
+
+        :param result: Simulated design.
+
+        :return: Whether or not the design was added.
+        """
+        if not result.outcome.result:
+            return False
+        if any(self.dominates(member, result) for member in self.members):
+            return False
+        self.members = [member for member in self.members if not self.dominates(result, member)]
+        self.members.append(result)
+        return True
+
+    def rows(self) -> List[Tuple]:
+        """
+        :return: One row per member in the order of COLUMNS, sorted by battery mass.
+        """
+        return [(r.design.cda, r.design.crr, r.design.mass, r.design.parallel, r.design.array_power_factor,
+                 r.battery_mass, r.outcome.min_soc, r.outcome.final_soc, r.outcome.finish_time)
+                for r in sorted(self.members, key=self._objectives)]
+
+    def write_csv(self, file_path: str) -> None:
+        """
+        Write the archive to a CSV file.
+
+        :param file_path: Path of the file to write.
+        """
+        with open(file_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.COLUMNS)
+            writer.writerows(self.rows())
+
+
+def explore_designs(race: Race,
+                    car: Car,
+                    vehicle_speed: float,
+                    cdas: List[float],
+                    crrs: List[float],
+                    masses: List[float],
+                    parallels: List[int],
+                    array_power_factors: List[float],
+                    wind_speed: float = 0.0,
+                    dt: float = 1.0,
+                    integrator: str = EULER,
+                    cache_path: Optional[str] = None,
+                    csv_path: Optional[str] = None,
+                    irradiance_raster: Optional[IrradianceRaster] = None,
+                    max_workers: Optional[int] = None) -> ParetoArchive:
+    """
+    Explore the grid of car designs and keep the Pareto set of battery mass, finish margin, and cda.
+
+    Designs are simulated in a process pool and folded into the archive as they complete.
+    Outcomes are stored in a `shelve` cache so an interrupted or extended exploration only
+    simulates the designs it hasn't seen. The cache key covers the car and simulation
+    settings but not the race, so use one cache file per race.
+
+    :param race: Race to evaluate.
+    :param car: Car the designs are based on. Its battery supplies the cell parameters.
+    :param vehicle_speed: Target speed in m/s.
+    :param cdas: Values of cda to explore.
+    :param crrs: Values of crr to explore.
+    :param masses: Car masses without the battery to explore in kg.
+    :param parallels: Numbers of cells in parallel to explore.
+    :param array_power_factors: Array power factors to explore.
+    :param wind_speed: Constant wind speed in m/s.
+    :param dt: Time step for each simulation.
+    :param integrator: Integrator for each simulation.
+    :param cache_path: Path of the `shelve` cache (no caching when None).
+    :param csv_path: Path to write the Pareto set to as CSV (not written when None).
+    :param irradiance_raster: Raster to share between the runs. One is built for the
+    race in a temporary file when this isn't provided.
+    :param max_workers: Number of worker processes (defaults to the number of CPUs).
+
+    :return: ParetoArchive of the non-dominated designs.
+    """
+    designs = [Design(*values) for values in itertools.product(cdas, crrs, masses, parallels, array_power_factors)]
+
+    def make_car(design: Design) -> Car:
+        return car.copy_with(cda=design.cda,
+                             crr=design.crr,
+                             mass=design.mass + design.parallel * BATTERY_MASS_PER_PARALLEL_CELL,
+                             battery=dataclasses.replace(car.battery, cells_in_parallel=design.parallel))
+
+    def make_key(design_car: Car, design: Design) -> str:
+        return repr((design_car, design.array_power_factor, vehicle_speed, wind_speed, dt, integrator))
+
+    archive = ParetoArchive()
+    done = 0
+
+    def record(design: Design, outcome: Outcome) -> None:
+        nonlocal done
+        done += 1
+        added = archive.add(DesignResult(design=design,
+                                         battery_mass=design.parallel * BATTERY_MASS_PER_PARALLEL_CELL,
+                                         outcome=outcome))
+        if added:
+            print(f'{done}/{len(designs)} {design} min soc {outcome.min_soc:.4f} '
+                  f'(archive size {len(archive.members)})')
+
+    with contextlib.ExitStack() as stack:
+        cache = stack.enter_context(shelve.open(cache_path)) if cache_path is not None else {}
+
+        pending = []
+        for design in designs:
+            design_car = make_car(design)
+            key = make_key(design_car, design)
+            if key in cache:
+                record(design, cache[key])
+            else:
+                pending.append((design, design_car, key))
+
+        if pending:
+            if irradiance_raster is None:
+                directory = stack.enter_context(tempfile.TemporaryDirectory())
+                irradiance_raster = build_irradiance_raster(race, os.path.join(directory, 'irradiance.bin'))
+
+            handle = publish_race(stack.enter_context(SharedRegistry()), race, irradiance_raster)
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=max_workers))
+            futures = {executor.submit(_run_scenario, handle,
+                                       _outcome_spec(design_car, vehicle_speed, wind_speed,
+                                                     design.array_power_factor, dt, integrator)): (design, key)
+                       for design, design_car, key in pending}
+
+            for future in as_completed(futures):
+                design, key = futures[future]
+                outcome = future.result()
+                cache[key] = outcome
+                record(design, outcome)
+
+    if csv_path is not None:
+        archive.write_csv(csv_path)
+
+    return archive
+
+
+@dataclass(frozen=True)
+class FrontierViolation:
+    """
+    A probe that contradicts the minimal battery growing with cda.
+    """
+    cda: float
+    parallel: int  # cells in parallel that were probed
+    finished: bool  # what the simulation found (the opposite of what was expected)
+    neighbors: Tuple[float, float]  # cda values whose answers bracketed the probe
+
+
+@dataclass
+class BatteryFrontier:
+    """
+    Minimal cells in parallel for each cda, None where even the largest battery didn't finish.
+    """
+    results: Dict[float, Optional[int]]
+    violations: List[FrontierViolation]
+
+
+class _ParallelCellSearch:
+    """
+    Integer search for the smallest number of cells in parallel that finishes at one cda.
+    """
+
+    def __init__(self, index: int, min_parallel_cells: int, max_parallel_cells: int,
+                 checks: List[Tuple[int, bool]], neighbors: Tuple[float, float]):
+        self.index = index
+        self.min_parallel_cells = min_parallel_cells
+        self.max_parallel_cells = max_parallel_cells
+        self.checks = checks  # (parallel, expected to finish) to verify before searching
+        self.neighbors = neighbors
+        self.finished: Dict[int, bool] = {}
+
+    @property
+    def high(self) -> Optional[int]:
+        feasible = [n for n, finished in self.finished.items() if finished]
+        return min(feasible) if feasible else None
+
+    @property
+    def low(self) -> int:
+        high = self.high
+        infeasible = [n for n, finished in self.finished.items()
+                      if not finished and (high is None or n < high)]
+        return max(infeasible, default=self.min_parallel_cells - 1)
+
+    @property
+    def done(self) -> bool:
+        if self.checks:
+            return False
+        high = self.high
+        if high is None:
+            return self.finished.get(self.max_parallel_cells) is False
+        return high - self.low <= 1
+
+    def probes(self, sections: int) -> List[int]:
+        if self.checks:
+            return [n for n, _ in self.checks]
+        low, high = self.low, self.high
+        if high is None:
+            return [self.max_parallel_cells]
+        return sorted({low + round(s * (high - low) / sections) for s in range(1, sections)} - {low, high})
+
+    def update(self, cdas: List[float], results: Dict[Tuple[int, int], bool]) -> List[FrontierViolation]:
+        violations = []
+        for n, expected in self.checks:
+            finished = results[(self.index, n)]
+            if finished != expected:
+                violations.append(FrontierViolation(cda=cdas[self.index], parallel=n,
+                                                    finished=finished, neighbors=self.neighbors))
+        self.checks = []
+        return violations
+
+
+def trace_battery_frontier(race: Race,
+                           car: Car,
+                           vehicle_speed: float,
+                           wind_speed: float,
+                           array_power_factor: float,
+                           cdas: List[float],
+                           min_parallel_cells: int,
+                           max_parallel_cells: int,
+                           sections: int = 2,
+                           dt: float = 1.0,
+                           integrator: str = EULER,
+                           irradiance_raster: Optional[IrradianceRaster] = None,
+                           max_workers: Optional[int] = None) -> BatteryFrontier:
+    """
+    Find the smallest battery that finishes for each cda by tracing the frontier.
+
+    The minimal number of cells in parallel is expected to grow with cda. The first and
+    last cda are searched over the whole range, then cda values are solved midpoint-first,
+    each one searched only between the answers of the two already solved cda values on
+    either side of it. Both ends of that bracket are simulated to confirm it holds, and
+    any probe that contradicts the ordering is reported as a violation (and the search
+    widens past the bracket) instead of being assumed away. Every cda at the same level
+    is searched at once, and each search probes `sections - 1` battery sizes per round,
+    so each round is one parallel batch of simulations.
+
+    :param race: Race to evaluate.
+    :param car: Car to evaluate the race with. Its battery supplies the cell parameters.
+    :param vehicle_speed: Target speed in m/s.
+    :param wind_speed: Constant wind speed in m/s.
+    :param array_power_factor: Scalar applied to the array power.
+    :param cdas: Values of cda to solve.
+    :param min_parallel_cells: Smallest number of cells in parallel to consider.
+    :param max_parallel_cells: Largest number of cells in parallel to consider.
+    :param sections: Number of sections each bracket is split into per round, at least 2.
+    :param dt: Time step for each simulation.
+    :param integrator: Integrator for each simulation.
+    :param irradiance_raster: Raster to share between the runs. One is built for the
+    race in a temporary file when this isn't provided.
+    :param max_workers: Number of worker processes (defaults to the number of CPUs).
+
+    :return: BatteryFrontier with the minimal cells in parallel for each cda and any violations.
+    """
+    # With fewer than 2 sections no battery size is probed, so no search would ever narrow
+    if sections < 2:
+        raise ValueError(f'sections must be at least 2, not {sections}')
+
+    cdas = sorted(cdas)
+    results: Dict[Tuple[int, int], bool] = {}
+    answers: Dict[int, Optional[int]] = {}
+    violations: List[FrontierViolation] = []
+
+    def make_car(index: int, parallel: int) -> Car:
+        return car.copy_with(cda=cdas[index],
+                             mass=car.mass + parallel * BATTERY_MASS_PER_PARALLEL_CELL,
+                             battery=dataclasses.replace(car.battery, cells_in_parallel=parallel))
+
+    with contextlib.ExitStack() as stack:
+        if irradiance_raster is None:
+            directory = stack.enter_context(tempfile.TemporaryDirectory())
+            irradiance_raster = build_irradiance_raster(race, os.path.join(directory, 'irradiance.bin'))
+        handle = publish_race(stack.enter_context(SharedRegistry()), race, irradiance_raster)
+        executor = stack.enter_context(ProcessPoolExecutor(max_workers=max_workers))
+
+        def run(searches: List[_ParallelCellSearch]) -> None:
+            while True:
+                active = [search for search in searches if not search.done]
+                if not active:
+                    break
+
+                keys = sorted({(search.index, n) for search in active
+                               for n in search.probes(sections)} - results.keys())
+                specs = [_outcome_spec(make_car(index, n), vehicle_speed, wind_speed, array_power_factor,
+                                       dt, integrator) for index, n in keys]
+                for key, outcome in zip(keys, executor.map(_run_scenario, itertools.repeat(handle), specs)):
+                    results[key] = bool(outcome.result)
+
+                for search in active:
+                    for n in search.probes(sections):
+                        search.finished[n] = results[(search.index, n)]
+                    violations.extend(search.update(cdas, results))
+
+            for search in searches:
+                answers[search.index] = search.high
+                print(cdas[search.index], search.high)
+
+        ends = sorted({0, len(cdas) - 1}) if cdas else []
+        run([_ParallelCellSearch(index, min_parallel_cells, max_parallel_cells, [], (cdas[index], cdas[index]))
+             for index in ends])
+
+        intervals = [(ends[0], ends[-1])] if len(ends) == 2 else []
+        while intervals:
+            searches = []
+            next_intervals = []
+            for i, j in intervals:
+                if j - i <= 1:
+                    continue
+                m = (i + j) // 2
+                low = answers[i] if answers[i] is not None else max_parallel_cells + 1
+                high = answers[j]
+
+                checks = []
+                if min_parallel_cells <= low - 1 <= max_parallel_cells:
+                    checks.append((low - 1, False))
+                if high is not None:
+                    checks.append((high, True))
+
+                searches.append(_ParallelCellSearch(m, min_parallel_cells, max_parallel_cells,
+                                                    checks, (cdas[i], cdas[j])))
+                next_intervals += [(i, m), (m, j)]
+
+            run(searches)
+            intervals = next_intervals
+
+    return BatteryFrontier(results={cdas[index]: answers[index] for index in sorted(answers)},
+                           violations=violations)
+
+
+SOC_LIMITED = 'soc'
+ARRIVAL_LIMITED = 'latest_arrival'
+
+
+@dataclass(frozen=True)
+class SpeedSearchResult:
+    """
+    Fastest constant target speed that finishes and what stops the car from going faster.
+
+    `speed` is None when even the slowest speed searched doesn't finish, and then the
+    limiting factor describes that run instead. `limiting_factor` is None when the fastest
+    speed searched finishes.
+    """
+    speed: Optional[float]  # <m/s>
+    limiting_factor: Optional[str]  # SOC_LIMITED or ARRIVAL_LIMITED
+    limiting_stop: Optional[str]  # name of the stop the battery ran out before or the car arrived late to
+    limiting_outcome: Optional[Outcome]  # run just faster than `speed`
+
+
+def _classify_outcome(race: Race, outcome: Outcome) -> Tuple[str, Optional[str]]:
+    """
+    Work out why a run didn't finish from where it ended.
+
+    :return: Tuple of the limiting factor and the name of the stop it applies to.
+    """
+    if outcome.final_soc <= 0.0:
+        stop = next((event for event in race.distance_events if event.distance > outcome.end_distance), None)
+        return SOC_LIMITED, stop.name if stop is not None else None
+
+    # `process_events` gives up on the stop the car just reached (or time ran out before the finish)
+    passed = [event for event in race.distance_events if event.distance <= outcome.end_distance]
+    stop = passed[-1] if passed and outcome.end_time <= race.time_events[-1].time else race.distance_events[-1]
+    return ARRIVAL_LIMITED, stop.name
+
+
+def find_fastest_feasible_speed(race: Race,
+                                car: Car,
+                                wind_speed: float = 0.0,
+                                array_power_factor: float = 1.0,
+                                speed_range: Tuple[float, float] = (40.0 / 3.6, 130.0 / 3.6),
+                                tolerance: float = 0.1,
+                                candidates: Optional[int] = None,
+                                dt: float = 1.0,
+                                integrator: str = EULER,
+                                irradiance_raster: Optional[IrradianceRaster] = None,
+                                max_workers: Optional[int] = None) -> SpeedSearchResult:
+    """
+    Find the fastest constant target speed that still finishes the race with a k-section search.
+
+    Each round simulates `candidates` evenly spaced speeds inside the current bracket in
+    parallel and shrinks the bracket to the gap between the fastest speed that finished
+    and the next faster speed that didn't, so the bracket shrinks by a factor of
+    `candidates + 1` per round. The run just above the answer is classified as SOC limited
+    (the battery ran out before a stop) or arrival limited (a stop's latest arrival was missed).
+
+    :param race: Race to evaluate.
+    :param car: Car to evaluate the race with.
+    :param wind_speed: Constant wind speed in m/s.
+    :param array_power_factor: Scalar applied to the array power.
+    :param speed_range: (slowest, fastest) target speed to search in m/s.
+    :param tolerance: Width of the final bracket in m/s.
+    :param candidates: Number of speeds simulated per round (defaults to the number of workers).
+    :param dt: Time step for each simulation.
+    :param integrator: Integrator for each simulation.
+    :param irradiance_raster: Raster to share between the runs. One is built for the
+    race in a temporary file when this isn't provided.
+    :param max_workers: Number of worker processes (defaults to the number of CPUs).
+
+    :return: SpeedSearchResult with the speed and the limiting factor.
+    """
+    if candidates is None:
+        candidates = max_workers or os.cpu_count() or 1
+    candidates = max(candidates, 1)
+
+    with contextlib.ExitStack() as stack:
+        if irradiance_raster is None:
+            directory = stack.enter_context(tempfile.TemporaryDirectory())
+            irradiance_raster = build_irradiance_raster(race, os.path.join(directory, 'irradiance.bin'))
+        handle = publish_race(stack.enter_context(SharedRegistry()), race, irradiance_raster)
+        executor = stack.enter_context(ProcessPoolExecutor(max_workers=max_workers))
+
+        def run(speeds: List[float]) -> List[Outcome]:
+            specs = [_outcome_spec(car, speed, wind_speed, array_power_factor, dt, integrator)
+                     for speed in speeds]
+            return list(executor.map(_run_scenario, itertools.repeat(handle), specs))
+
+        low, high = speed_range
+        low_outcome, high_outcome = run([low, high])
+        if not low_outcome.result:
+            return SpeedSearchResult(None, *_classify_outcome(race, low_outcome), low_outcome)
+        if high_outcome.result:
+            return SpeedSearchResult(high, None, None, None)
+
+        while high - low > tolerance:
+            speeds = [low + (high - low) * (i + 1) / (candidates + 1) for i in range(candidates)]
+            outcomes = run(speeds)
+
+            # Fastest speed that finished, then the next speed above it (which didn't)
+            for speed, outcome in zip(speeds, outcomes):
+                if outcome.result:
+                    low = speed
+            for speed, outcome in zip(speeds, outcomes):
+                if speed > low and not outcome.result:
+                    high, high_outcome = speed, outcome
+                    break
+
+            print(f'{low * 3.6:.2f} km/h finishes, {high * 3.6:.2f} km/h does not')
+
+    return SpeedSearchResult(low, *_classify_outcome(race, high_outcome), high_outcome)